@@ -2,36 +2,102 @@ import json
 
 from django.contrib import admin
 from django.contrib import messages
+from django.contrib.admin.utils import quote, unquote
+from django.core.exceptions import PermissionDenied
+from django.db.models.functions import Substr
+from django.http import Http404, HttpResponse
 from django.http.response import HttpResponseRedirect
+from django.urls import path, reverse
 from django.utils.html import format_html
 from djnewsletter.forms import EmailServersAdminForm
 from djnewsletter.helpers import send_email
-from djnewsletter.mixins import ApproxCountPaginatorMixin
-from djnewsletter.models import Unsubscribers, Emails, Bounced, Domains, EmailServers
+from djnewsletter.conf import settings
+from djnewsletter.mixins import ApproxCountPaginatorMixin, FullTextSearchMixin, KeysetChangeList, KeysetPaginationMixin
+from djnewsletter.models import (
+    Unsubscribers, Emails, EmailsArchive, Bounced, DailyStatistics, Domains, EmailServers,
+)
 
 
 class UnsubscribersAdmin(ApproxCountPaginatorMixin, admin.ModelAdmin):
     list_display = ['email', 'newsletter', 'unsubscribeDatetime']
 
 
-class EmailsAdmin(ApproxCountPaginatorMixin, admin.ModelAdmin):
-    list_display = ['subject', 'email_body', 'sender', 'recipient', 'newsletter', 'status', 'type', 'createDateTime',
-                    'changeDateTime']
+class EmailsChangeList(KeysetChangeList):
+    def get_queryset(self, request):
+        # Тело письма в списке не загружается, вместо него - начало текста, обрезанное в БД
+        return super().get_queryset(request).defer('body').annotate(
+            body_preview=Substr('body', 1, settings.DJNEWSLETTER_ADMIN_BODY_PREVIEW_LENGTH),
+        )
+
+
+class EmailsAdmin(FullTextSearchMixin, KeysetPaginationMixin, ApproxCountPaginatorMixin, admin.ModelAdmin):
+    list_display = ['subject', 'email_body', 'sender', 'recipient', 'newsletter', 'delivery_status', 'status', 'type',
+                    'createDateTime', 'changeDateTime']
+    list_filter = ['delivery_status']
     search_fields = ['subject', 'body', 'sender', 'recipient']
     readonly_fields = ['used_server']
 
+    def get_changelist(self, request, **kwargs):
+        return EmailsChangeList
+
+    def get_urls(self):
+        return [
+            path(
+                '<path:object_id>/body/',
+                self.admin_site.admin_view(self.body_view),
+                name='{}_{}_body'.format(self.model._meta.app_label, self.model._meta.model_name),
+            ),
+        ] + super().get_urls()
+
+    def body_view(self, request, object_id):
+        """
+        Тело письма целиком, для просмотра из списка писем.
+        Заголовок sandbox не даёт выполнять скрипты письма от имени админки.
+        """
+        if not self.has_view_or_change_permission(request):
+            raise PermissionDenied
+        email = self.get_object(request, unquote(object_id))
+        if email is None:
+            raise Http404
+        response = HttpResponse(email.body)
+        response['Content-Security-Policy'] = 'sandbox'
+        return response
+
     def email_body(self, obj):
+        body_preview = getattr(obj, 'body_preview', None)
+        if body_preview is None:
+            body_preview = obj.body[:settings.DJNEWSLETTER_ADMIN_BODY_PREVIEW_LENGTH]
         return format_html(
-            '<div style="word-break: break-word; overflow: auto; height: 100px;">{}</div>',
-            obj.body,
+            '<div style="word-break: break-word; overflow: auto; max-height: 100px;">{}</div>'
+            '<a href="{}" target="_blank">Открыть письмо</a>',
+            body_preview,
+            reverse(
+                'admin:{}_{}_body'.format(self.model._meta.app_label, self.model._meta.model_name),
+                args=[quote(obj.pk)],
+                current_app=self.admin_site.name,
+            ),
         )
 
 
-class BouncedAdmin(ApproxCountPaginatorMixin, admin.ModelAdmin):
+class EmailsArchiveAdmin(ApproxCountPaginatorMixin, admin.ModelAdmin):
+    list_display = ['subject', 'sender', 'recipient', 'newsletter', 'delivery_status', 'createDateTime', 'month']
+    list_filter = ['delivery_status']
+    date_hierarchy = 'month'
+    readonly_fields = [field.name for field in EmailsArchive._meta.fields]
+
+
+class BouncedAdmin(KeysetPaginationMixin, ApproxCountPaginatorMixin, admin.ModelAdmin):
     list_display = ['email', 'event', 'category', 'eventDateTime', 'reason', 'createDateTime']
     search_fields = ['email', 'event', 'category', 'reason']
 
 
+class DailyStatisticsAdmin(admin.ModelAdmin):
+    list_display = ['day', 'used_server', 'newsletter', 'delivery_status', 'count']
+    list_filter = ['delivery_status', 'used_server']
+    date_hierarchy = 'day'
+    readonly_fields = ['day', 'used_server', 'newsletter', 'delivery_status', 'count']
+
+
 class DomainsAdmin(admin.ModelAdmin):
     list_display = ['domain']
     search_fields = ['domain']
@@ -39,7 +105,7 @@ class DomainsAdmin(admin.ModelAdmin):
 
 class EmailServersAdmin(admin.ModelAdmin):
     form = EmailServersAdminForm
-    list_display = ['email_host', 'email_port', 'main', 'is_active', 'sending_method']
+    list_display = ['email_host', 'email_port', 'main', 'is_active', 'sending_method', 'weight']
     filter_horizontal = ['preferred_domains']
 
     def send_test_email(self, request, object_id):
@@ -82,6 +148,8 @@ class EmailServersAdmin(admin.ModelAdmin):
 
 admin.site.register(Unsubscribers, UnsubscribersAdmin)
 admin.site.register(Emails, EmailsAdmin)
+admin.site.register(EmailsArchive, EmailsArchiveAdmin)
 admin.site.register(Bounced, BouncedAdmin)
+admin.site.register(DailyStatistics, DailyStatisticsAdmin)
 admin.site.register(Domains, DomainsAdmin)
 admin.site.register(EmailServers, EmailServersAdmin)
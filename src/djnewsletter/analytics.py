@@ -1,7 +1,9 @@
-import json
 from datetime import datetime, timedelta
 
-from djnewsletter.models import Emails
+from django.db.models import Count, Q, Sum
+
+from djnewsletter.models import DailyStatistics, EmailRecipients
+from djnewsletter.statuses import DeliveryStatus
 
 
 class Analytics:
@@ -11,10 +13,6 @@ class Analytics:
         :param ranges: список дней, за которые нужно получить статистику, например ['today', 5, '15', 30]
         """
         self.ranges = ranges
-        self.backends = {
-            'smtp': self.parse_status_smtp,
-            'unisender_api': self.parse_status_unisender,
-        }
         self.statuses = {
             # внутренний ключ: ключ для отображения
             'success': 'success',
@@ -31,33 +29,57 @@ class Analytics:
         return self.now - timedelta(days=days), self.now
 
     def get_email_stats(self, email):
+        """
+        Один запрос по EmailRecipients для всех периодов: строки раскладываются по периодам условной агрегацией.
+        Письмо считается доставленным получателю, если его delivery_status - DeliveryStatus.SENT
+        и получатель не отмечен EmailRecipients.failed, остальные - ошибки.
+        """
+        filter_ranges = [self._get_filter_range(days) for days in self.ranges]
+        if not filter_ranges:
+            return {}
+
+        aggregates = {}
+        sent = Q(email__delivery_status=DeliveryStatus.SENT, failed=False)
+        for idx, filter_range in enumerate(filter_ranges):
+            in_range = Q(sentDateTime__range=filter_range)
+            aggregates['total_{}'.format(idx)] = Count('id', filter=in_range)
+            aggregates['success_{}'.format(idx)] = Count('id', filter=in_range & sent)
+        counts = EmailRecipients.objects.filter(
+            recipient=email,
+            sentDateTime__gte=min(start for start, _ in filter_ranges),
+        ).aggregate(**aggregates)
+
         full_statistics = {}
-        emails_qs = Emails.objects.filter(
-            recipient__icontains=email
-        )
-        for days in self.ranges:
-            period_statistics = {field: 0 for _, field in self.statuses.items()}
-            emails = emails_qs.filter(
-                createDateTime__range=self._get_filter_range(days)
-            ).select_related('used_server')
-            for email_instance in emails:
-                parse_status = self.backends.get(email_instance.used_server.sending_method)
-                status = parse_status(email, email_instance.status)
-                period_statistics[status] += 1
-            period_statistics.update({'total': sum(period_statistics.values())})
-            full_statistics.update({days: period_statistics})
+        for idx, days in enumerate(self.ranges):
+            total = counts['total_{}'.format(idx)]
+            success = counts['success_{}'.format(idx)]
+            full_statistics[days] = {
+                self.statuses['success']: success,
+                self.statuses['error']: total - success,
+                'total': total,
+            }
         return full_statistics
 
-    def parse_status_unisender(self, email, status):
-        try:
-            status = json.loads(status.replace('\'', '\"'))
-            if status.get('status') == 'success' and email in status.get('emails', []):
-                return self.statuses['success']
-            return self.statuses['error']
-        except ValueError:
-            return self.statuses['error']
-
-    def parse_status_smtp(self, email, status):
-        if status == 'sent to user':
-            return self.statuses['success']
-        return self.statuses['error']
+    def get_daily_stats(self, date_from, date_to, used_server=None, newsletter=None):
+        """
+        Количество писем по дням из DailyStatistics, без обращения к Emails.
+        :return: {день: {'success': ..., 'error': ..., 'total': ...}}
+        """
+        daily_statistics = DailyStatistics.objects.filter(day__range=(date_from, date_to))
+        if used_server is not None:
+            daily_statistics = daily_statistics.filter(used_server=used_server)
+        if newsletter is not None:
+            daily_statistics = daily_statistics.filter(newsletter=newsletter)
+
+        full_statistics = {}
+        for row in daily_statistics.values('day').annotate(
+                total=Sum('count'),
+                success=Sum('count', filter=Q(delivery_status=DeliveryStatus.SENT)),
+        ).order_by('day'):
+            success = row['success'] or 0
+            full_statistics[row['day']] = {
+                self.statuses['success']: success,
+                self.statuses['error']: row['total'] - success,
+                'total': row['total'],
+            }
+        return full_statistics
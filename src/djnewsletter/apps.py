@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+
+
+class DjnewsletterConfig(AppConfig):
+    name = 'djnewsletter'
+    verbose_name = 'djnewsletter'
+
+    def ready(self):
+        # noinspection PyUnresolvedReferences
+        import djnewsletter.signals  # noqa: F401
+        from djnewsletter.ratelimit import rate_limiter
+        # Проверка настроек хранилища ограничения скорости при запуске, а не при первой отправке
+        rate_limiter.get_storage()
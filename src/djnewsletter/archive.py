@@ -0,0 +1,122 @@
+import functools
+import operator
+from datetime import date, datetime, timedelta
+
+from django.db import transaction
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+
+from djnewsletter.conf import settings
+from djnewsletter.models import Emails, EmailsArchive
+from djnewsletter.statuses import DeliveryStatus
+from djnewsletter.storage import get_today
+
+ARCHIVE_FIELDS = [field.attname for field in EmailsArchive._meta.concrete_fields if field.name != 'month']
+
+
+def get_retention_cutoffs(now):
+    """
+    Границы хранения писем: письма, созданные раньше границы, считаются устаревшими.
+    :return: (граница для писем без своего срока хранения или None, {newsletter: граница})
+    """
+    retention = settings.DJNEWSLETTER_EMAILS_RETENTION
+    default_cutoff = None if retention is None else now - timedelta(days=retention)
+    newsletter_cutoffs = {
+        newsletter: None if days is None else now - timedelta(days=days)
+        for newsletter, days in settings.DJNEWSLETTER_EMAILS_RETENTION_BY_NEWSLETTER.items()
+    }
+    return default_cutoff, newsletter_cutoffs
+
+
+def get_expired_emails_filter(default_cutoff, newsletter_cutoffs):
+    """
+    :return: Q по устаревшим письмам или None, если срок хранения не задан
+    """
+    conditions = [
+        Q(newsletter=newsletter, createDateTime__lt=cutoff)
+        for newsletter, cutoff in newsletter_cutoffs.items()
+        if cutoff is not None
+    ]
+    if default_cutoff is not None:
+        condition = Q(createDateTime__lt=default_cutoff)
+        if newsletter_cutoffs:
+            condition &= ~Q(newsletter__in=list(newsletter_cutoffs))
+        conditions.append(condition)
+    if not conditions:
+        return None
+    return functools.reduce(operator.or_, conditions)
+
+
+def get_month(value):
+    return date(value.year, value.month, 1)
+
+
+def archive_expired_emails(chunk_size=None, purge=False, now=None):
+    """
+    Переносит устаревшие письма в EmailsArchive (или удаляет их при purge=True) пачками по chunk_size.
+    Письма перебираются по возрастанию id от последнего обработанного (keyset), каждая пачка
+    обрабатывается в отдельной транзакции; EmailRecipients писем удаляются вместе с ними.
+    DailyStatistics не меняется.
+    :return: генератор количества писем в обработанных пачках
+    """
+    chunk_size = chunk_size or settings.DJNEWSLETTER_ARCHIVE_CHUNK_SIZE
+    default_cutoff, newsletter_cutoffs = get_retention_cutoffs(now or timezone.now())
+    expired_filter = get_expired_emails_filter(default_cutoff, newsletter_cutoffs)
+    if expired_filter is None:
+        return
+
+    # Письма новее самой поздней границы не устаревают, по ней ограничивается перебор
+    latest_cutoff = max(cutoff for cutoff in [default_cutoff, *newsletter_cutoffs.values()] if cutoff is not None)
+    max_id = Emails.objects.filter(createDateTime__lt=latest_cutoff).aggregate(max_id=Max('id'))['max_id']
+    if max_id is None:
+        return
+
+    fields = ['id'] if purge else ARCHIVE_FIELDS
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                Emails.objects.filter(
+                    expired_filter,
+                    id__gt=last_id,
+                    id__lte=max_id,
+                ).order_by('id').values(*fields)[:chunk_size]
+            )
+            if not rows:
+                return
+            ids = [row['id'] for row in rows]
+            if not purge:
+                EmailsArchive.objects.bulk_create(
+                    [EmailsArchive(month=get_month(row['createDateTime']), **row) for row in rows],
+                    ignore_conflicts=True,
+                )
+            # only('id'): удаление не загружает тела писем
+            Emails.objects.filter(id__in=ids).only('id').delete()
+        last_id = ids[-1]
+        yield len(rows)
+
+
+def get_content_cutoff(today=None):
+    """
+    День, раньше которого содержимое вложений в хранилище (DJNEWSLETTER_CONTENT_STORAGE) не нужно:
+    на DJNEWSLETTER_CONTENT_RETENTION дней раньше сегодняшнего и раньше дня создания самого старого
+    письма в очереди. Письма в очереди старше DJNEWSLETTER_CONTENT_QUEUED_MAX_AGE дней (потерянные задачи,
+    записи 'sent to queue' до миграции 0009) не учитываются, иначе одно такое письмо остановит очистку.
+    """
+    today = today or get_today()
+    cutoff = today - timedelta(days=settings.DJNEWSLETTER_CONTENT_RETENTION)
+    queued_since = datetime.combine(
+        today - timedelta(days=settings.DJNEWSLETTER_CONTENT_QUEUED_MAX_AGE), datetime.min.time(),
+    )
+    if settings.USE_TZ:
+        queued_since = timezone.make_aware(queued_since)
+    oldest_queued = Emails.objects.filter(
+        delivery_status=DeliveryStatus.QUEUED,
+        createDateTime__gte=queued_since,
+    ).aggregate(oldest_queued=Min('createDateTime'))['oldest_queued']
+    if oldest_queued is not None:
+        if timezone.is_aware(oldest_queued):
+            oldest_queued = timezone.localtime(oldest_queued)
+        # Содержимое могло быть сохранено до полуночи, а письмо создано после
+        cutoff = min(cutoff, oldest_queued.date() - timedelta(days=1))
+    return cutoff
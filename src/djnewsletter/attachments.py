@@ -0,0 +1,116 @@
+import collections
+import email
+import threading
+from email.message import Message
+from email.mime.base import MIMEBase
+from email.policy import compat32
+
+from djnewsletter.conf import settings
+from djnewsletter.storage import content_storage, load_bytes, store_bytes, store_content
+
+
+class EncodedAttachmentsCache:
+    def __init__(self):
+        """
+        Закодированное содержимое вложений, хранится в памяти процесса (воркера).
+        Общий размер ограничен DJNEWSLETTER_ATTACHMENTS_CACHE_SIZE байт,
+        при превышении вытесняются давно не использованные записи.
+        """
+        self._lock = threading.Lock()
+        self._items = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, cache_key, encode):
+        """
+        :param encode: функция, возвращающая (значение, размер в байтах); вызывается при промахе
+        """
+        with self._lock:
+            item = self._items.get(cache_key)
+            if item is not None:
+                self._items.move_to_end(cache_key)
+                return item[0]
+
+        value, size = encode()
+        max_size = settings.DJNEWSLETTER_ATTACHMENTS_CACHE_SIZE
+        with self._lock:
+            if cache_key not in self._items and size <= max_size:
+                self._items[cache_key] = (value, size)
+                self.size += size
+                while self.size > max_size:
+                    _, (_, evicted_size) = self._items.popitem(last=False)
+                    self.size -= evicted_size
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items = collections.OrderedDict()
+            self.size = 0
+
+
+encoded_attachments_cache = EncodedAttachmentsCache()
+
+
+class StoredAttachment:
+    def __init__(self, key, filename, mimetype):
+        """
+        Вложение (filename, content, mimetype), содержимое которого лежит в хранилище по ключу key.
+        """
+        self.key = key
+        self.filename = filename
+        self.mimetype = mimetype
+
+    def read(self):
+        return load_bytes(self.key)
+
+    def get_mime_part(self, email_message):
+        """
+        В кеше хранятся только заголовки и закодированное содержимое (строки),
+        MIME часть для каждого письма создаётся заново.
+        """
+        def encode():
+            mime_part = email_message.create_mime_attachment(self.filename, self.read(), self.mimetype)
+            # get_payload() декодирует 8bit содержимое текста, а нужна закодированная строка как есть
+            payload = mime_part._payload
+            return (tuple(mime_part.items()), payload), len(payload)
+
+        headers, payload = encoded_attachments_cache.get(('mime', self.key, self.filename, self.mimetype), encode)
+        mime_part = ParsedMIMEPart()
+        for name, value in headers:
+            mime_part[name] = value
+        mime_part.set_payload(payload)
+        return mime_part
+
+    def open(self):
+        return content_storage.open(self.key, 'rb')
+
+    def size(self):
+        return content_storage.size(self.key)
+
+
+class ParsedMIMEPart(MIMEBase):
+    def __init__(self, policy=compat32):
+        """
+        MIME часть, восстановленная из байтов парсером email или из закодированного содержимого в кеше.
+        Наследует MIMEBase, потому что EmailMessage добавляет к письму как есть только экземпляры MIMEBase.
+        """
+        Message.__init__(self, policy=policy)
+
+
+def store_attachment(attachment):
+    """
+    :param attachment: MIMEBase или (filename, content, mimetype)
+    :return: ссылка на вложение в хранилище для данных задачи
+    """
+    if isinstance(attachment, MIMEBase):
+        return {'key': store_content(attachment.as_bytes()), 'mime_part': True}
+
+    filename, content, mimetype = attachment
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+    return {'key': store_bytes(content), 'filename': filename, 'mimetype': mimetype}
+
+
+def load_attachment(ref):
+    if ref.get('mime_part'):
+        return email.message_from_bytes(load_bytes(ref['key']), _class=ParsedMIMEPart)
+    return StoredAttachment(key=ref['key'], filename=ref['filename'], mimetype=ref['mimetype'])
@@ -1,14 +1,32 @@
-from copy import deepcopy
-
 from django.core.mail.backends.base import BaseEmailBackend
 from django.db import transaction
 
+from djnewsletter.conf import (
+    settings,
+)
 from djnewsletter.handlers import (
     DJNewsLetterSendingHandlers,
 )
+from djnewsletter.models import (
+    EmailRecipients,
+    Emails,
+)
 from djnewsletter.options import (
     DJNewsLetterSendingMethodOptions,
 )
+from djnewsletter.payloads import (
+    create_payload,
+    store_message_attachments,
+)
+from djnewsletter.rollup import (
+    record_status_changes,
+)
+from djnewsletter.statuses import (
+    DeliveryStatus,
+)
+from djnewsletter.tasks import (
+    send_batch_async,
+)
 
 
 class DJNewsletterBackend(BaseEmailBackend):
@@ -16,41 +34,126 @@ class DJNewsletterBackend(BaseEmailBackend):
         super().__init__(fail_silently, **kwargs)
         self.sending_options = DJNewsLetterSendingMethodOptions()
 
-    def run_task(self, email_message):
+    def run_task(self, email_instance, payload, task_options):
+        try:
+            task = self.sending_options.get_task_by_sending_method(email_instance.used_server.sending_method)
+            task.apply_async(args=(payload,), **task_options)
+        except Exception as e:
+            email_instance.status = str(e)
+            email_instance.delivery_status = DeliveryStatus.FAILED
+            email_instance.save()
+            record_status_changes([email_instance])
+
+    @staticmethod
+    def run_batch_task(task, email_instances, payloads, task_options):
         try:
-            task = self.sending_options.get_task_by_sending_method(email_message.email_server.sending_method)
+            task.apply_async(args=(payloads,), **task_options)
+        except Exception as e:
+            for email_instance in email_instances:
+                email_instance.status = str(e)
+                email_instance.delivery_status = DeliveryStatus.FAILED
+                email_instance.save()
+            record_status_changes(email_instances)
+
+    def get_batch_options(self, email_server):
+        """
+        :return: (задача, ключ группировки, размер пачки) или None, если письмо отправляется отдельной задачей
+        """
+        if settings.DJNEWSLETTER_ASYNC_ENGINE:
+            return send_batch_async, None, settings.DJNEWSLETTER_ASYNC_BATCH_SIZE
+
+        batch_task = self.sending_options.get_batch_task_by_sending_method(email_server.sending_method)
+        if batch_task is None or settings.DJNEWSLETTER_TASK_BATCH_SIZE <= 1:
+            return None
+        return batch_task, email_server.pk, settings.DJNEWSLETTER_TASK_BATCH_SIZE
+
+    def run_tasks(self, queued_emails):
+        """
+        При DJNEWSLETTER_TASK_BATCH_SIZE > 1 письма одного сервера с одинаковыми countdown и eta
+        объединяются в пачки, если для способа отправки есть задача для пачки.
+        При DJNEWSLETTER_ASYNC_ENGINE письма всех серверов отправляются пачками через send_batch_async.
+        """
+        batches = {}
+        for email_message, email_instance, recipients, from_email, stored_attachments in queued_emails:
+            email_server = email_instance.used_server
+            payload = create_payload(
+                email_message=email_message,
+                email_instance=email_instance,
+                email_server=email_server,
+                recipients=recipients,
+                from_email=from_email,
+                stored_attachments=stored_attachments,
+            )
             task_options = {
                 'countdown': email_message.countdown,
                 'eta': email_message.eta,
             }
-            task.apply_async(args=(email_message,), **task_options)
-        except Exception as e:
-            email_message.email_instance.status = str(e)
-            email_message.email_instance.save()
+            batch_options = self.get_batch_options(email_server)
+            if batch_options is None:
+                self.run_task(email_instance, payload, task_options)
+                continue
 
-    def send_messages(self, email_messages):
-        for email_message in email_messages:
-            with transaction.atomic():
+            batch_task, batch_server_key, batch_size = batch_options
+            batch_key = (batch_task.name, batch_server_key, email_message.countdown, email_message.eta)
+            _, email_instances, payloads, _ = batches.setdefault(batch_key, (batch_task, [], [], task_options))
+            email_instances.append(email_instance)
+            payloads.append(payload)
+            if len(payloads) >= batch_size:
+                self.run_batch_task(*batches.pop(batch_key))
+
+        for batch in batches.values():
+            self.run_batch_task(*batch)
+
+    @staticmethod
+    def create_emails(not_sent_emails, queued_emails):
+        """
+        Записи в Emails для всей пачки писем создаются через bulk_create, записи в EmailRecipients -
+        одним bulk_create для всех получателей, DailyStatistics обновляется по одному запросу на ключ.
+        """
+        emails = not_sent_emails + queued_emails
+        Emails.objects.bulk_create_with_ids(emails)
+        EmailRecipients.objects.create_for_emails(emails)
+        record_status_changes(emails)
+
+    def send_messages(self, email_messages, not_sent_emails=None):
+        """
+        :param not_sent_emails: записи 'did not send', созданные до вызова (подавление пачки в send_mass_email),
+            сохраняются вместе с записями писем
+        """
+        not_sent_emails = list(not_sent_emails or [])
+        queued_emails = []
+        with transaction.atomic():
+            for email_message in email_messages:
                 message_handler = DJNewsLetterSendingHandlers().get_handler(email_message)
                 email_message = message_handler.handle()
+                not_sent_emails.extend(message_handler.not_sent_emails)
+                if not email_message.recipients_email_server_route:
+                    continue
+
+                stored_attachments = store_message_attachments(email_message)
                 for email_server, recipients in email_message.recipients_email_server_route.items():
                     from_email = self.sending_options.get_from_email(email_server)
-                    email_message.email_instance = message_handler.create_email(
+                    email_instance = message_handler.create_email(
                         sender=from_email,
                         recipients=recipients,
                         used_server=email_server,
                         status='sent to queue',
+                        delivery_status=DeliveryStatus.QUEUED,
                     )
-                    email_message_for_task = deepcopy(email_message)
-                    email_message_for_task.to = recipients
-                    email_message_for_task.from_email = from_email
-                    email_message_for_task.email_server = email_server
-                    transaction.on_commit(
-                        lambda m=email_message_for_task: self.run_task(
-                            email_message=m,
-                        )
+                    queued_emails.append(
+                        (email_message, email_instance, recipients, from_email, stored_attachments),
                     )
 
+            self.create_emails(
+                not_sent_emails=not_sent_emails,
+                queued_emails=[email_instance for _, email_instance, _, _, _ in queued_emails],
+            )
+            transaction.on_commit(
+                lambda: self.run_tasks(
+                    queued_emails=queued_emails,
+                )
+            )
+
         return len(email_messages)
 
 
@@ -0,0 +1,68 @@
+import json
+from datetime import datetime
+
+from djnewsletter.conf import settings
+from djnewsletter.models import Bounced
+
+# Поля Bounced, которые можно заполнить из события SendGrid, вычисляются один раз при импорте
+BOUNCED_FIELDS = frozenset(
+    field.name for field in Bounced._meta.concrete_fields
+) - {'id', 'eventDateTime', 'category', 'createDateTime'}
+BOUNCED_MAX_LENGTHS = {
+    field.name: field.max_length for field in Bounced._meta.concrete_fields if field.max_length is not None
+}
+# Поля, по которым событие ищется (подавление, уникальность): обрезанное значение бессмысленно
+BOUNCED_KEY_FIELDS = frozenset(['email', 'event'])
+
+
+def is_sendgrid_payload(data):
+    """
+    Быстрая проверка тела запроса без разбора JSON: SendGrid присылает массив событий.
+    """
+    return data.lstrip()[:1] == b'['
+
+
+def build_bounced(events):
+    """
+    Строит объекты Bounced по событиям SendGrid.
+    Хранится первое событие каждого типа для адреса, поэтому повторы внутри пачки отбрасываются;
+    события без timestamp пропускаются. Значения длиннее поля обрезаются, события с адресом или типом
+    длиннее поля пропускаются: иначе ошибка БД повторялась бы при каждом повторе задачи.
+    """
+    new_items = {}
+    for item in events:
+        if not isinstance(item, dict) or 'timestamp' not in item:
+            continue
+        values = {field: value for field, value in item.items() if field in BOUNCED_FIELDS}
+        category = item.get('category')
+        if category:
+            values['category'] = str(category)
+        if any(
+            isinstance(values.get(field), str) and len(values[field]) > BOUNCED_MAX_LENGTHS[field]
+            for field in BOUNCED_KEY_FIELDS
+        ):
+            continue
+        for field, value in values.items():
+            max_length = BOUNCED_MAX_LENGTHS.get(field)
+            if isinstance(value, str) and max_length is not None:
+                values[field] = value[:max_length]
+        bounced = Bounced(**values)
+        bounced.eventDateTime = datetime.fromtimestamp(item['timestamp'])
+        new_items.setdefault((bounced.email, bounced.event), bounced)
+    return list(new_items.values())
+
+
+def create_sendgrid_bounced(data):
+    """
+    Сохраняет события из тела запроса SendGrid пачками по DJNEWSLETTER_BOUNCED_BATCH_SIZE.
+    События, которые уже есть в Bounced (в том числе из повторной отправки пачки), пропускаются.
+    :return: количество событий в пачке после удаления повторов
+    """
+    new_items = build_bounced(json.loads(data))
+    if new_items:
+        Bounced.objects.bulk_create(
+            new_items,
+            batch_size=settings.DJNEWSLETTER_BOUNCED_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+    return len(new_items)
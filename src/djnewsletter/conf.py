@@ -12,3 +12,39 @@ class DjnewsletterAppConf(AppConf):
     INTERVAL_SENDING_TO_RECIPIENT = None
     UNISENDER_URL = None
     MIN_APPROX_COUNT = 10000
+    APPROX_COUNT_TIMEOUT = 60  # seconds
+    APPROX_COUNT_CACHE_SIZE = 1000
+    ADMIN_BODY_PREVIEW_LENGTH = 300
+    ROUTING_TABLE_TIMEOUT = 60  # seconds
+    SUPPRESSION_CHUNK_SIZE = 300
+    SUPPRESSION_INDEX = False
+    SUPPRESSION_INDEX_REFRESH_INTERVAL = 10  # seconds
+    SUPPRESSION_INDEX_OVERLAP = 60  # seconds
+    SUPPRESSION_INDEX_ERROR_RATE = 0.001
+    SUPPRESSION_INDEX_MIN_CAPACITY = 100000
+    MASS_SENDING_CHUNK_SIZE = 1000
+    BOUNCED_BATCH_SIZE = 500
+    EMAILS_RETENTION = None  # days, None - хранить всегда
+    EMAILS_RETENTION_BY_NEWSLETTER = {}  # {newsletter: days или None}
+    ARCHIVE_CHUNK_SIZE = 1000
+    CONTENT_STORAGE = None  # обязательна для писем с вложениями: хранилище, общее для всех воркеров
+    CONTENT_STORAGE_OPTIONS = {}
+    CONTENT_RETENTION = 7  # days
+    CONTENT_QUEUED_MAX_AGE = 30  # days, письма в очереди старше не задерживают очистку хранилища
+    ATTACHMENTS_CACHE_SIZE = 50 * 1024 * 1024  # bytes
+    SMTP_POOL = True
+    SMTP_POOL_IDLE_TIMEOUT = 30  # seconds
+    SMTP_POOL_MAX_MESSAGES = 100
+    SMTP_STATUS_FLUSH_SIZE = 10
+    TASK_BATCH_SIZE = 1
+    UNISENDER_CONNECT_TIMEOUT = 5  # seconds
+    UNISENDER_READ_TIMEOUT = 30  # seconds
+    UNISENDER_POOL_SIZE = 10
+    UNISENDER_CHUNK_SIZE = 64 * 1024  # bytes
+    ASYNC_ENGINE = False
+    ASYNC_BATCH_SIZE = 500
+    ASYNC_CONCURRENCY = 100
+    ASYNC_SERVER_CONCURRENCY = 10
+    RATE_LIMIT_STORAGE = 'db'  # 'db', 'cache' или 'local'
+    RATE_LIMIT_CACHE = 'default'  # для 'cache': общий для воркеров кеш (memcached, redis, БД)
+    RATE_LIMIT_MAX_SLEEP = 1  # seconds
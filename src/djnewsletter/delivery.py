@@ -0,0 +1,72 @@
+from djnewsletter.attachments import (
+    StoredAttachment,
+)
+from djnewsletter.smtp import (
+    smtp_connection_pool,
+)
+from djnewsletter.statuses import (
+    DeliveryStatus,
+)
+from djnewsletter.unisender import (
+    UniSenderAPIClient,
+)
+
+
+def prepare_smtp_attachments(email_message):
+    email_message.attachments.extend(
+        email_message.inline_attachments
+    )
+    for idx, attachment in enumerate(email_message.attachments):
+        if isinstance(attachment, StoredAttachment):
+            # MIME часть кодируется один раз на процесс и переиспользуется для всех писем с этим вложением
+            email_message.attachments[idx] = attachment.get_mime_part(email_message)
+        elif isinstance(attachment, tuple) and len(attachment) == 3:
+            email_message.attachments[idx] = email_message.create_mime_attachment(*attachment)
+
+
+def deliver_by_smtp(email_message):
+    """
+    Отправка письма без обращений к БД (можно вызывать из любого потока).
+    :return: (статус доставки, подробности статуса, id письма у провайдера)
+    """
+    prepare_smtp_attachments(email_message)
+    smtp_connection_pool.send_messages(email_message.email_server, [email_message])
+    return DeliveryStatus.SENT, 'sent to user', None
+
+
+def deliver_by_unisender(email_message):
+    unisender_api = UniSenderAPIClient(
+        api_key=email_message.email_server.api_key,
+        username=email_message.email_server.api_username,
+    )
+    response_json = unisender_api.send(
+        subject=email_message.subject,
+        body_html=email_message.body,
+        from_email=email_message.from_email,
+        from_name=email_message.email_server.api_from_name,
+        recipients=email_message.to,
+        attachments=email_message.attachments,
+        inline_attachments=email_message.inline_attachments,
+    )
+    if response_json.get('status') == 'success':
+        delivery_status = DeliveryStatus.SENT
+        # Запись в БД делает вызывающий код (EmailRecipients.objects.mark_failed)
+        email_message.email_instance.failed_recipients = get_unisender_failed_recipients(
+            response_json, email_message.to,
+        )
+    else:
+        delivery_status = DeliveryStatus.FAILED
+    return delivery_status, str(response_json), response_json.get('job_id')
+
+
+def get_unisender_failed_recipients(response_json, recipients):
+    """
+    Получатели успешного запроса, которым UniSender не отправил письмо: перечисленные в failed_emails
+    и отсутствующие в emails (если ответ содержит emails).
+    """
+    failed_emails = response_json.get('failed_emails') or {}
+    emails = response_json.get('emails')
+    return [
+        recipient for recipient in recipients
+        if recipient in failed_emails or (emails is not None and recipient not in emails)
+    ]
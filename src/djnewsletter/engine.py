@@ -0,0 +1,92 @@
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from djnewsletter.conf import settings
+from djnewsletter.options import DJNewsLetterSendingMethodOptions
+from djnewsletter.payloads import load_email_messages, update_statuses
+from djnewsletter.ratelimit import rate_limiter
+from djnewsletter.statuses import DeliveryStatus
+
+
+class AsyncDeliveryEngine:
+    def __init__(self, concurrency=None, server_concurrency=None):
+        """
+        Одновременная отправка многих писем из одного процесса.
+        Блокирующие SMTP и HTTP клиенты выполняются в пуле из concurrency потоков, asyncio ограничивает
+        количество одновременных отправок через один EmailServers значением server_concurrency.
+        Отправка идёт через функцию 'deliver' из DJNewsLetterSendingMethodOptions, к БД обращается только
+        вызывающий поток.
+        """
+        self.concurrency = concurrency or settings.DJNEWSLETTER_ASYNC_CONCURRENCY
+        self.server_concurrency = server_concurrency or settings.DJNEWSLETTER_ASYNC_SERVER_CONCURRENCY
+        self.sending_options = DJNewsLetterSendingMethodOptions()
+
+    async def deliver(self, executor, semaphore, email_message, email_instance, wait=0):
+        """
+        :param wait: через сколько секунд наступит время отправки письма по ограничению скорости
+        """
+        deliver = self.sending_options.get_deliver_by_sending_method(email_message.email_server.sending_method)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        async with semaphore:
+            try:
+                delivery_status, status, email_remote_id = await asyncio.get_running_loop().run_in_executor(
+                    executor, deliver, email_message,
+                )
+            except Exception as e:
+                email_instance.delivery_status = DeliveryStatus.FAILED
+                email_instance.status = str(e)
+                return e
+
+        email_instance.delivery_status = delivery_status
+        email_instance.status = status
+        if email_remote_id is not None:
+            email_instance.email_remote_id = email_remote_id
+        return None
+
+    async def deliver_all(self, email_messages, waits):
+        semaphores = collections.defaultdict(lambda: asyncio.Semaphore(self.server_concurrency))
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return await asyncio.gather(*[
+                self.deliver(executor, semaphores[email_message.email_server.pk], email_message, email_instance, wait)
+                for (email_message, email_instance), wait in zip(email_messages, waits)
+            ])
+
+    @staticmethod
+    def split_rate_limited(payloads, email_messages):
+        """
+        Письма, время отправки которых по ограничению скорости наступит в пределах
+        DJNEWSLETTER_RATE_LIMIT_MAX_SLEEP секунд, отправляются в этой задаче после ожидания,
+        остальные откладываются с зарезервированным временем отправки.
+        :return: (данные и письма для отправки, ожидание перед отправкой каждого, отложенные данные,
+            через сколько секунд наступит время первого отложенного письма)
+        """
+        max_sleep = settings.DJNEWSLETTER_RATE_LIMIT_MAX_SLEEP
+        ready, ready_waits, deferred_payloads, deferred_waits = [], [], [], []
+        for payload, (email_message, email_instance) in zip(payloads, email_messages):
+            wait = rate_limiter.reserve(email_message.email_server, payload, max_wait=max_sleep)
+            if wait > max_sleep:
+                deferred_payloads.append(payload)
+                deferred_waits.append(wait)
+            else:
+                ready.append((payload, (email_message, email_instance)))
+                ready_waits.append(wait)
+        return ready, ready_waits, deferred_payloads, min(deferred_waits, default=0)
+
+    def send(self, payloads):
+        """
+        :return: (данные неотправленных писем, последняя ошибка, данные отложенных писем,
+            через сколько секунд повторить отложенные)
+        """
+        ready, ready_waits, deferred_payloads, wait = self.split_rate_limited(payloads, load_email_messages(payloads))
+        email_messages = [email_message for _, email_message in ready]
+        errors = asyncio.run(self.deliver_all(email_messages, ready_waits))
+        update_statuses(
+            [email_instance for _, email_instance in email_messages],
+            fields=('delivery_status', 'status', 'email_remote_id'),
+        )
+
+        failed_payloads = [payload for (payload, _), error in zip(ready, errors) if error is not None]
+        last_error = next((error for error in reversed(errors) if error is not None), None)
+        return failed_payloads, last_error, deferred_payloads, wait
@@ -4,6 +4,7 @@ from datetime import datetime, timedelta
 from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core.mail import EmailMultiAlternatives
+from django.db.models import CharField, Value
 
 from djnewsletter.exceptions import (
     SuitableEmailServerNotFoundException,
@@ -13,10 +14,19 @@ from djnewsletter.mail import (
 )
 from djnewsletter.models import (
     Bounced,
-    EmailServers,
+    EmailRecipients,
     Emails,
     Unsubscribers,
 )
+from djnewsletter.routing import (
+    email_servers_router,
+)
+from djnewsletter.statuses import (
+    DeliveryStatus,
+)
+from djnewsletter.suppression import (
+    suppression_index,
+)
 
 
 class DJNewsLetterSendingHandlers:
@@ -43,6 +53,7 @@ class BaseEmailMessageHandler:
     def __init__(self, email_message):
         self.email_message = email_message
         self.site = self.get_site()
+        self.not_sent_emails = []
 
     def handle(self):
         raise NotImplementedError
@@ -56,52 +67,12 @@ class BaseEmailMessageHandler:
         djnewsletter_email_message.copy_attributes_from_child_instance(self.email_message)
         self.email_message = djnewsletter_email_message
 
-    def get_email_servers(self, domain):
-        email_servers = []
-        if self.site is not None:
-            email_servers.extend([
-                EmailServers.objects.filter(
-                    is_active=True,
-                    sites=self.site,
-                    preferred_domains__domain=domain,
-                ),
-                EmailServers.objects.filter(
-                    is_active=True,
-                    sites=self.site,
-                ),
-            ])
-        email_servers.extend([
-            EmailServers.objects.filter(
-                is_active=True,
-                preferred_domains__domain=domain,
-                sites__isnull=True,
-            ),
-            EmailServers.objects.filter(
-                main=True,
-                is_active=True,
-                sites__isnull=True,
-            ),
-        ])
-        return email_servers
-
     def get_recipients_email_server_route(self):
         recipients_email_server_route = collections.defaultdict(list)
-        email_servers_for_domains_cache = {}
+        routing_table = email_servers_router.get_table()
         for email in self.email_message.to:
             domain = email.split('@')[1]
-            cached_email_server_for_domain = email_servers_for_domains_cache.get(domain, None)
-            if cached_email_server_for_domain:
-                recipients_email_server_route[cached_email_server_for_domain].append(email)
-                continue
-
-            email_server = next(
-                (
-                    email_server.first() for email_server in self.get_email_servers(domain)
-                    if email_server.first() is not None
-                ),
-                None,
-            )
-
+            email_server = routing_table.get_email_server(domain, self.site)
             if not email_server:
                 raise SuitableEmailServerNotFoundException(
                     'Ошибка выбора EmailServers для адреса: `{email}`'.format(
@@ -109,7 +80,6 @@ class BaseEmailMessageHandler:
                     )
                 )
             recipients_email_server_route[email_server].append(email)
-            email_servers_for_domains_cache[domain] = email_server
         return recipients_email_server_route
 
     @staticmethod
@@ -118,8 +88,11 @@ class BaseEmailMessageHandler:
             return Site.objects.get_current()
         return None
 
-    def create_email(self, sender, recipients, status, used_server=None, save=True):
-        email = Emails(
+    def create_email(self, sender, recipients, status, delivery_status, used_server=None):
+        """
+        Запись Emails без сохранения: записи всей пачки писем сохраняет DJNewsletterBackend.create_emails.
+        """
+        return Emails(
             type=self.email_message.content_subtype,
             sender=sender,
             recipient=recipients,
@@ -127,11 +100,9 @@ class BaseEmailMessageHandler:
             subject=self.email_message.subject,
             newsletter=self.email_message.newsletter,
             status=status,
+            delivery_status=delivery_status,
             used_server=used_server
         )
-        if save:
-            email.save()
-        return email
 
 
 class DefaultEmailMessageHandler(BaseEmailMessageHandler):
@@ -158,70 +129,120 @@ class EmailMultiAlternativesHandler(BaseEmailMessageHandler):
 
 
 class DJNewsLetterEmailMessageHandler(BaseEmailMessageHandler):
+    SUPPRESSION_BOUNCED = 'bounced'
+    SUPPRESSION_UNSUBSCRIBED = 'unsubscribed'
+    SUPPRESSION_INTERVAL_SENDING = 'interval_sending'
+    # Порядок важен: адрес попадает только в первую подходящую группу
+    suppression_statuses = (
+        (SUPPRESSION_BOUNCED, DeliveryStatus.BOUNCED, 'There were problems with the recipient this letter previously'),
+        (SUPPRESSION_UNSUBSCRIBED, DeliveryStatus.UNSUBSCRIBED, 'Don\'t sent, because user is unsubscribe'),
+        (SUPPRESSION_INTERVAL_SENDING, DeliveryStatus.TOO_FREQUENT, 'Letters are sent too frequently'),
+    )
+
     def handle(self):
-        self.handle_bounced()
-        self.handle_unsubscribe()
-        self.handle_interval_sending()
+        self.handle_suppression()
         self.handle_email_server()
         return self.email_message
 
-    def handle_bounced(self):
-        if self.email_message.newsletter:
-            bounced_emails = Bounced.objects.filter(
-                email__in=self.email_message.to,
-                event__in=['bounce', 'dropped', 'spamreport'],
-            ).values_list('email', flat=True)
-            if bounced_emails.exists():
-                bounced_emails = list(bounced_emails)
-                self.email_message.to = list(
-                    filter(lambda email: email not in bounced_emails, self.email_message.to)
-                )
-                self.create_email(
-                    sender='did not send',
-                    recipients=bounced_emails,
-                    status='There were problems with the recipient this letter previously',
-                )
+    def get_suppression_querysets(self, recipients, possibly_suppressed=None):
+        """
+        :param recipients: пачка получателей
+        :param possibly_suppressed: получатели из пачки, которые могут быть в Bounced или Unsubscribers
+            (по данным индекса подавления); None - проверять всех
+        """
+        querysets = []
+        if possibly_suppressed is None:
+            possibly_suppressed = recipients
+
+        if possibly_suppressed:
+            querysets.append(
+                Bounced.objects.filter(
+                    email__in=possibly_suppressed,
+                    event__in=Bounced.SUPPRESSION_EVENTS,
+                ).annotate(
+                    suppression=Value(self.SUPPRESSION_BOUNCED, output_field=CharField()),
+                ).values_list('email', 'suppression')
+            )
 
-    def handle_unsubscribe(self):
-        if self.email_message.newsletter:
             if 'List-Unsubscribe' in self.email_message.extra_headers:
-                unsubscribers_emails = Unsubscribers.objects.filter(
-                    email__in=self.email_message.to,
-                    newsletter=self.email_message.newsletter,
-                ).values_list('email', flat=True)
-                if unsubscribers_emails.exists():
-                    unsubscribers_emails = list(unsubscribers_emails)
-                    self.email_message.to = list(
-                        filter(lambda email: email not in unsubscribers_emails, self.email_message.to)
-                    )
-                    self.create_email(
-                        sender='did not send',
-                        recipients=unsubscribers_emails,
-                        status='Don\'t sent, because user is unsubscribe',
-                    )
+                querysets.append(
+                    Unsubscribers.objects.filter(
+                        email__in=possibly_suppressed,
+                        newsletter=self.email_message.newsletter,
+                    ).annotate(
+                        suppression=Value(self.SUPPRESSION_UNSUBSCRIBED, output_field=CharField()),
+                    ).values_list('email', 'suppression')
+                )
 
-    def handle_interval_sending(self):
-        if self.email_message.newsletter:
-            interval_sending_to_recipient = settings.DJNEWSLETTER_INTERVAL_SENDING_TO_RECIPIENT
-            if interval_sending_to_recipient is not None:
-                already_sent_emails = Emails.objects.filter(
-                    recipient__in=self.email_message.to,
+        interval_sending_to_recipient = settings.DJNEWSLETTER_INTERVAL_SENDING_TO_RECIPIENT
+        if interval_sending_to_recipient is not None:
+            querysets.append(
+                EmailRecipients.objects.filter(
+                    recipient__in=recipients,
                     newsletter=self.email_message.newsletter,
-                    status_hash='3b0cea37664e25d1060e6306dcdcef51',  # 'sent to user' hash
-                    changeDateTime__gt=datetime.now() - timedelta(
+                    sentDateTime__gt=datetime.now() - timedelta(
                         hours=interval_sending_to_recipient,
-                    )
-                ).values_list('recipient', flat=True)
-                if already_sent_emails.exists():
-                    already_sent_emails = list(already_sent_emails)
-                    self.email_message.to = list(
-                        filter(lambda email: email not in already_sent_emails, self.email_message.to)
-                    )
-                    self.create_email(
-                        sender='did not send',
-                        recipients=already_sent_emails,
-                        status='Letters are sent too frequently',
-                    )
+                    ),
+                    email__delivery_status=DeliveryStatus.SENT,
+                    failed=False,
+                ).annotate(
+                    suppression=Value(self.SUPPRESSION_INTERVAL_SENDING, output_field=CharField()),
+                ).values_list('recipient', 'suppression')
+            )
+        return querysets
+
+    def get_suppressed_recipients(self):
+        """
+        Адреса, которым не нужно отправлять письмо, сгруппированные по причине.
+        Один запрос (UNION по Bounced, Unsubscribers и Emails) на каждую пачку получателей.
+        При включенном DJNEWSLETTER_SUPPRESSION_INDEX в Bounced и Unsubscribers проверяются только адреса,
+        которые есть в индексе подавления.
+        """
+        suppressed_recipients = collections.defaultdict(set)
+        chunk_size = settings.DJNEWSLETTER_SUPPRESSION_CHUNK_SIZE
+        recipients = self.email_message.to
+        for offset in range(0, len(recipients), chunk_size):
+            recipients_chunk = recipients[offset:offset + chunk_size]
+            possibly_suppressed = None
+            if settings.DJNEWSLETTER_SUPPRESSION_INDEX:
+                possibly_suppressed = suppression_index.filter_possibly_suppressed(recipients_chunk)
+
+            querysets = self.get_suppression_querysets(recipients_chunk, possibly_suppressed)
+            if not querysets:
+                continue
+            first_queryset, *other_querysets = querysets
+            if other_querysets:
+                first_queryset = first_queryset.union(*other_querysets)
+            for email, suppression in first_queryset:
+                suppressed_recipients[suppression].add(email)
+        return suppressed_recipients
+
+    def handle_suppression(self):
+        if not self.email_message.newsletter or not self.email_message.check_suppression:
+            return
+
+        suppressed_recipients = self.get_suppressed_recipients()
+        if not suppressed_recipients:
+            return
+
+        recipients = self.email_message.to
+        for suppression, delivery_status, status in self.suppression_statuses:
+            suppressed_emails = suppressed_recipients.get(suppression)
+            if not suppressed_emails:
+                continue
+            not_sent_emails = [email for email in recipients if email in suppressed_emails]
+            if not not_sent_emails:
+                continue
+            recipients = [email for email in recipients if email not in suppressed_emails]
+            self.not_sent_emails.append(
+                self.create_email(
+                    sender='did not send',
+                    recipients=not_sent_emails,
+                    status=status,
+                    delivery_status=delivery_status,
+                )
+            )
+        self.email_message.to = recipients
 
     def handle_email_server(self):
         if self.email_message.email_server:
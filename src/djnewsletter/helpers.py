@@ -1,6 +1,79 @@
+from itertools import islice
+
+from django.core.mail import get_connection
+from django.db.models.query import QuerySet
+
+from djnewsletter.backends import DJNewsletterBackend
+from djnewsletter.conf import settings
+from djnewsletter.handlers import DJNewsLetterEmailMessageHandler
 from djnewsletter.mail import DJNewsLetterEmailMessage
 
 
 def send_email(**kwargs):
     message = DJNewsLetterEmailMessage(**kwargs)
     message.send()
+
+
+def iterate_chunks(iterable, chunk_size):
+    if isinstance(iterable, QuerySet):
+        iterable = iterable.iterator(chunk_size=chunk_size)
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def suppress_recipients(recipients, **kwargs):
+    """
+    Подавление для всей пачки получателей одним проходом, до построения персональных писем.
+    :return: (получатели, которым нужно отправить письмо, записи 'did not send' для остальных)
+    """
+    handler = DJNewsLetterEmailMessageHandler(DJNewsLetterEmailMessage(to=recipients, **kwargs))
+    handler.handle_suppression()
+    return handler.email_message.to, handler.not_sent_emails
+
+
+def send_mass_email(recipients, get_recipient_context=None, chunk_size=None, fail_silently=False, **kwargs):
+    """
+    Отправка письма большому количеству получателей пачками, без построения полного списка в памяти.
+    Каждая пачка проходит через бэкенд (подавление, маршрутизация, постановка в очередь) в своей транзакции.
+    :param recipients: итерируемый объект с адресами, например QuerySet.values_list('email', flat=True)
+    :param get_recipient_context: функция email -> dict с персональным контекстом шаблона;
+        если задана, каждому получателю отправляется отдельное письмо. Подавление выполняется
+        один раз для пачки, письма строятся только для оставшихся получателей
+    :param chunk_size: размер пачки, по умолчанию DJNEWSLETTER_MASS_SENDING_CHUNK_SIZE
+    :param fail_silently:
+    :param kwargs: Значения для DJNewsLetterEmailMessage, кроме to
+    :return: количество обработанных получателей
+    """
+    if chunk_size is None:
+        chunk_size = settings.DJNEWSLETTER_MASS_SENDING_CHUNK_SIZE
+    base_context = kwargs.pop('context', None) or {}
+    connection = get_connection(fail_silently=fail_silently)
+
+    recipients_count = 0
+    for recipients_chunk in iterate_chunks(recipients, chunk_size):
+        send_options = {}
+        if get_recipient_context is None:
+            messages = [DJNewsLetterEmailMessage(to=recipients_chunk, context=base_context, **kwargs)]
+        else:
+            recipients_to_send = recipients_chunk
+            # Подавление пачки доступно, только если бэкенд принимает готовые записи 'did not send'
+            suppression_checked = isinstance(connection, DJNewsletterBackend)
+            if suppression_checked:
+                recipients_to_send, send_options['not_sent_emails'] = suppress_recipients(recipients_chunk, **kwargs)
+            messages = [
+                DJNewsLetterEmailMessage(
+                    to=[recipient],
+                    context=dict(base_context, **get_recipient_context(recipient)),
+                    check_suppression=not suppression_checked,
+                    **kwargs
+                ) for recipient in recipients_to_send
+            ]
+        for message in messages:
+            message.render_body()
+        connection.send_messages(messages, **send_options)
+        recipients_count += len(recipients_chunk)
+    return recipients_count
@@ -6,9 +6,10 @@ from email.mime.base import MIMEBase
 from django.conf import settings
 from django.core.mail import EmailMessage
 from django.core.mail.message import SafeMIMEText
-from django.template.loader import render_to_string
 from django.utils.encoding import smart_str
 
+from djnewsletter.rendering import render_template
+
 
 class DJNewsLetterEmailMessage(EmailMessage):
     content_subtype = 'html'
@@ -24,6 +25,7 @@ class DJNewsLetterEmailMessage(EmailMessage):
             inline_attachments=None,
             countdown=None,
             eta=None,
+            check_suppression=True,
             **kwargs,
     ):
         """
@@ -38,6 +40,7 @@ class DJNewsLetterEmailMessage(EmailMessage):
         @param api_key:
         @param countdown:
         @param eta:
+        @param check_suppression: False, если получатели уже проверены (подавление пачки в send_mass_email)
         @param kwargs: Значения для EmailMessage
         """
         self.email_server = email_server
@@ -50,6 +53,7 @@ class DJNewsLetterEmailMessage(EmailMessage):
         self.inline_attachments = inline_attachments
         self.countdown = countdown
         self.eta = eta
+        self.check_suppression = check_suppression
         self.recipients_email_server_route = {}
         self.email_instance = None
         super().__init__(**kwargs)
@@ -57,15 +61,12 @@ class DJNewsLetterEmailMessage(EmailMessage):
     def copy_attributes_from_child_instance(self, child_instance):
         self.__dict__.update(child_instance.__dict__)
 
-    def get_context(self):
-        context = settings.DJNEWSLETTER_LETTER_CONTEXT
-        context.update(self.context)
-        return context
-
-    def send(self, fail_silently=False):
+    def render_body(self):
         if self.template:
-            self.body = render_to_string(self.template, self.get_context())
+            self.body = render_template(self.template, settings.DJNEWSLETTER_LETTER_CONTEXT, self.context)
 
+    def send(self, fail_silently=False):
+        self.render_body()
         return super().send(fail_silently)
 
     def create_mime_attachment(self, filename, content, mimetype=None, encoding=None):
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from djnewsletter.archive import archive_expired_emails
+
+
+class Command(BaseCommand):
+    help = (
+        'Переносит в EmailsArchive письма старше срока хранения '
+        '(DJNEWSLETTER_EMAILS_RETENTION, DJNEWSLETTER_EMAILS_RETENTION_BY_NEWSLETTER). '
+        'Каждая пачка писем обрабатывается в отдельной транзакции.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--purge', action='store_true',
+            help='Удалять письма без переноса в архив. Удалённые письма не учитываются rebuild_daily_statistics',
+        )
+        parser.add_argument('--chunk-size', type=int, default=None, help='Количество писем в одной пачке')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        if chunk_size is not None and chunk_size < 1:
+            raise CommandError('--chunk-size должен быть больше 0')
+
+        total = 0
+        for rows_count in archive_expired_emails(chunk_size=chunk_size, purge=options['purge']):
+            total += rows_count
+            self.stdout.write('{}: {} писем'.format('Удалено' if options['purge'] else 'Перенесено', rows_count))
+        self.stdout.write('Всего: {} писем'.format(total))
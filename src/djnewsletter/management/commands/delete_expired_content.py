@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from djnewsletter.archive import get_content_cutoff
+from djnewsletter.storage import delete_expired_content
+
+
+class Command(BaseCommand):
+    help = (
+        'Удаляет из DJNEWSLETTER_CONTENT_STORAGE вложения писем, сохранённые раньше '
+        'DJNEWSLETTER_CONTENT_RETENTION дней назад. Содержимое писем, которые ещё в очереди, не удаляется.'
+    )
+
+    def handle(self, *args, **options):
+        cutoff = get_content_cutoff()
+        total = 0
+        for day_directory in delete_expired_content(before=cutoff):
+            total += 1
+            self.stdout.write('Удалено: {}'.format(day_directory))
+        self.stdout.write('Всего: {} дней до {}'.format(total, cutoff.isoformat()))
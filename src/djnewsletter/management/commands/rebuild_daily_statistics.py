@@ -0,0 +1,38 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from djnewsletter.rollup import rebuild_daily_statistics
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError('Дата должна быть в формате ГГГГ-ММ-ДД: {}'.format(value))
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересчитывает DailyStatistics по Emails и EmailsArchive за период. '
+        'Каждая пачка дней пересчитывается в отдельной транзакции.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('date_from', type=parse_date, help='Первый день периода, ГГГГ-ММ-ДД')
+        parser.add_argument('date_to', type=parse_date, help='Последний день периода, ГГГГ-ММ-ДД')
+        parser.add_argument('--batch-days', type=int, default=1, help='Количество дней в одной пачке')
+
+    def handle(self, *args, **options):
+        date_from, date_to, batch_days = options['date_from'], options['date_to'], options['batch_days']
+        if date_from > date_to:
+            raise CommandError('Начало периода позже его окончания')
+        if batch_days < 1:
+            raise CommandError('--batch-days должен быть больше 0')
+
+        batch_from = date_from
+        while batch_from <= date_to:
+            batch_to = min(batch_from + timedelta(days=batch_days - 1), date_to)
+            rows_count = rebuild_daily_statistics(batch_from, batch_to)
+            self.stdout.write('{} - {}: {} строк'.format(batch_from, batch_to, rows_count))
+            batch_from = batch_to + timedelta(days=1)
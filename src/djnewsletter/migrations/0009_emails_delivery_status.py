@@ -0,0 +1,80 @@
+# Generated by Django 2.2.14 on 2026-10-17 13:08
+
+from django.db import migrations, models, transaction
+from django.db.models import Max
+
+BATCH_SIZE = 10000
+
+# Значения DeliveryStatus на момент миграции
+QUEUED = 1
+SENT = 2
+FAILED = 3
+BOUNCED = 4
+UNSUBSCRIBED = 5
+TOO_FREQUENT = 6
+
+STATUSES = {
+    'sent to queue': QUEUED,
+    'sent to user': SENT,
+    'There were problems with the recipient this letter previously': BOUNCED,
+    'Don\'t sent, because user is unsubscribe': UNSUBSCRIBED,
+    'Letters are sent too frequently': TOO_FREQUENT,
+}
+
+
+def backfill_delivery_status(apps, schema_editor):
+    """
+    Заполняет delivery_status по тексту status диапазонами id по BATCH_SIZE записей,
+    каждый диапазон в отдельной транзакции, чтобы не держать блокировки на всю таблицу.
+    Ответ UniSender со 'status': 'success' считается отправкой, остальные тексты - ошибками.
+    """
+    Emails = apps.get_model('djnewsletter', 'Emails')
+    max_id = Emails.objects.aggregate(max_id=Max('id'))['max_id']
+    if max_id is None:
+        return
+
+    for start_id in range(0, max_id + 1, BATCH_SIZE):
+        with transaction.atomic():
+            batch = Emails.objects.filter(
+                id__gte=start_id,
+                id__lt=start_id + BATCH_SIZE,
+                delivery_status__isnull=True,
+            )
+            for status, delivery_status in STATUSES.items():
+                batch.filter(status=status).update(delivery_status=delivery_status)
+            batch.filter(status__contains='\'status\': \'success\'').update(delivery_status=SENT)
+            batch.update(delivery_status=FAILED)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('djnewsletter', '0008_emailservers_sites'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emails',
+            name='delivery_status',
+            field=models.PositiveSmallIntegerField(
+                blank=True,
+                choices=[
+                    (1, 'В очереди'),
+                    (2, 'Отправлено'),
+                    (3, 'Ошибка отправки'),
+                    (4, 'Не отправлено: проблемы с получателем'),
+                    (5, 'Не отправлено: получатель отписался'),
+                    (6, 'Не отправлено: слишком частая отправка'),
+                ],
+                db_index=True,
+                null=True,
+                verbose_name='Статус доставки',
+            ),
+        ),
+        migrations.RunPython(backfill_delivery_status, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='emails',
+            name='status_hash',
+        ),
+    ]
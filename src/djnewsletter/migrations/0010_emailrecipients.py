@@ -0,0 +1,78 @@
+# Generated by Django 2.2.14 on 2026-10-17 13:10
+
+import re
+
+import django.db.models.deletion
+from django.db import migrations, models, transaction
+from django.db.models import Max
+
+BATCH_SIZE = 10000
+
+
+def parse_recipients(recipients):
+    return re.findall(r'[^\s\'",\[\]]+', recipients)
+
+
+def backfill_email_recipients(apps, schema_editor):
+    """
+    Заполняет EmailRecipients по Emails.recipient диапазонами id по BATCH_SIZE писем,
+    каждый диапазон в отдельной транзакции. Индекс создаётся после заполнения.
+    """
+    Emails = apps.get_model('djnewsletter', 'Emails')
+    EmailRecipients = apps.get_model('djnewsletter', 'EmailRecipients')
+    max_id = Emails.objects.aggregate(max_id=Max('id'))['max_id']
+    if max_id is None:
+        return
+
+    for start_id in range(0, max_id + 1, BATCH_SIZE):
+        emails = Emails.objects.filter(
+            id__gte=start_id,
+            id__lt=start_id + BATCH_SIZE,
+        ).values_list('id', 'recipient', 'newsletter', 'createDateTime')
+        with transaction.atomic():
+            EmailRecipients.objects.bulk_create([
+                EmailRecipients(
+                    email_id=email_id,
+                    recipient=recipient,
+                    newsletter=newsletter,
+                    sentDateTime=create_datetime,
+                )
+                for email_id, recipients, newsletter, create_datetime in emails
+                for recipient in parse_recipients(recipients)
+            ], batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('djnewsletter', '0009_emails_delivery_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailRecipients',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipient', models.EmailField(max_length=255)),
+                ('newsletter', models.CharField(blank=True, max_length=20, null=True)),
+                ('sentDateTime', models.DateTimeField()),
+                ('email', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    related_name='recipients',
+                    to='djnewsletter.Emails',
+                )),
+            ],
+            options={
+                'verbose_name_plural': 'EmailRecipients',
+            },
+        ),
+        migrations.RunPython(backfill_email_recipients, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='emailrecipients',
+            index=models.Index(
+                fields=['recipient', 'newsletter', 'sentDateTime'],
+                name='djnewslette_recipie_366088_idx',
+            ),
+        ),
+    ]
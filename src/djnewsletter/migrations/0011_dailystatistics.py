@@ -0,0 +1,45 @@
+# Generated by Django 2.2.14 on 2026-10-17 13:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djnewsletter', '0010_emailrecipients'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='День')),
+                ('newsletter', models.CharField(blank=True, default='', max_length=20, verbose_name='Рассылка')),
+                ('delivery_status', models.PositiveSmallIntegerField(
+                    choices=[
+                        (1, 'В очереди'),
+                        (2, 'Отправлено'),
+                        (3, 'Ошибка отправки'),
+                        (4, 'Не отправлено: проблемы с получателем'),
+                        (5, 'Не отправлено: получатель отписался'),
+                        (6, 'Не отправлено: слишком частая отправка'),
+                    ],
+                    verbose_name='Статус доставки',
+                )),
+                ('count', models.IntegerField(default=0, verbose_name='Количество писем')),
+                ('used_server', models.ForeignKey(
+                    blank=True,
+                    null=True,
+                    on_delete=django.db.models.deletion.CASCADE,
+                    to='djnewsletter.EmailServers',
+                    verbose_name='Сервер',
+                )),
+            ],
+            options={
+                'verbose_name_plural': 'DailyStatistics',
+                'unique_together': {('day', 'used_server', 'newsletter', 'delivery_status')},
+            },
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 2.2.14 on 2026-10-17 13:18
+
+from django.db import migrations, models, transaction
+from django.db.models import Count, Min
+
+BATCH_SIZE = 1000
+
+
+def delete_duplicates(model, fields):
+    """
+    Оставляет по одной (первой) записи на каждое сочетание fields,
+    удаляет дубликаты по BATCH_SIZE групп в отдельной транзакции.
+    """
+    duplicates = model.objects.values(*fields).annotate(
+        min_id=Min('id'),
+        count=Count('id'),
+    ).filter(count__gt=1).values_list('min_id', *fields)
+
+    while True:
+        batch = list(duplicates[:BATCH_SIZE])
+        if not batch:
+            return
+        with transaction.atomic():
+            for min_id, *values in batch:
+                model.objects.filter(**dict(zip(fields, values))).exclude(id=min_id).delete()
+
+
+def delete_suppression_duplicates(apps, schema_editor):
+    delete_duplicates(apps.get_model('djnewsletter', 'Bounced'), ('email', 'event'))
+    delete_duplicates(apps.get_model('djnewsletter', 'Unsubscribers'), ('email', 'newsletter'))
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('djnewsletter', '0011_dailystatistics'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_suppression_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='bounced',
+            unique_together={('email', 'event')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='unsubscribers',
+            unique_together={('email', 'newsletter')},
+        ),
+        # Индекс по email заменён индексом уникальности (email, event)
+        migrations.AlterField(
+            model_name='bounced',
+            name='email',
+            field=models.CharField(max_length=100),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 2.2.14 on 2026-10-17 13:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djnewsletter', '0012_suppression_unique_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailsArchive',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('month', models.DateField(db_index=True, verbose_name='Месяц')),
+                ('type', models.CharField(max_length=5)),
+                ('sender', models.EmailField(max_length=255)),
+                ('recipient', models.EmailField(max_length=255)),
+                ('body', models.TextField()),
+                ('subject', models.CharField(max_length=256)),
+                ('newsletter', models.CharField(blank=True, max_length=20, null=True)),
+                ('status', models.TextField()),
+                ('delivery_status', models.PositiveSmallIntegerField(
+                    blank=True,
+                    choices=[
+                        (1, 'В очереди'),
+                        (2, 'Отправлено'),
+                        (3, 'Ошибка отправки'),
+                        (4, 'Не отправлено: проблемы с получателем'),
+                        (5, 'Не отправлено: получатель отписался'),
+                        (6, 'Не отправлено: слишком частая отправка'),
+                    ],
+                    null=True,
+                    verbose_name='Статус доставки',
+                )),
+                ('createDateTime', models.DateTimeField()),
+                ('changeDateTime', models.DateTimeField()),
+                ('email_remote_id', models.CharField(blank=True, max_length=128, null=True)),
+                ('used_server', models.ForeignKey(
+                    blank=True,
+                    null=True,
+                    on_delete=django.db.models.deletion.SET_NULL,
+                    related_name='+',
+                    to='djnewsletter.EmailServers',
+                )),
+            ],
+            options={
+                'verbose_name_plural': 'EmailsArchive',
+            },
+        ),
+    ]
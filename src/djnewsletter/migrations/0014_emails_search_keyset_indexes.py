@@ -0,0 +1,107 @@
+# Generated by Django 2.2.14 on 2026-10-17 13:23
+
+from django.db import migrations, models
+from django.db.models import Max
+
+BATCH_SIZE = 10000
+
+# Вектор строится по теме, адресам и тексту письма без HTML тегов; длина текста ограничена,
+# так как tsvector не может быть больше 1 МБ
+CREATE_SEARCH_VECTOR_SQL = [
+    'ALTER TABLE djnewsletter_emails ADD COLUMN IF NOT EXISTS search_vector tsvector',
+    """
+    CREATE OR REPLACE FUNCTION djnewsletter_emails_search_vector(subject text, sender text, recipient text, body text)
+    RETURNS tsvector AS $$
+        SELECT
+            setweight(to_tsvector('simple', coalesce(subject, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(sender, '') || ' ' || coalesce(recipient, '')), 'B') ||
+            setweight(to_tsvector('simple', left(regexp_replace(coalesce(body, ''), '<[^>]*>', ' ', 'g'), 100000)), 'C')
+    $$ LANGUAGE sql IMMUTABLE
+    """,
+    """
+    CREATE OR REPLACE FUNCTION djnewsletter_emails_search_vector_trigger() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := djnewsletter_emails_search_vector(NEW.subject, NEW.sender, NEW.recipient, NEW.body);
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    'DROP TRIGGER IF EXISTS djnewsletter_emails_search_vector_update ON djnewsletter_emails',
+    """
+    CREATE TRIGGER djnewsletter_emails_search_vector_update
+    BEFORE INSERT OR UPDATE OF subject, sender, recipient, body ON djnewsletter_emails
+    FOR EACH ROW EXECUTE PROCEDURE djnewsletter_emails_search_vector_trigger()
+    """,
+]
+
+BACKFILL_SEARCH_VECTOR_SQL = """
+    UPDATE djnewsletter_emails
+    SET search_vector = djnewsletter_emails_search_vector(subject, sender, recipient, body)
+    WHERE id >= %s AND id < %s AND search_vector IS NULL
+"""
+
+CREATE_SEARCH_INDEX_SQL = (
+    'CREATE INDEX CONCURRENTLY IF NOT EXISTS djnewsletter_emails_search_vector_idx '
+    'ON djnewsletter_emails USING GIN (search_vector)'
+)
+
+DROP_SEARCH_VECTOR_SQL = [
+    'DROP INDEX IF EXISTS djnewsletter_emails_search_vector_idx',
+    'DROP TRIGGER IF EXISTS djnewsletter_emails_search_vector_update ON djnewsletter_emails',
+    'DROP FUNCTION IF EXISTS djnewsletter_emails_search_vector_trigger()',
+    'DROP FUNCTION IF EXISTS djnewsletter_emails_search_vector(text, text, text, text)',
+    'ALTER TABLE djnewsletter_emails DROP COLUMN IF EXISTS search_vector',
+]
+
+
+def create_search_vector(apps, schema_editor):
+    """
+    Полнотекстовый поиск по Emails только на PostgreSQL: колонка search_vector поддерживается триггером,
+    существующие письма заполняются диапазонами id по BATCH_SIZE, GIN индекс создаётся без блокировки записи.
+    Колонки нет в модели, её использует только FullTextSearchMixin в админке.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    for sql in CREATE_SEARCH_VECTOR_SQL:
+        schema_editor.execute(sql)
+
+    Emails = apps.get_model('djnewsletter', 'Emails')
+    max_id = Emails.objects.aggregate(max_id=Max('id'))['max_id']
+    if max_id is not None:
+        for start_id in range(0, max_id + 1, BATCH_SIZE):
+            schema_editor.execute(BACKFILL_SEARCH_VECTOR_SQL, (start_id, start_id + BATCH_SIZE))
+
+    schema_editor.execute(CREATE_SEARCH_INDEX_SQL)
+
+
+def drop_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    for sql in DROP_SEARCH_VECTOR_SQL:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('djnewsletter', '0013_emailsarchive'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='emails',
+            index=models.Index(fields=['-createDateTime', '-id'], name='djnewslette_createD_37a633_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='emails',
+            name='djnewslette_createD_b40d62_idx',
+        ),
+        migrations.AddIndex(
+            model_name='bounced',
+            index=models.Index(fields=['-createDateTime', '-id'], name='djnewslette_createD_21ba6e_idx'),
+        ),
+        migrations.RunPython(create_search_vector, drop_search_vector),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.14 on 2026-10-17 13:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djnewsletter', '0014_emails_search_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailservers',
+            name='send_burst',
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text='Пусто - одно письмо',
+                null=True,
+                verbose_name='Писем подряд без ограничения скорости',
+            ),
+        ),
+        migrations.AddField(
+            model_name='emailservers',
+            name='send_rate',
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text='Пусто - без ограничения',
+                null=True,
+                verbose_name='Ограничение скорости отправки (писем в минуту)',
+            ),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.2.14 on 2026-10-17 13:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djnewsletter', '0015_emailservers_send_rate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailservers',
+            name='weight',
+            field=models.PositiveIntegerField(
+                default=1,
+                help_text='Доля писем сервера среди подходящих серверов пропорциональна весу; 0 - сервер не выбирается',
+                verbose_name='Вес',
+            ),
+        ),
+    ]
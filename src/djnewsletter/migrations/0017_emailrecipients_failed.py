@@ -0,0 +1,138 @@
+# Generated by Django 2.2.14 on 2026-10-17 14:02
+
+import ast
+import collections
+
+from django.db import migrations, models, transaction
+from django.db.models import F, Max
+from django.utils import timezone
+
+BATCH_SIZE = 10000
+# Ограничение SQLite на количество параметров запроса
+UPDATE_BATCH_SIZE = 900
+
+# Значения DeliveryStatus на момент миграции
+SENT = 2
+FAILED = 3
+
+
+def parse_unisender_status(status):
+    """
+    Emails.status писем UniSender - str() словаря ответа API.
+    :return: словарь ответа или None, если status не ответ UniSender
+    """
+    try:
+        response_json = ast.literal_eval(status)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+    return response_json if isinstance(response_json, dict) else None
+
+
+def get_failed_recipients(response_json, recipients):
+    failed_emails = response_json.get('failed_emails') or {}
+    emails = response_json.get('emails')
+    return [
+        recipient for recipient in recipients
+        if recipient in failed_emails or (emails is not None and recipient not in emails)
+    ]
+
+
+def get_day(value):
+    if timezone.is_aware(value):
+        return timezone.localdate(value)
+    return value.date()
+
+
+def increment_daily_statistics(DailyStatistics, changes):
+    for (day, used_server_id, newsletter, delivery_status), delta in sorted(changes.items(), key=str):
+        filters = {
+            'day': day,
+            'used_server_id': used_server_id,
+            'newsletter': newsletter,
+            'delivery_status': delivery_status,
+        }
+        if delta and not DailyStatistics.objects.filter(**filters).update(count=F('count') + delta):
+            DailyStatistics.objects.create(count=delta, **filters)
+
+
+def mark_unisender_failed_recipients(apps, schema_editor):
+    """
+    Успешные ответы UniSender с failed_emails записывались как FAILED для всего письма.
+    Такие письма получают статус SENT, а недоставленные адреса отмечаются в EmailRecipients.failed.
+    Письма обрабатываются диапазонами id по BATCH_SIZE, каждый диапазон в отдельной транзакции:
+    получатели диапазона выбираются одним запросом, изменения статусов переносятся в DailyStatistics.
+    """
+    Emails = apps.get_model('djnewsletter', 'Emails')
+    EmailRecipients = apps.get_model('djnewsletter', 'EmailRecipients')
+    DailyStatistics = apps.get_model('djnewsletter', 'DailyStatistics')
+    max_id = Emails.objects.aggregate(max_id=Max('id'))['max_id']
+    if max_id is None:
+        return
+
+    for start_id in range(0, max_id + 1, BATCH_SIZE):
+        emails = Emails.objects.filter(
+            id__gte=start_id,
+            id__lt=start_id + BATCH_SIZE,
+            used_server__sending_method='unisender_api',
+            delivery_status__in=(SENT, FAILED),
+            status__startswith='{',
+        ).only('id', 'status', 'delivery_status', 'createDateTime', 'used_server_id', 'newsletter')
+        with transaction.atomic():
+            sent_ids = []
+            changes = collections.Counter()
+            responses = {}
+            for email in emails:
+                response_json = parse_unisender_status(email.status)
+                if response_json is None or response_json.get('status') != 'success':
+                    continue
+                if email.delivery_status == FAILED:
+                    sent_ids.append(email.pk)
+                    key = (get_day(email.createDateTime), email.used_server_id, email.newsletter or '')
+                    changes[key + (FAILED,)] -= 1
+                    changes[key + (SENT,)] += 1
+                # Без failed_emails и emails все получатели считаются доставленными
+                if response_json.get('failed_emails') or response_json.get('emails') is not None:
+                    responses[email.pk] = response_json
+
+            # Получатели всего диапазона одним запросом
+            recipients = collections.defaultdict(list)
+            if responses:
+                for recipient_id, email_id, recipient in EmailRecipients.objects.filter(
+                    email_id__gte=start_id,
+                    email_id__lt=start_id + BATCH_SIZE,
+                ).values_list('id', 'email_id', 'recipient'):
+                    if email_id in responses:
+                        recipients[email_id].append((recipient_id, recipient))
+
+            failed_ids = []
+            for email_id, response_json in responses.items():
+                email_recipients = {recipient: recipient_id for recipient_id, recipient in recipients[email_id]}
+                failed_ids.extend(
+                    email_recipients[recipient]
+                    for recipient in get_failed_recipients(response_json, email_recipients)
+                )
+
+            for offset in range(0, len(failed_ids), UPDATE_BATCH_SIZE):
+                EmailRecipients.objects.filter(
+                    id__in=failed_ids[offset:offset + UPDATE_BATCH_SIZE],
+                ).update(failed=True)
+            for offset in range(0, len(sent_ids), UPDATE_BATCH_SIZE):
+                Emails.objects.filter(id__in=sent_ids[offset:offset + UPDATE_BATCH_SIZE]).update(delivery_status=SENT)
+            increment_daily_statistics(DailyStatistics, changes)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('djnewsletter', '0016_emailservers_weight'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailrecipients',
+            name='failed',
+            field=models.BooleanField(default=False, verbose_name='Не доставлено получателю'),
+        ),
+        migrations.RunPython(mark_unisender_failed_recipients, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.14 on 2026-10-17 13:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djnewsletter', '0017_emailrecipients_failed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateLimitBuckets',
+            fields=[
+                ('key', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('tokens', models.FloatField()),
+                ('updated', models.FloatField()),
+            ],
+            options={
+                'verbose_name_plural': 'RateLimitBuckets',
+            },
+        ),
+    ]
@@ -1,49 +1,147 @@
-from django.conf import settings
+import collections
+import json
+import threading
+import time
+
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
 from django.core.paginator import Paginator
-from django.db import connection
+from django.db import connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
 from django.utils.functional import cached_property
 
-__all__ = ['ApproxCountPaginatorMixin']
+from djnewsletter.conf import settings
+
+__all__ = ['ApproxCountPaginatorMixin', 'KeysetPaginationMixin', 'FullTextSearchMixin']
+
+CURSOR_VAR = 'cursor'
+
+
+class ApproxCountCache:
+    def __init__(self):
+        """
+        Оценки количества строк по (таблица, SQL запрос), хранятся в памяти процесса
+        DJNEWSLETTER_APPROX_COUNT_TIMEOUT секунд. Количество записей ограничено
+        DJNEWSLETTER_APPROX_COUNT_CACHE_SIZE, при превышении вытесняются самые старые.
+        """
+        self._lock = threading.Lock()
+        self._items = collections.OrderedDict()
+
+    def get(self, cache_key, estimate):
+        """
+        :param estimate: функция, возвращающая оценку; вызывается при промахе или устаревшей записи
+        """
+        with self._lock:
+            item = self._items.get(cache_key)
+            if item is not None and time.monotonic() - item[1] < settings.DJNEWSLETTER_APPROX_COUNT_TIMEOUT:
+                return item[0]
+
+        approx_count = estimate()
+        with self._lock:
+            self._items.pop(cache_key, None)
+            self._items[cache_key] = (approx_count, time.monotonic())
+            while len(self._items) > settings.DJNEWSLETTER_APPROX_COUNT_CACHE_SIZE:
+                self._items.popitem(last=False)
+        return approx_count
+
+    def clear(self):
+        with self._lock:
+            self._items = collections.OrderedDict()
+
+
+approx_count_cache = ApproxCountCache()
 
 
 class ApproxCountPaginator(Paginator):
+    """
+    Для больших таблиц вместо COUNT(*) использует оценку СУБД: статистику таблицы для запросов без условий
+    и оценку планировщика (EXPLAIN) для отфильтрованных. Если оценка не больше DJNEWSLETTER_MIN_APPROX_COUNT,
+    количество считается точно.
+    """
+
     def get_approx_count(self):
-        approx_count = None
+        query = getattr(self.object_list, 'query', None)
+        if query is None:
+            return None
 
-        get_approx_count_method = getattr(self, 'get_approx_count_{connection_vendor}'.format(
+        connection = connections[self.object_list.db]
+        is_filtered = bool(query.where) or query.distinct or query.combinator is not None or bool(query.group_by)
+        get_approx_count_method = getattr(self, 'get_{filtered}approx_count_{connection_vendor}'.format(
+            filtered='filtered_' if is_filtered else '',
             connection_vendor=connection.vendor,
         ), None)
-        if get_approx_count_method is not None:
-            approx_count = get_approx_count_method()
+        if get_approx_count_method is None:
+            return None
 
+        sql, params = self.get_sql(connection)
+        approx_count = approx_count_cache.get(
+            (connection.alias, query.model._meta.db_table, sql, tuple(map(str, params))),
+            lambda: get_approx_count_method(connection, sql, params),
+        )
         if approx_count is not None and approx_count > settings.DJNEWSLETTER_MIN_APPROX_COUNT:
             return approx_count
         return None
 
-    def get_approx_count_mysql(self):
+    def get_sql(self, connection):
+        # Сортировка не влияет на количество строк
+        queryset = self.object_list.order_by()
+        return queryset.query.get_compiler(connection=connection).as_sql()
+
+    def get_approx_count_mysql(self, connection, sql, params):
         # For MySQL
         # http://stackoverflow.com/a/10446271/366908
-        cursor = connection.cursor()
-        cursor.execute('SHOW TABLE STATUS LIKE %s', (self.object_list.query.model._meta.db_table,))
-        approx_count = cursor.fetchall()[0][4]
-        return approx_count
+        with connection.cursor() as cursor:
+            cursor.execute('SHOW TABLE STATUS LIKE %s', (self.object_list.query.model._meta.db_table,))
+            return cursor.fetchall()[0][4]
 
-    def get_approx_count_postgresql(self):
+    def get_filtered_approx_count_mysql(self, connection, sql, params):
+        # Оценка первой таблицы плана: rows - просмотренные строки, filtered - процент прошедших условие
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN ' + sql, params)
+            columns = [column[0].lower() for column in cursor.description]
+            row = dict(zip(columns, cursor.fetchall()[0]))
+        if row.get('rows') is None:
+            return None
+        return int(row['rows'] * float(row.get('filtered') or 100) / 100)
+
+    def get_approx_count_postgresql(self, connection, sql, params):
         # For Postgres
         # http://stackoverflow.com/a/23118765/366908
         parts = [
             p.strip('"') for p in self.object_list.query.model._meta.db_table.split('.')
         ]
-        cursor = connection.cursor()
-        if len(parts) == 1:
-            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', parts)
-        else:
-            cursor.execute(
-                'SELECT reltuples::bigint FROM pg_class c JOIN pg_namespace n ON (c.relnamespace = n.oid) '
-                'WHERE n.nspname = %s AND c.relname = %s', parts
-            )
-        approx_count = cursor.fetchall()[0][0]
-        return approx_count
+        with connection.cursor() as cursor:
+            if len(parts) == 1:
+                cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', parts)
+            else:
+                cursor.execute(
+                    'SELECT reltuples::bigint FROM pg_class c JOIN pg_namespace n ON (c.relnamespace = n.oid) '
+                    'WHERE n.nspname = %s AND c.relname = %s', parts
+                )
+            return cursor.fetchall()[0][0]
+
+    def get_filtered_approx_count_postgresql(self, connection, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchall()[0][0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def get_approx_count_sqlite(self, connection, sql, params):
+        # Количество строк из статистики ANALYZE, без неё - наибольший rowid (поиск по индексу первичного ключа).
+        # После удалений rowid завышает количество, поэтому sqlite_stat1 предпочтительнее
+        db_table = self.object_list.query.model._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchall():
+                cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s', (db_table,))
+                row = cursor.fetchone()
+                if row is not None:
+                    return int(row[0].split()[0])
+            cursor.execute('SELECT MAX(_ROWID_) FROM {}'.format(connection.ops.quote_name(db_table)))
+            return cursor.fetchall()[0][0]
 
     @cached_property
     def count(self):
@@ -55,3 +153,121 @@ class ApproxCountPaginator(Paginator):
 
 class ApproxCountPaginatorMixin:
     paginator = ApproxCountPaginator
+    # Иначе при фильтрации ChangeList считает все строки таблицы через COUNT(*) мимо оценки
+    show_full_result_count = False
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Список объектов в админке с постраничным выводом по курсору: следующая страница выбирается
+    условием (keyset_field, pk) < (значения последней строки) по индексу, без OFFSET.
+    Используется при сортировке по умолчанию (-keyset_field, -pk); при другой сортировке
+    или выводе всех объектов - обычный постраничный вывод.
+    """
+
+    def get_queryset(self, request):
+        # Курсор не условие фильтрации, и ссылки фильтров должны вести на первую страницу
+        self.cursor = self.params.pop(CURSOR_VAR, None)
+        return super().get_queryset(request)
+
+    @cached_property
+    def is_keyset_pagination(self):
+        return ORDER_VAR not in self.params and not self.show_all
+
+    def parse_cursor(self):
+        value, _, pk = self.cursor.rpartition('_')
+        try:
+            return parse_datetime(value) or None, int(pk)
+        except ValueError:
+            return None, None
+
+    @staticmethod
+    def format_cursor(value, pk):
+        return '{}_{}'.format(value.isoformat(), pk)
+
+    def get_keyset_queryset(self):
+        queryset = self.queryset
+        if not self.cursor:
+            return queryset
+
+        value, pk = self.parse_cursor()
+        if value is None:
+            raise IncorrectLookupParameters
+        field = self.model_admin.keyset_field
+        # Первое условие позволяет СУБД ограничить просмотр индекса диапазоном
+        return queryset.filter(
+            Q(**{'{}__lte'.format(field): value}),
+            Q(**{'{}__lt'.format(field): value}) | Q(**{field: value, 'pk__lt': pk}),
+        )
+
+    def get_results(self, request):
+        if not self.is_keyset_pagination:
+            self.cursor = None
+            self.next_cursor = None
+            return super().get_results(request)
+
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        queryset = self.get_keyset_queryset()
+        # Ключ последней строки страницы и признак следующей страницы одним запросом
+        last_rows = list(
+            queryset.values_list(self.model_admin.keyset_field, 'pk')[self.list_per_page - 1:self.list_per_page + 1]
+        )
+        self.next_cursor = self.format_cursor(*last_rows[0]) if len(last_rows) > 1 else None
+
+        self.result_count = paginator.count
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = queryset[:self.list_per_page]
+        self.can_show_all = False
+        self.multi_page = bool(self.cursor or self.next_cursor)
+        self.paginator = paginator
+
+    @property
+    def first_page_url(self):
+        return self.get_query_string()
+
+    @property
+    def next_page_url(self):
+        if self.next_cursor is None:
+            return None
+        return self.get_query_string({CURSOR_VAR: self.next_cursor})
+
+
+class KeysetPaginationMixin:
+    """
+    Постраничный вывод по курсору (keyset_field, pk) для больших таблиц,
+    нужен индекс по (-keyset_field, -pk).
+    """
+    keyset_field = 'createDateTime'
+    change_list_template = 'admin/djnewsletter/keyset_change_list.html'
+    show_full_result_count = False
+
+    def get_ordering(self, request):
+        return ['-{}'.format(self.keyset_field), '-pk']
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+
+class FullTextSearchMixin:
+    """
+    Поиск в админке по полю tsvector с GIN индексом на PostgreSQL.
+    На остальных СУБД - обычный поиск по search_fields.
+    """
+    search_vector_column = 'search_vector'
+    search_config = 'simple'
+
+    def is_full_text_search_available(self, queryset):
+        return connections[queryset.db].vendor == 'postgresql'
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term or not self.is_full_text_search_available(queryset):
+            return super().get_search_results(request, queryset, search_term)
+
+        connection = connections[queryset.db]
+        where = '{}.{} @@ plainto_tsquery(%s, %s)'.format(
+            connection.ops.quote_name(queryset.model._meta.db_table),
+            connection.ops.quote_name(self.search_vector_column),
+        )
+        return queryset.extra(where=[where], params=[self.search_config, search_term]), False
@@ -1,10 +1,25 @@
-from hashlib import md5
+import re
+import uuid
 
 from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import F, Q
+from django.utils import timezone
 
 from djnewsletter.options import DJNewsLetterSendingMethodOptions
+from djnewsletter.statuses import DeliveryStatus
+
+
+class UnsubscribersManager(models.Manager):
+    def unsubscribe(self, emails, newsletter):
+        """
+        Отписывает адреса от рассылки одним bulk_create, уже отписанные адреса пропускаются.
+        """
+        return self.bulk_create(
+            [Unsubscribers(email=email, newsletter=newsletter) for email in emails],
+            ignore_conflicts=True,
+        )
 
 
 class Unsubscribers(models.Model):
@@ -12,8 +27,41 @@ class Unsubscribers(models.Model):
     newsletter = models.CharField(max_length=20)
     unsubscribeDatetime = models.DateTimeField(auto_now_add=True)
 
+    objects = UnsubscribersManager()
+
     class Meta:
         verbose_name_plural = 'Unsubscribers'
+        # Индекс уникальности покрывает проверку отписки (email IN ... AND newsletter = ...)
+        unique_together = ('email', 'newsletter')
+
+
+class EmailsManager(models.Manager):
+    def bulk_create_with_ids(self, emails):
+        """
+        bulk_create, после которого у писем есть id, в том числе на БД, которые не возвращают id
+        из bulk_create (всё, кроме PostgreSQL). Письма пачки вставляются с уникальной меткой
+        в email_remote_id, id выбираются одним запросом по метке в порядке вставки, затем метка снимается.
+        """
+        if not emails or connections[self.db].features.can_return_ids_from_bulk_insert:
+            return self.bulk_create(emails)
+
+        marker = 'djnewsletter:bulk_create:{}'.format(uuid.uuid4().hex)
+        # Условие по createDateTime ограничивает поиск метки индексом по дате создания
+        created_after = timezone.now()
+        for email in emails:
+            email.email_remote_id = marker
+        with transaction.atomic(using=self.db, savepoint=False):
+            self.bulk_create(emails)
+            batch = self.filter(createDateTime__gte=created_after, email_remote_id=marker)
+            ids = list(batch.order_by('id').values_list('id', flat=True))
+            batch.update(email_remote_id=None)
+        if len(ids) != len(emails):
+            raise IntegrityError('Emails: создано {} записей из {}'.format(len(ids), len(emails)))
+
+        for email, pk in zip(emails, ids):
+            email.pk = pk
+            email.email_remote_id = None
+        return emails
 
 
 class Emails(models.Model):
@@ -24,27 +72,174 @@ class Emails(models.Model):
     subject = models.CharField(max_length=256)
     newsletter = models.CharField(max_length=20, null=True, blank=True)
     status = models.TextField()
+    delivery_status = models.PositiveSmallIntegerField(
+        choices=DeliveryStatus.CHOICES, null=True, blank=True, db_index=True, verbose_name='Статус доставки')
     createDateTime = models.DateTimeField(auto_now_add=True)
     changeDateTime = models.DateTimeField(auto_now=True)
-    status_hash = models.CharField(max_length=32, null=True, blank=True,
-                                   verbose_name='Хеш статуса для безгеморройного индексирования')
     used_server = models.ForeignKey('djnewsletter.EmailServers', on_delete=models.CASCADE, null=True, blank=True)
     email_remote_id = models.CharField(max_length=128, null=True, blank=True)
 
-    def save(self, **kwargs):
-        self.status_hash = md5(self.status.encode('utf-8')).hexdigest()
-        super(Emails, self).save(**kwargs)
+    objects = EmailsManager()
+
+    # delivery_status на момент загрузки из БД, для учёта изменений в DailyStatistics
+    loaded_delivery_status = None
 
     class Meta:
         verbose_name_plural = 'Emails'
         indexes = [
-            models.Index(fields=['-createDateTime', ]),
+            # Сортировка и постраничный вывод по курсору в админке
+            models.Index(fields=['-createDateTime', '-id']),
             models.Index(fields=['-changeDateTime', ]),
         ]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Emails, cls).from_db(db, field_names, values)
+        instance.loaded_delivery_status = instance.__dict__.get('delivery_status')
+        return instance
+
+
+class EmailsArchive(models.Model):
+    """
+    Письма, перенесённые из Emails командой archive_emails по истечении срока хранения.
+    id совпадает с Emails.id. month - первый день месяца создания письма: по нему архив
+    выбирается и удаляется помесячно, как секции секционированной таблицы.
+    """
+    id = models.IntegerField(primary_key=True)
+    month = models.DateField(db_index=True, verbose_name='Месяц')
+    type = models.CharField(max_length=5)
+    sender = models.EmailField(max_length=255)
+    recipient = models.EmailField(max_length=255)
+    body = models.TextField()
+    subject = models.CharField(max_length=256)
+    newsletter = models.CharField(max_length=20, null=True, blank=True)
+    status = models.TextField()
+    delivery_status = models.PositiveSmallIntegerField(
+        choices=DeliveryStatus.CHOICES, null=True, blank=True, verbose_name='Статус доставки')
+    createDateTime = models.DateTimeField()
+    changeDateTime = models.DateTimeField()
+    used_server = models.ForeignKey(
+        'djnewsletter.EmailServers', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    email_remote_id = models.CharField(max_length=128, null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = 'EmailsArchive'
+
+
+class EmailRecipientsManager(models.Manager):
+    def create_for_emails(self, emails):
+        """
+        Создаёт по записи на каждого получателя писем одним bulk_create. У писем уже должен быть id.
+        """
+        return self.bulk_create([
+            EmailRecipients(
+                email=email,
+                recipient=recipient,
+                newsletter=email.newsletter,
+                sentDateTime=email.createDateTime,
+            )
+            for email in emails
+            for recipient in EmailRecipients.parse_recipients(email.recipient)
+        ])
+
+    def mark_failed(self, emails):
+        """
+        Отмечает получателей, которым письмо не доставлено, хотя отправка письма в целом успешна
+        (например, failed_emails в ответе UniSender). Адреса берутся из email.failed_recipients.
+        """
+        failed = Q()
+        for email in emails:
+            failed_recipients = getattr(email, 'failed_recipients', None)
+            if failed_recipients:
+                failed |= Q(email=email, recipient__in=failed_recipients)
+        if failed:
+            self.filter(failed).update(failed=True)
+
+
+class EmailRecipients(models.Model):
+    """
+    Получатели письма, по записи на адрес. Emails.recipient хранит список адресов строкой,
+    поиск по адресу (частота отправки, аналитика) делается по этой таблице.
+    """
+    email = models.ForeignKey(Emails, on_delete=models.CASCADE, related_name='recipients')
+    recipient = models.EmailField(max_length=255)
+    newsletter = models.CharField(max_length=20, null=True, blank=True)
+    sentDateTime = models.DateTimeField()
+    failed = models.BooleanField(default=False, verbose_name='Не доставлено получателю')
+
+    objects = EmailRecipientsManager()
+
+    class Meta:
+        verbose_name_plural = 'EmailRecipients'
+        indexes = [
+            models.Index(fields=['recipient', 'newsletter', 'sentDateTime']),
+        ]
+
+    @staticmethod
+    def parse_recipients(recipients):
+        """
+        :param recipients: список адресов или его строковое представление из Emails.recipient
+        """
+        if isinstance(recipients, str):
+            return re.findall(r'[^\s\'",\[\]]+', recipients)
+        return list(recipients)
+
+
+class DailyStatisticsManager(models.Manager):
+    def increment(self, day, used_server_id, newsletter, delivery_status, delta):
+        filters = {
+            'day': day,
+            'used_server_id': used_server_id,
+            'newsletter': newsletter,
+            'delivery_status': delivery_status,
+        }
+        if self.filter(**filters).update(count=F('count') + delta):
+            return
+        try:
+            with transaction.atomic():
+                self.create(count=delta, **filters)
+        except IntegrityError:
+            # Строку успел создать другой процесс
+            self.filter(**filters).update(count=F('count') + delta)
+
+
+class DailyStatistics(models.Model):
+    """
+    Количество писем (записей Emails) по дню создания, серверу, рассылке и статусу доставки.
+    Обновляется при создании писем и изменении их статуса, пересчитывается командой rebuild_daily_statistics.
+    Для писем без сервера (не отправленных из-за подавления) уникальность ключа в БД не проверяется,
+    поэтому значения нужно суммировать.
+    """
+    day = models.DateField(verbose_name='День')
+    used_server = models.ForeignKey(
+        'djnewsletter.EmailServers', on_delete=models.CASCADE, null=True, blank=True, verbose_name='Сервер')
+    newsletter = models.CharField(max_length=20, blank=True, default='', verbose_name='Рассылка')
+    delivery_status = models.PositiveSmallIntegerField(choices=DeliveryStatus.CHOICES, verbose_name='Статус доставки')
+    count = models.IntegerField(default=0, verbose_name='Количество писем')
+
+    objects = DailyStatisticsManager()
+
+    class Meta:
+        verbose_name_plural = 'DailyStatistics'
+        unique_together = ('day', 'used_server', 'newsletter', 'delivery_status')
+
+
+class RateLimitBuckets(models.Model):
+    """
+    Корзины токенов ограничения скорости отправки (DJNEWSLETTER_RATE_LIMIT_STORAGE = 'db').
+    """
+    key = models.CharField(max_length=64, primary_key=True)
+    tokens = models.FloatField()
+    updated = models.FloatField()  # time.time()
+
+    class Meta:
+        verbose_name_plural = 'RateLimitBuckets'
+
 
 class Bounced(models.Model):
-    email = models.CharField(max_length=100, db_index=True)
+    SUPPRESSION_EVENTS = ['bounce', 'dropped', 'spamreport']
+
+    email = models.CharField(max_length=100)
     event = models.CharField(max_length=255, db_index=True)
     eventDateTime = models.DateTimeField()
     category = models.CharField(max_length=255, null=True, blank=True)
@@ -53,6 +248,12 @@ class Bounced(models.Model):
 
     class Meta:
         verbose_name_plural = 'Bounceds'
+        # Хранится первое событие каждого типа для адреса; индекс уникальности покрывает проверку подавления
+        # (email IN ... AND event IN ...), повторные события при вставке пропускаются
+        unique_together = ('email', 'event')
+        indexes = [
+            models.Index(fields=['-createDateTime', '-id']),
+        ]
 
 
 class Domains(models.Model):
@@ -93,6 +294,15 @@ class EmailServers(models.Model):
     is_active = models.BooleanField(default=False, verbose_name='Сервер активен')
     preferred_domains = models.ManyToManyField(Domains, verbose_name='Предпочтительней для доменов', blank=True)
     sites = models.ManyToManyField(Site, verbose_name='Сайт', blank=True)
+    send_rate = models.PositiveIntegerField(
+        verbose_name='Ограничение скорости отправки (писем в минуту)', null=True, blank=True,
+        help_text='Пусто - без ограничения')
+    send_burst = models.PositiveIntegerField(
+        verbose_name='Писем подряд без ограничения скорости', null=True, blank=True,
+        help_text='Пусто - одно письмо')
+    weight = models.PositiveIntegerField(
+        verbose_name='Вес', default=1,
+        help_text='Доля писем сервера среди подходящих серверов пропорциональна весу; 0 - сервер не выбирается')
 
     class Meta:
         verbose_name_plural = 'EmailServers'
@@ -1,6 +1,11 @@
 from django.utils.functional import cached_property
 
+from djnewsletter.delivery import (
+    deliver_by_smtp,
+    deliver_by_unisender,
+)
 from djnewsletter.tasks import (
+    send_batch_by_smtp,
     send_by_smtp,
     send_by_unisender,
 )
@@ -11,11 +16,14 @@ class DJNewsLetterSendingMethodOptions:
         'smtp': {
             'label': 'SMTP сервер',
             'task': send_by_smtp,
+            'batch_task': send_batch_by_smtp,
+            'deliver': deliver_by_smtp,
             'from_email': 'email_default_from',
         },
         'unisender_api': {
             'label': 'UniSender API',
             'task': send_by_unisender,
+            'deliver': deliver_by_unisender,
             'from_email': 'api_from_email',
         },
     }
@@ -30,6 +38,14 @@ class DJNewsLetterSendingMethodOptions:
         options = self.sending_method_options.get(sending_method)
         return options['task']
 
+    def get_batch_task_by_sending_method(self, sending_method):
+        options = self.sending_method_options.get(sending_method)
+        return options.get('batch_task')
+
+    def get_deliver_by_sending_method(self, sending_method):
+        options = self.sending_method_options.get(sending_method)
+        return options['deliver']
+
     def get_from_email(self, email_server):
         options = self.sending_method_options.get(email_server.sending_method)
         return getattr(email_server, options['from_email'])
@@ -0,0 +1,88 @@
+from djnewsletter.attachments import load_attachment, store_attachment
+from djnewsletter.mail import DJNewsLetterEmailMessage
+from djnewsletter.models import Emails, EmailRecipients, EmailServers
+from djnewsletter.rollup import record_status_changes
+
+
+def store_message_attachments(email_message):
+    """
+    Каждое вложение сохраняется в хранилище по хешу содержимого: одинаковые вложения
+    разных писем, маршрутов и повторных попыток хранятся один раз, а в задачу попадают только ссылки.
+    :return: {'attachments': [...], 'inline_attachments': [...]}
+    """
+    return {
+        'attachments': [store_attachment(attachment) for attachment in email_message.attachments],
+        'inline_attachments': [store_attachment(attachment) for attachment in email_message.inline_attachments],
+    }
+
+
+def create_payload(email_message, email_instance, email_server, recipients, from_email, stored_attachments):
+    """
+    Данные для задачи отправки. Тема и тело письма берутся из записи Emails,
+    вложения - из хранилища по ссылкам из stored_attachments.
+    """
+    return {
+        'email_id': email_instance.pk,
+        'email_server_id': email_server.pk,
+        'recipients': recipients,
+        'from_email': from_email,
+        'cc': email_message.cc,
+        'bcc': email_message.bcc,
+        'reply_to': email_message.reply_to,
+        'headers': email_message.extra_headers,
+        'category': email_message.category,
+        'attachments': stored_attachments['attachments'],
+        'inline_attachments': stored_attachments['inline_attachments'],
+    }
+
+
+def build_email_message(payload, email_instance, email_server):
+    email_message = DJNewsLetterEmailMessage(
+        email_server=email_server,
+        category=payload['category'],
+        inline_attachments=[load_attachment(ref) for ref in payload['inline_attachments']],
+        subject=email_instance.subject,
+        body=email_instance.body,
+        from_email=payload['from_email'],
+        to=payload['recipients'],
+        cc=payload['cc'],
+        bcc=payload['bcc'],
+        reply_to=payload['reply_to'],
+        headers=payload['headers'],
+    )
+    # EmailMessage.__init__ разбирает вложения как (filename, content, mimetype), поэтому они задаются после
+    email_message.attachments = [load_attachment(ref) for ref in payload['attachments']]
+    email_message.content_subtype = email_instance.type
+    email_message.email_instance = email_instance
+    return email_message
+
+
+def load_email_message(payload):
+    """
+    Восстанавливает письмо из данных задачи.
+    :return: (DJNewsLetterEmailMessage, Emails)
+    """
+    email_instance = Emails.objects.get(pk=payload['email_id'])
+    email_server = EmailServers.objects.get(pk=payload['email_server_id'])
+    return build_email_message(payload, email_instance, email_server), email_instance
+
+
+def load_email_messages(payloads):
+    """
+    Восстанавливает пачку писем: по одному запросу к Emails и EmailServers.
+    :return: список (DJNewsLetterEmailMessage, Emails)
+    """
+    email_instances = Emails.objects.in_bulk([payload['email_id'] for payload in payloads])
+    email_servers = EmailServers.objects.in_bulk({payload['email_server_id'] for payload in payloads})
+    email_messages = []
+    for payload in payloads:
+        email_instance = email_instances[payload['email_id']]
+        email_message = build_email_message(payload, email_instance, email_servers[payload['email_server_id']])
+        email_messages.append((email_message, email_instance))
+    return email_messages
+
+
+def update_statuses(email_instances, fields=('delivery_status', 'status')):
+    Emails.objects.bulk_update(email_instances, fields=fields)
+    EmailRecipients.objects.mark_failed(email_instances)
+    record_status_changes(email_instances)
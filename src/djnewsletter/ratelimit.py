@@ -0,0 +1,209 @@
+import math
+import threading
+import time
+import uuid
+
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+
+from djnewsletter.conf import settings
+
+
+def take_token(state, rate, capacity, now):
+    """
+    Корзина токенов: за секунду добавляется rate токенов, но не больше capacity.
+    Токен забирается всегда, при пустой корзине - в счёт будущих (количество токенов становится отрицательным),
+    поэтому каждое следующее письмо получает время отправки на 1 / rate секунд позже предыдущего.
+    :param state: (количество токенов, время обновления) или None для полной корзины
+    :return: (новое состояние, через сколько секунд наступит время отправки; 0 - можно отправлять сразу)
+    """
+    if state is None:
+        tokens = capacity
+    else:
+        tokens = min(capacity, state[0] + max(now - state[1], 0) * rate)
+    tokens -= 1
+    return (tokens, now), max(-tokens, 0) / rate
+
+
+def get_state_timeout(state, rate, capacity):
+    # После заполнения корзины состояние не нужно: отсутствие ключа означает полную корзину
+    return math.ceil((capacity - state[0]) / rate) + 1
+
+
+class LocalRateLimitStorage:
+    def __init__(self):
+        """
+        Корзины в памяти процесса: ограничение действует только внутри одного воркера.
+        """
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key, rate, capacity):
+        with self._lock:
+            self._buckets[key], wait = take_token(self._buckets.get(key), rate, capacity, time.time())
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets = {}
+
+
+class DatabaseRateLimitStorage:
+    def __init__(self):
+        """
+        Корзины в таблице RateLimitBuckets, общие для всех воркеров.
+        Строка корзины изменяется под блокировкой SELECT ... FOR UPDATE.
+        """
+
+    @staticmethod
+    def get_model():
+        # models -> options -> tasks -> ratelimit: модели нельзя импортировать на уровне модуля
+        from djnewsletter.models import RateLimitBuckets
+        return RateLimitBuckets
+
+    def take(self, key, rate, capacity):
+        RateLimitBuckets = self.get_model()
+        with transaction.atomic():
+            bucket = RateLimitBuckets.objects.select_for_update().filter(key=key).first()
+            if bucket is None:
+                state, wait = take_token(None, rate, capacity, time.time())
+                try:
+                    with transaction.atomic():
+                        RateLimitBuckets.objects.create(key=key, tokens=state[0], updated=state[1])
+                    return wait
+                except IntegrityError:
+                    # Строку успел создать другой процесс
+                    bucket = RateLimitBuckets.objects.select_for_update().get(key=key)
+
+            state, wait = take_token((bucket.tokens, bucket.updated), rate, capacity, time.time())
+            RateLimitBuckets.objects.filter(key=key).update(tokens=state[0], updated=state[1])
+        return wait
+
+    def clear(self):
+        self.get_model().objects.all().delete()
+
+
+class CacheRateLimitStorage:
+    # Кеши, не общие для воркеров или без атомарного cache.add
+    unshared_backends = (LocMemCache, DummyCache, FileBasedCache)
+    lock_timeout = 5  # seconds
+    lock_attempts = 10
+    lock_delay = 0.01  # seconds
+
+    def __init__(self):
+        """
+        Корзины в кеше Django DJNEWSLETTER_RATE_LIMIT_CACHE, общие для всех воркеров.
+        Состояние изменяется под блокировкой через cache.add, которая атомарна в memcached, redis
+        и кеше в БД (DatabaseCache).
+        """
+        cache = self.get_cache()
+        if isinstance(cache, self.unshared_backends):
+            raise ImproperlyConfigured(
+                'DJNEWSLETTER_RATE_LIMIT_CACHE должен быть общим для всех воркеров (memcached, redis, БД), '
+                '{} не подходит. Для ограничения внутри одного процесса используйте '
+                'DJNEWSLETTER_RATE_LIMIT_STORAGE = \'local\'.'.format(type(cache).__name__)
+            )
+
+    @staticmethod
+    def get_cache():
+        return caches[settings.DJNEWSLETTER_RATE_LIMIT_CACHE]
+
+    def take(self, key, rate, capacity):
+        cache = self.get_cache()
+        lock_key = '{}:lock'.format(key)
+        # Значение блокировки уникально: по истечении lock_timeout блокировку мог взять другой воркер
+        lock_token = uuid.uuid4().hex
+        for _ in range(self.lock_attempts):
+            if cache.add(lock_key, lock_token, self.lock_timeout):
+                break
+            time.sleep(self.lock_delay)
+        else:
+            # Корзину долго изменяют другие воркеры: токен не получен
+            return None
+
+        try:
+            state, wait = take_token(cache.get(key), rate, capacity, time.time())
+            cache.set(key, state, get_state_timeout(state, rate, capacity))
+        finally:
+            if cache.get(lock_key) == lock_token:
+                cache.delete(lock_key)
+        return wait
+
+    def clear(self):
+        pass
+
+
+class RateLimiter:
+    storage_classes = {
+        'db': DatabaseRateLimitStorage,
+        'cache': CacheRateLimitStorage,
+        'local': LocalRateLimitStorage,
+    }
+    # Ключ данных задачи со временем отправки, зарезервированным для письма
+    payload_key = 'rate_limit_send_at'
+
+    def __init__(self):
+        """
+        Ограничение скорости отправки через EmailServers: send_rate писем в минуту,
+        до send_burst писем подряд. Хранилище корзин выбирается DJNEWSLETTER_RATE_LIMIT_STORAGE.
+        """
+        self._lock = threading.Lock()
+        self._storages = {}
+
+    def get_storage(self):
+        name = settings.DJNEWSLETTER_RATE_LIMIT_STORAGE
+        with self._lock:
+            if name not in self._storages:
+                self._storages[name] = self.storage_classes[name]()
+            return self._storages[name]
+
+    @staticmethod
+    def get_key(email_server):
+        return 'djnewsletter:rate_limit:{}'.format(email_server.pk)
+
+    def acquire(self, email_server):
+        """
+        Забирает токен для отправки одного письма через сервер.
+        :return: 0, если письмо можно отправлять, иначе через сколько секунд наступит его время отправки;
+            None, если хранилище занято и токен не получен
+        """
+        if not email_server.send_rate:
+            return 0
+        return self.get_storage().take(
+            self.get_key(email_server),
+            email_server.send_rate / 60,
+            max(email_server.send_burst or 1, 1),
+        )
+
+    def reserve(self, email_server, payload, max_wait=0):
+        """
+        Время отправки письма. Токен забирается один раз: если ждать дольше max_wait секунд,
+        время отправки сохраняется в payload, и перезапущенная задача токен повторно не запрашивает.
+        Отложенные письма получают время по очереди и не просыпаются одновременно.
+        :param payload: данные задачи для письма
+        :return: через сколько секунд можно отправлять письмо
+        """
+        send_at = payload.pop(self.payload_key, None)
+        if send_at is None:
+            wait = self.acquire(email_server)
+            if wait is None:
+                # Токен не получен: задача перезапускается без резерва и запросит токен снова
+                return max_wait + 60 / email_server.send_rate
+        else:
+            wait = max(send_at - time.time(), 0)
+        if wait > max_wait:
+            payload[self.payload_key] = time.time() + wait
+        return wait
+
+    def reset(self):
+        with self._lock:
+            storages = list(self._storages.values())
+        for storage in storages:
+            storage.clear()
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,59 @@
+import os
+import threading
+
+from django.template import Context
+from django.template.loader import get_template
+
+from djnewsletter.conf import settings
+
+
+class TemplateCache:
+    def __init__(self):
+        """
+        Скомпилированные шаблоны писем, по одному на процесс.
+        При DEBUG шаблон перечитывается, если изменилось время модификации файла.
+        """
+        self._lock = threading.Lock()
+        self._templates = {}
+
+    @staticmethod
+    def get_mtime(template):
+        origin = getattr(getattr(template, 'template', None), 'origin', None)
+        try:
+            return os.path.getmtime(origin.name)
+        except (AttributeError, TypeError, OSError):
+            return None
+
+    def get_template(self, template_name):
+        cached = self._templates.get(template_name)
+        if cached is not None:
+            template, mtime = cached
+            if not settings.DEBUG or mtime == self.get_mtime(template):
+                return template
+
+        template = get_template(template_name)
+        with self._lock:
+            self._templates[template_name] = (template, self.get_mtime(template))
+        return template
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._templates = {}
+
+
+template_cache = TemplateCache()
+
+
+def render_template(template_name, base_context, context):
+    """
+    Рендерит шаблон без изменения и копирования base_context: контекст письма кладётся слоем поверх него.
+    """
+    template = template_cache.get_template(template_name)
+    django_template = getattr(template, 'template', None)
+    if django_template is None:
+        # Не DTL шаблон (например, Jinja2) принимает только dict
+        return template.render(dict(base_context, **context))
+
+    layered_context = Context(base_context, autoescape=django_template.engine.autoescape)
+    with layered_context.push(context):
+        return django_template.render(layered_context)
@@ -0,0 +1,99 @@
+import collections
+from datetime import datetime, timedelta
+
+from django.db import transaction
+from django.db.models import Count, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from djnewsletter.conf import settings
+from djnewsletter.models import DailyStatistics, Emails, EmailsArchive
+
+
+def get_day(value):
+    if timezone.is_aware(value):
+        return timezone.localdate(value)
+    return value.date()
+
+
+def get_statistics_key(email_instance, delivery_status):
+    return (
+        get_day(email_instance.createDateTime),
+        email_instance.used_server_id,
+        email_instance.newsletter or '',
+        delivery_status,
+    )
+
+
+def record_status_changes(email_instances):
+    """
+    Переносит изменения delivery_status писем в DailyStatistics: +1 к новому статусу,
+    -1 к статусу, с которым письмо было загружено из БД. Одно обновление на каждый изменившийся ключ.
+    """
+    changes = collections.Counter()
+    for email_instance in email_instances:
+        if email_instance.delivery_status == email_instance.loaded_delivery_status:
+            continue
+        if email_instance.loaded_delivery_status is not None:
+            changes[get_statistics_key(email_instance, email_instance.loaded_delivery_status)] -= 1
+        if email_instance.delivery_status is not None:
+            changes[get_statistics_key(email_instance, email_instance.delivery_status)] += 1
+        email_instance.loaded_delivery_status = email_instance.delivery_status
+
+    # Одинаковый порядок обновления строк во всех процессах, чтобы не было взаимных блокировок
+    for key, delta in sorted(changes.items(), key=lambda item: str(item[0])):
+        if delta:
+            DailyStatistics.objects.increment(*key, delta)
+
+
+def get_day_start(day):
+    day_start = datetime.combine(day, datetime.min.time())
+    if settings.USE_TZ:
+        return timezone.make_aware(day_start)
+    return day_start
+
+
+def aggregate_daily_statistics(queryset, date_from, date_to):
+    # Условие по createDateTime, а не по дате от него, чтобы использовался индекс по дате создания
+    return queryset.filter(
+        createDateTime__gte=get_day_start(date_from),
+        createDateTime__lt=get_day_start(date_to + timedelta(days=1)),
+        delivery_status__isnull=False,
+    ).annotate(
+        day=TruncDate('createDateTime'),
+        newsletter_key=Coalesce('newsletter', Value('')),
+    ).values_list(
+        'day', 'used_server_id', 'newsletter_key', 'delivery_status',
+    ).annotate(
+        emails_count=Count('id'),
+    ).order_by()
+
+
+def rebuild_daily_statistics(date_from, date_to):
+    """
+    Пересчитывает DailyStatistics за дни с date_from по date_to (включительно) по Emails и EmailsArchive
+    в одной транзакции. Строки периода блокируются до подсчёта: DailyStatistics.increment других процессов
+    ждёт окончания пересчёта и применяется к новым строкам, а не удаляется вместе со старыми.
+    :return: количество созданных строк
+    """
+    with transaction.atomic():
+        daily_statistics = DailyStatistics.objects.filter(day__range=(date_from, date_to))
+        list(daily_statistics.select_for_update().values_list('pk', flat=True))
+
+        counts = collections.Counter()
+        for queryset in (Emails.objects.all(), EmailsArchive.objects.all()):
+            for *key, emails_count in aggregate_daily_statistics(queryset, date_from, date_to):
+                counts[tuple(key)] += emails_count
+
+        daily_statistics.delete()
+        created = DailyStatistics.objects.bulk_create([
+            DailyStatistics(
+                day=day,
+                used_server_id=used_server_id,
+                newsletter=newsletter,
+                delivery_status=delivery_status,
+                count=emails_count,
+            )
+            for (day, used_server_id, newsletter, delivery_status), emails_count in counts.items()
+        ])
+    return len(created)
@@ -0,0 +1,152 @@
+import collections
+import threading
+import time
+
+from djnewsletter.conf import settings
+from djnewsletter.models import EmailServers
+
+
+class EmailServersPool:
+    def __init__(self, email_servers):
+        """
+        Равноценные серверы одной группы маршрутизации. Серверы выбираются плавным взвешенным
+        циклическим перебором (как в nginx): на каждые sum(weight) выборов сервер выбирается weight раз,
+        и выборы одного сервера не идут подряд. Состояние общее для всех писем процесса.
+        """
+        self.email_servers = email_servers
+        self.total_weight = sum(email_server.weight for email_server in email_servers)
+        self._lock = threading.Lock()
+        self._current_weights = [0] * len(email_servers)
+
+    def get_email_server(self):
+        if len(self.email_servers) == 1:
+            return self.email_servers[0]
+
+        with self._lock:
+            selected_idx = 0
+            for idx, email_server in enumerate(self.email_servers):
+                self._current_weights[idx] += email_server.weight
+                if self._current_weights[idx] > self._current_weights[selected_idx]:
+                    selected_idx = idx
+            self._current_weights[selected_idx] -= self.total_weight
+        return self.email_servers[selected_idx]
+
+
+class EmailServersRoutingTable:
+    def __init__(self, email_servers, server_sites, server_domains):
+        """
+        Таблица маршрутизации писем по серверам.
+        Порядок выбора группы серверов для домена:
+        - активные серверы сайта с предпочтительным доменом;
+        - активные серверы сайта;
+        - активные серверы без сайтов с предпочтительным доменом;
+        - основные активные серверы без сайтов.
+        Письма распределяются между серверами группы пропорционально EmailServers.weight.
+        :param email_servers: активные EmailServers
+        :param server_sites: словарь {id сервера: [id сайтов]}
+        :param server_domains: словарь {id сервера: [предпочтительные домены]}
+        """
+        site_domain_servers = collections.defaultdict(list)
+        site_servers = collections.defaultdict(list)
+        domain_servers = collections.defaultdict(list)
+        main_servers = []
+        self.built_at = time.monotonic()
+
+        for email_server in sorted(email_servers, key=lambda server: server.pk):
+            if email_server.weight < 1:
+                continue
+            site_ids = server_sites.get(email_server.pk, [])
+            domains = server_domains.get(email_server.pk, [])
+            if site_ids:
+                for site_id in site_ids:
+                    site_servers[site_id].append(email_server)
+                    for domain in domains:
+                        site_domain_servers[(site_id, domain)].append(email_server)
+                continue
+
+            for domain in domains:
+                domain_servers[domain].append(email_server)
+            if email_server.main:
+                main_servers.append(email_server)
+
+        self.site_domain_servers = self.get_pools(site_domain_servers)
+        self.site_servers = self.get_pools(site_servers)
+        self.domain_servers = self.get_pools(domain_servers)
+        self.main_servers = EmailServersPool(main_servers) if main_servers else None
+
+    @staticmethod
+    def get_pools(servers):
+        return {key: EmailServersPool(email_servers) for key, email_servers in servers.items()}
+
+    @classmethod
+    def build(cls):
+        email_servers = list(EmailServers.objects.filter(is_active=True))
+        email_servers_ids = [email_server.pk for email_server in email_servers]
+
+        server_sites = collections.defaultdict(list)
+        for email_server_id, site_id in EmailServers.sites.through.objects.filter(
+                emailservers_id__in=email_servers_ids,
+        ).values_list('emailservers_id', 'site_id'):
+            server_sites[email_server_id].append(site_id)
+
+        server_domains = collections.defaultdict(list)
+        for email_server_id, domain in EmailServers.preferred_domains.through.objects.filter(
+                emailservers_id__in=email_servers_ids,
+        ).values_list('emailservers_id', 'domains__domain'):
+            server_domains[email_server_id].append(domain)
+
+        return cls(email_servers, server_sites, server_domains)
+
+    def get_pool(self, domain, site=None):
+        if site is not None:
+            pool = (
+                self.site_domain_servers.get((site.pk, domain)) or
+                self.site_servers.get(site.pk)
+            )
+            if pool is not None:
+                return pool
+        return self.domain_servers.get(domain) or self.main_servers
+
+    def get_email_server(self, domain, site=None):
+        pool = self.get_pool(domain, site)
+        if pool is None:
+            return None
+        return pool.get_email_server()
+
+
+class EmailServersRouter:
+    def __init__(self):
+        """
+        Таблица строится один раз на процесс и сбрасывается сигналами при изменении
+        EmailServers, Domains и Site. Изменения, сделанные в других процессах, подхватываются
+        по истечении DJNEWSLETTER_ROUTING_TABLE_TIMEOUT секунд.
+        """
+        self._lock = threading.Lock()
+        self._table = None
+
+    @staticmethod
+    def is_expired(table):
+        timeout = settings.DJNEWSLETTER_ROUTING_TABLE_TIMEOUT
+        if timeout is None:
+            return False
+        return time.monotonic() - table.built_at > timeout
+
+    def get_table(self):
+        table = self._table
+        if table is not None and not self.is_expired(table):
+            return table
+
+        with self._lock:
+            if self._table is None or self.is_expired(self._table):
+                self._table = EmailServersRoutingTable.build()
+            return self._table
+
+    def get_email_server(self, domain, site=None):
+        return self.get_table().get_email_server(domain, site)
+
+    def invalidate(self, **kwargs):
+        with self._lock:
+            self._table = None
+
+
+email_servers_router = EmailServersRouter()
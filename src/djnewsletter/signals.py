@@ -0,0 +1,16 @@
+from django.contrib.sites.models import Site
+from django.core.signals import setting_changed
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from djnewsletter.models import Domains, EmailServers
+from djnewsletter.rendering import template_cache
+from djnewsletter.routing import email_servers_router
+
+for model in (EmailServers, Domains, Site):
+    post_save.connect(email_servers_router.invalidate, sender=model, dispatch_uid='djnewsletter_routing_save')
+    post_delete.connect(email_servers_router.invalidate, sender=model, dispatch_uid='djnewsletter_routing_delete')
+
+for through in (EmailServers.preferred_domains.through, EmailServers.sites.through):
+    m2m_changed.connect(email_servers_router.invalidate, sender=through, dispatch_uid='djnewsletter_routing_m2m')
+
+setting_changed.connect(template_cache.clear, dispatch_uid='djnewsletter_template_cache')
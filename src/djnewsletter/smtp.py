@@ -0,0 +1,124 @@
+import collections
+import threading
+import time
+from smtplib import SMTPRecipientsRefused, SMTPResponseException, SMTPServerDisconnected
+
+from django.core.mail import get_connection
+
+from djnewsletter.conf import (
+    BACKEND,
+    settings,
+)
+
+
+class PooledSMTPConnection:
+    def __init__(self, email_server):
+        server_settings = email_server.get_smtp_server_settings()
+        self.email_server_id = email_server.pk
+        self.server_settings = server_settings
+        if server_settings:
+            self.connection = get_connection(backend=BACKEND, **server_settings)
+        else:
+            self.connection = get_connection(backend=BACKEND)
+        self.connection.open()
+        self.sent_count = 0
+        self.last_used_at = time.monotonic()
+
+    def is_reusable(self, email_server):
+        return (
+            self.server_settings == email_server.get_smtp_server_settings() and
+            self.sent_count < settings.DJNEWSLETTER_SMTP_POOL_MAX_MESSAGES and
+            time.monotonic() - self.last_used_at < settings.DJNEWSLETTER_SMTP_POOL_IDLE_TIMEOUT
+        )
+
+    def send_messages(self, email_messages):
+        num_sent = self.connection.send_messages(email_messages)
+        self.sent_count += len(email_messages)
+        self.last_used_at = time.monotonic()
+        return num_sent
+
+    def is_connected(self):
+        # smtplib закрывает сокет, получив 421
+        smtp = getattr(self.connection, 'connection', None)
+        return getattr(smtp, 'sock', None) is not None
+
+    def close(self):
+        self.connection.close()
+
+
+class SMTPConnectionPool:
+    def __init__(self):
+        """
+        Открытые SMTP соединения воркера, по EmailServers.id.
+        Соединение переоткрывается, если оно простаивало дольше DJNEWSLETTER_SMTP_POOL_IDLE_TIMEOUT,
+        отправило DJNEWSLETTER_SMTP_POOL_MAX_MESSAGES писем, изменились настройки сервера
+        или сервер разорвал соединение.
+        """
+        self._lock = threading.Lock()
+        self._idle_connections = collections.defaultdict(list)
+
+    def acquire(self, email_server):
+        with self._lock:
+            idle_connections = self._idle_connections[email_server.pk]
+            while idle_connections:
+                connection = idle_connections.pop()
+                if connection.is_reusable(email_server):
+                    return connection
+                connection.close()
+        return PooledSMTPConnection(email_server)
+
+    def release(self, connection):
+        with self._lock:
+            self._idle_connections[connection.email_server_id].append(connection)
+
+    def send_messages(self, email_server, email_messages):
+        if not settings.DJNEWSLETTER_SMTP_POOL:
+            connection = PooledSMTPConnection(email_server)
+            try:
+                return connection.send_messages(email_messages)
+            finally:
+                connection.close()
+
+        connection = self.acquire(email_server)
+        try:
+            num_sent = connection.send_messages(email_messages)
+        except SMTPRecipientsRefused:
+            # Получатели отклонены, соединение остаётся рабочим, если сервер его не закрыл (421)
+            if connection.is_connected():
+                self.release(connection)
+            else:
+                connection.close()
+            raise
+        except SMTPResponseException:
+            # Сервер ответил ошибкой (например, 421): состояние сессии неизвестно, соединение не переиспользуется
+            connection.close()
+            raise
+        except SMTPServerDisconnected:
+            connection.close()
+            connection = PooledSMTPConnection(email_server)
+            try:
+                num_sent = connection.send_messages(email_messages)
+            except Exception:
+                connection.close()
+                raise
+        except Exception:
+            connection.close()
+            raise
+
+        if num_sent != len(email_messages):
+            # С fail_silently ошибки не пробрасываются, соединение могло быть разорвано
+            connection.close()
+        else:
+            self.release(connection)
+        return num_sent
+
+    def close_all(self):
+        with self._lock:
+            idle_connections = self._idle_connections
+            self._idle_connections = collections.defaultdict(list)
+        for connections in idle_connections.values():
+            for connection in connections:
+                connection.close()
+
+
+smtp_connection_pool = SMTPConnectionPool()
@@ -0,0 +1,19 @@
+class DeliveryStatus:
+    """
+    Статус доставки письма (Emails.delivery_status). Подробности (ответ сервера, текст ошибки) хранятся в Emails.status.
+    """
+    QUEUED = 1
+    SENT = 2
+    FAILED = 3
+    BOUNCED = 4
+    UNSUBSCRIBED = 5
+    TOO_FREQUENT = 6
+
+    CHOICES = (
+        (QUEUED, 'В очереди'),
+        (SENT, 'Отправлено'),
+        (FAILED, 'Ошибка отправки'),
+        (BOUNCED, 'Не отправлено: проблемы с получателем'),
+        (UNSUBSCRIBED, 'Не отправлено: получатель отписался'),
+        (TOO_FREQUENT, 'Не отправлено: слишком частая отправка'),
+    )
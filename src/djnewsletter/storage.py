@@ -0,0 +1,96 @@
+import hashlib
+from datetime import date
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import get_storage_class
+from django.utils import timezone
+from django.utils.functional import LazyObject
+
+from djnewsletter.conf import settings
+
+# Каталоги хранилища: содержимое вложений и MIME части, переданные письму готовыми
+STORAGE_DIRECTORIES = ('attachments', 'content')
+
+
+class ContentStorage(LazyObject):
+    def _setup(self):
+        if not settings.DJNEWSLETTER_CONTENT_STORAGE:
+            raise ImproperlyConfigured(
+                'DJNEWSLETTER_CONTENT_STORAGE не задан. Вложения писем передаются воркерам через хранилище, '
+                'поэтому оно должно быть доступно и процессу, который отправляет письма, и всем воркерам '
+                '(например, S3 или общая файловая система).'
+            )
+        storage_class = get_storage_class(settings.DJNEWSLETTER_CONTENT_STORAGE)
+        self._wrapped = storage_class(**settings.DJNEWSLETTER_CONTENT_STORAGE_OPTIONS)
+
+
+content_storage = ContentStorage()
+
+
+def get_today():
+    now = timezone.now()
+    if timezone.is_aware(now):
+        return timezone.localdate(now)
+    return now.date()
+
+
+def _store(directory, data):
+    """
+    Содержимое хранится в каталоге дня сохранения, чтобы его можно было удалять по дням
+    (delete_expired_content). Одинаковое содержимое в течение дня сохраняется один раз.
+    """
+    name = 'djnewsletter/{}/{}/{}'.format(directory, get_today().isoformat(), hashlib.sha256(data).hexdigest())
+    if content_storage.exists(name):
+        return name
+    return content_storage.save(name, ContentFile(data))
+
+
+def store_content(data):
+    """
+    Сохраняет MIME часть, переданную письму готовой (MIMEBase.as_bytes()).
+    :return: ключ для load_bytes
+    """
+    return _store('content', data)
+
+
+def store_bytes(data):
+    """
+    Сохраняет байты (содержимое вложения) под именем, равным их sha256.
+    :return: ключ для load_bytes
+    """
+    return _store('attachments', data)
+
+
+def load_bytes(key):
+    with content_storage.open(key, 'rb') as content_file:
+        return content_file.read()
+
+
+def delete_expired_content(before):
+    """
+    Удаляет содержимое, сохранённое раньше дня before.
+    :return: генератор удалённых каталогов дней
+    """
+    for directory in STORAGE_DIRECTORIES:
+        directory = 'djnewsletter/{}'.format(directory)
+        try:
+            day_directories, _ = content_storage.listdir(directory)
+        except FileNotFoundError:
+            continue
+
+        for day_directory in sorted(day_directories):
+            try:
+                day = date.fromisoformat(day_directory)
+            except ValueError:
+                continue
+            if day >= before:
+                continue
+
+            day_directory = '{}/{}'.format(directory, day_directory)
+            _, names = content_storage.listdir(day_directory)
+            for name in names:
+                content_storage.delete('{}/{}'.format(day_directory, name))
+            # Пустой каталог удаляется в файловой системе, в объектных хранилищах каталогов нет
+            content_storage.delete(day_directory)
+            yield day_directory
@@ -0,0 +1,132 @@
+import hashlib
+import math
+import threading
+import time
+from datetime import timedelta
+
+from django.db.models import Max
+
+from djnewsletter.conf import settings
+from djnewsletter.models import Bounced, Unsubscribers
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        """
+        :param capacity: ожидаемое количество элементов
+        :param error_rate: допустимая доля ложноположительных ответов при заполнении до capacity
+        """
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.size = max(int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hash_count = max(int(round(self.size / self.capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _get_positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + idx * h2) % self.size for idx in range(self.hash_count))
+
+    def add(self, value):
+        positions = list(self._get_positions(value))
+        if all(self.bits[position >> 3] & (1 << (position & 7)) for position in positions):
+            return
+        for position in positions:
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._get_positions(value))
+
+    def is_overflowed(self):
+        return self.count > self.capacity
+
+
+class SuppressionIndex:
+    def __init__(self):
+        """
+        Индекс адресов из Bounced и Unsubscribers, хранится в памяти процесса (воркера).
+        Отрицательный ответ точен: адреса нет ни в одной из таблиц на момент последнего обновления.
+        Положительный ответ означает, что адрес нужно проверить в БД.
+        Обновляется инкрементально по createDateTime / unsubscribeDatetime не чаще,
+        чем раз в DJNEWSLETTER_SUPPRESSION_INDEX_REFRESH_INTERVAL секунд.
+        """
+        self._lock = threading.Lock()
+        self.bloom_filter = None
+        self.bounced_loaded_until = None
+        self.unsubscribers_loaded_until = None
+        self.refreshed_at = None
+
+    @staticmethod
+    def normalize(email):
+        return email.lower()
+
+    def get_bounced_queryset(self):
+        queryset = Bounced.objects.filter(event__in=Bounced.SUPPRESSION_EVENTS)
+        if self.bounced_loaded_until is not None:
+            queryset = queryset.filter(createDateTime__gte=self.bounced_loaded_until - self.get_overlap())
+        return queryset
+
+    def get_unsubscribers_queryset(self):
+        queryset = Unsubscribers.objects.all()
+        if self.unsubscribers_loaded_until is not None:
+            queryset = queryset.filter(
+                unsubscribeDatetime__gte=self.unsubscribers_loaded_until - self.get_overlap(),
+            )
+        return queryset
+
+    @staticmethod
+    def get_overlap():
+        # Запас на расхождение часов серверов, которые пишут в таблицы
+        return timedelta(seconds=settings.DJNEWSLETTER_SUPPRESSION_INDEX_OVERLAP)
+
+    def _load(self, queryset, field, datetime_field, loaded_until):
+        # Граница фиксируется до чтения строк, поэтому вставленные во время загрузки строки не потеряются
+        max_datetime = queryset.aggregate(max_datetime=Max(datetime_field))['max_datetime']
+        if max_datetime is None:
+            return loaded_until
+        for email in queryset.filter(**{'{}__lte'.format(datetime_field): max_datetime}).values_list(
+                field, flat=True,
+        ).iterator():
+            self.bloom_filter.add(self.normalize(email))
+        return max_datetime
+
+    def rebuild(self):
+        capacity = max(
+            (Bounced.objects.count() + Unsubscribers.objects.count()) * 2,
+            settings.DJNEWSLETTER_SUPPRESSION_INDEX_MIN_CAPACITY,
+        )
+        self.bloom_filter = BloomFilter(capacity, settings.DJNEWSLETTER_SUPPRESSION_INDEX_ERROR_RATE)
+        self.bounced_loaded_until = None
+        self.unsubscribers_loaded_until = None
+        self.update()
+
+    def update(self):
+        self.bounced_loaded_until = self._load(
+            self.get_bounced_queryset(), 'email', 'createDateTime', self.bounced_loaded_until,
+        )
+        self.unsubscribers_loaded_until = self._load(
+            self.get_unsubscribers_queryset(), 'email', 'unsubscribeDatetime', self.unsubscribers_loaded_until,
+        )
+        self.refreshed_at = time.monotonic()
+
+    def refresh(self):
+        with self._lock:
+            if self.bloom_filter is None or self.bloom_filter.is_overflowed():
+                self.rebuild()
+            elif time.monotonic() - self.refreshed_at > settings.DJNEWSLETTER_SUPPRESSION_INDEX_REFRESH_INTERVAL:
+                self.update()
+            return self.bloom_filter
+
+    def reset(self):
+        with self._lock:
+            self.bloom_filter = None
+
+    def filter_possibly_suppressed(self, emails):
+        bloom_filter = self.refresh()
+        return [email for email in emails if self.normalize(email) in bloom_filter]
+
+
+suppression_index = SuppressionIndex()
@@ -1,72 +1,251 @@
+import time
+
+from celery.signals import worker_process_shutdown
 from celery.task import task, current
-from django.core.mail import get_connection
+from django.db import InterfaceError, OperationalError
 
 from djnewsletter.conf import (
-    BACKEND,
     MAX_RETRIES,
     COUNTDOWN,
+    settings,
+)
+from djnewsletter.delivery import (
+    deliver_by_smtp,
+    deliver_by_unisender,
+)
+from djnewsletter.ratelimit import (
+    rate_limiter,
+)
+from djnewsletter.smtp import (
+    smtp_connection_pool,
+)
+from djnewsletter.statuses import (
+    DeliveryStatus,
 )
 from djnewsletter.unisender import (
-    UniSenderAPIClient,
+    unisender_sessions,
 )
 
 
+@worker_process_shutdown.connect
+def close_connections(**kwargs):
+    smtp_connection_pool.close_all()
+    unisender_sessions.close_all()
+
+
+def load_email_message(payload):
+    # models -> options -> tasks: модели нельзя импортировать на уровне модуля
+    from djnewsletter.payloads import load_email_message
+    return load_email_message(payload)
+
+
+def load_email_messages(payloads):
+    from djnewsletter.payloads import load_email_messages
+    return load_email_messages(payloads)
+
+
+def update_statuses(email_instances, fields=('delivery_status', 'status')):
+    from djnewsletter.payloads import update_statuses
+    update_statuses(email_instances, fields=fields)
+
+
+def mark_failed_recipients(email_instances):
+    from djnewsletter.models import EmailRecipients
+    EmailRecipients.objects.mark_failed(email_instances)
+
+
+def record_status_changes(email_instances):
+    from djnewsletter.rollup import record_status_changes
+    record_status_changes(email_instances)
+
+
+def create_bounced(data):
+    from djnewsletter.bounced import create_sendgrid_bounced
+    return create_sendgrid_bounced(data)
+
+
+def get_retry_countdown():
+    # Первый повтор тоже откладывается на COUNTDOWN
+    return COUNTDOWN * (current.request.retries + 1)
+
+
+def wait_for_token(email_server, payload):
+    """
+    Ожидание своего времени отправки по ограничению скорости сервера. Ожидание до
+    DJNEWSLETTER_RATE_LIMIT_MAX_SLEEP секунд выполняется в задаче, иначе задачу нужно отложить:
+    время отправки уже зарезервировано в payload.
+    :return: 0 - письмо можно отправлять, иначе через сколько секунд перезапустить задачу
+    """
+    max_sleep = settings.DJNEWSLETTER_RATE_LIMIT_MAX_SLEEP
+    wait = rate_limiter.reserve(email_server, payload, max_wait=max_sleep)
+    if wait > max_sleep:
+        return wait
+    if wait > 0:
+        time.sleep(wait)
+    return 0
+
+
+def reschedule(task, data, countdown):
+    """
+    Откладывает отправку до появления токена ограничения скорости сервера.
+    Откладывание не считается ошибкой и не расходует повторы MAX_RETRIES.
+    :param data: аргумент задачи - данные письма или пачки писем
+    """
+    if current.request.is_eager:
+        # Задача выполняется синхронно: перезапуск сразу снова не получил бы токен
+        time.sleep(countdown)
+        countdown = 0
+    task.apply_async(args=(data,), countdown=countdown, retries=current.request.retries)
+
+
+def deliver_async(payloads):
+    from djnewsletter.engine import AsyncDeliveryEngine
+    return AsyncDeliveryEngine().send(payloads)
+
+
 @task(queue='emails', time_limit=300)
-def send_by_smtp(email_message):
-    try:
-        server_settings = email_message.email_server.get_smtp_server_settings()
-        if server_settings:
-            conn = get_connection(backend=BACKEND, **server_settings)
-        else:
-            conn = get_connection(backend=BACKEND)
-
-        email_message.attachments.extend(
-            email_message.inline_attachments
-        )
-        for idx, attachment in enumerate(email_message.attachments):
-            if isinstance(attachment, tuple) and len(attachment) == 3:
-                email_message.attachments[idx] = email_message.create_mime_attachment(*attachment)
+def send_by_smtp(payload):
+    email_message, email_instance = load_email_message(payload)
+    wait = wait_for_token(email_message.email_server, payload)
+    if wait:
+        reschedule(send_by_smtp, payload, wait)
+        return
 
-        conn.send_messages([email_message])
-        email_message.email_instance.status = 'sent to user'
+    error = None
+    try:
+        email_instance.delivery_status, email_instance.status, _ = deliver_by_smtp(email_message)
     except Exception as e:
-        email_message.email_instance.status = str(e)
-        send_by_smtp.retry(max_retries=MAX_RETRIES, countdown=COUNTDOWN * current.request.retries, exc=e)
+        email_instance.status = str(e)
+        email_instance.delivery_status = DeliveryStatus.FAILED
+        error = e
+
+    # Статус сохраняется до постановки повтора в очередь, иначе повтор может загрузить старый статус
+    email_instance.save(
+        update_fields=(
+            'delivery_status',
+            'status',
+        ),
+    )
+    record_status_changes([email_instance])
+    if error is not None:
+        send_by_smtp.retry(max_retries=MAX_RETRIES, countdown=get_retry_countdown(), exc=error)
+
+
+@task(queue='emails', time_limit=300)
+def send_batch_by_smtp(payloads):
+    """
+    Отправка пачки писем одного сервера через одно SMTP соединение.
+    Письма отправляются по очереди, чтобы статус был у каждого; статусы сохраняются каждые
+    DJNEWSLETTER_SMTP_STATUS_FLUSH_SIZE писем, поэтому при остановке воркера отправленные письма
+    не остаются в очереди. Повторяются только неотправленные письма. Письма, время отправки которых
+    по ограничению скорости наступит не скоро, откладываются.
+    """
+    email_messages = load_email_messages(payloads)
+    email_instances = []
+    failed_payloads = []
+    deferred_payloads = []
+    wait = 0
+    error = None
+    try:
+        for idx, (payload, (email_message, email_instance)) in enumerate(zip(payloads, email_messages)):
+            wait = wait_for_token(email_message.email_server, payload)
+            if wait:
+                deferred_payloads = payloads[idx:]
+                # Время отправки резервируется сразу для всех отложенных писем, перезапуск их не перемешает
+                for deferred_payload in deferred_payloads[1:]:
+                    rate_limiter.reserve(email_message.email_server, deferred_payload, max_wait=-1)
+                break
+            try:
+                email_instance.delivery_status, email_instance.status, _ = deliver_by_smtp(email_message)
+            except Exception as e:
+                email_instance.status = str(e)
+                email_instance.delivery_status = DeliveryStatus.FAILED
+                failed_payloads.append(payload)
+                error = e
+            email_instances.append(email_instance)
+            if len(email_instances) >= settings.DJNEWSLETTER_SMTP_STATUS_FLUSH_SIZE:
+                update_statuses(email_instances)
+                email_instances = []
     finally:
-        email_message.email_instance.save(
-            update_fields=(
-                'status',
-            ),
+        if email_instances:
+            update_statuses(email_instances)
+
+    if deferred_payloads:
+        reschedule(send_batch_by_smtp, deferred_payloads, wait)
+    if failed_payloads:
+        send_batch_by_smtp.retry(
+            args=(failed_payloads,),
+            max_retries=MAX_RETRIES,
+            countdown=get_retry_countdown(),
+            exc=error,
         )
 
 
 @task(queue='emails', time_limit=300)
-def send_by_unisender(email_message):
-    unisender_api = UniSenderAPIClient(
-        api_key=email_message.email_server.api_key,
-        username=email_message.email_server.api_username,
-    )
-    try:
-        response_json = unisender_api.send(
-            subject=email_message.subject,
-            body_html=email_message.body,
-            from_email=email_message.from_email,
-            from_name=email_message.email_server.api_from_name,
-            recipients=email_message.to,
-            attachments=email_message.attachments,
-            inline_attachments=email_message.inline_attachments,
+def send_batch_async(payloads):
+    """
+    Отправка пачки писем любых серверов и способов отправки через AsyncDeliveryEngine.
+    """
+    failed_payloads, error, deferred_payloads, wait = deliver_async(payloads)
+    if deferred_payloads:
+        reschedule(send_batch_async, deferred_payloads, wait)
+    if failed_payloads:
+        send_batch_async.retry(
+            args=(failed_payloads,),
+            max_retries=MAX_RETRIES,
+            countdown=get_retry_countdown(),
+            exc=error,
         )
+
+
+@task(queue='emails', time_limit=300)
+def send_by_unisender(payload):
+    email_message, email_instance = load_email_message(payload)
+    wait = wait_for_token(email_message.email_server, payload)
+    if wait:
+        reschedule(send_by_unisender, payload, wait)
+        return
+
+    error = None
+    try:
+        (
+            email_instance.delivery_status,
+            email_instance.status,
+            email_instance.email_remote_id,
+        ) = deliver_by_unisender(email_message)
     except Exception as e:
-        email_message.email_instance.status = str(e)
-        send_by_unisender.retry(max_retries=MAX_RETRIES, countdown=COUNTDOWN * current.request.retries, exc=e)
-    else:
-        email_message.email_instance.status = str(response_json)
-        email_message.email_instance.email_remote_id = response_json.get('job_id')
-    finally:
-        email_message.email_instance.save()
-        email_message.email_instance.save(
-            update_fields=(
-                'status',
-                'email_remote_id',
-            ),
-        )
+        email_instance.status = str(e)
+        email_instance.delivery_status = DeliveryStatus.FAILED
+        error = e
+
+    email_instance.save()
+    email_instance.save(
+        update_fields=(
+            'delivery_status',
+            'status',
+            'email_remote_id',
+        ),
+    )
+    mark_failed_recipients([email_instance])
+    record_status_changes([email_instance])
+    if error is not None:
+        send_by_unisender.retry(max_retries=MAX_RETRIES, countdown=get_retry_countdown(), exc=error)
+
+
+@task(
+    queue='bounced',
+    time_limit=300,
+    autoretry_for=(OperationalError, InterfaceError),
+    max_retries=MAX_RETRIES,
+    retry_backoff=COUNTDOWN,
+    retry_backoff_max=COUNTDOWN * 2 ** MAX_RETRIES,
+)
+def create_sendgrid_bounced(data):
+    """
+    Сохранение событий SendGrid, принятых create_sendgrid_bounced view. View уже ответил SendGrid,
+    и пачка не будет отправлена повторно, поэтому при временной ошибке БД (соединение, блокировка)
+    задача повторяется (повтор не создаёт дублей: существующие события пропускаются). Отдельная очередь,
+    чтобы приём событий не ждал отправки писем.
+    :param data: тело запроса SendGrid (JSON массив событий)
+    """
+    return create_bounced(data)
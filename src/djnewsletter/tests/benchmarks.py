@@ -0,0 +1,176 @@
+"""
+Бенчмарки, не запускаются вместе с тестами:
+
+    django-admin test djnewsletter.tests.benchmarks --settings=djnewsletter.tests.settings
+"""
+import base64
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import mock
+
+import requests
+from django.test import RequestFactory, SimpleTestCase, TestCase
+
+from djnewsletter.bounced import create_sendgrid_bounced
+from djnewsletter.models import Bounced
+
+from djnewsletter.tests.servers import UniSenderStandIn
+from djnewsletter.unisender import LazyEncoder, UniSenderAPIClient, unisender_sessions
+from djnewsletter.views import create_sendgrid_bounced as create_sendgrid_bounced_view
+
+
+def measure(func, repeat):
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return time.perf_counter() - started_at
+
+
+def measure_peak_memory(func):
+    """
+    Пиковый объём памяти, выделенной Python во время вызова (байт).
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class UniSenderSessionBenchmark(SimpleTestCase):
+    repeat = 300
+
+    def setUp(self):
+        unisender_sessions.close_all()
+        self.addCleanup(unisender_sessions.close_all)
+
+    def test_session_vs_new_connection(self):
+        with UniSenderStandIn() as stand_in, self.settings(DJNEWSLETTER_UNISENDER_URL=stand_in.url):
+            message = {'message': {'recipients': [{'email': 'example@email.com'}]}}
+            new_connection_time = measure(lambda: requests.post(stand_in.url, json=message), self.repeat)
+            connections_before = stand_in.connections_count
+
+            client = UniSenderAPIClient(api_key='api_key', username='api_username')
+            session_time = measure(lambda: client._send_request(stand_in.url, message), self.repeat)
+
+        print(
+            '\nUniSender, {} запросов: новое соединение на запрос {:.3f} с, keep-alive сессия {:.3f} с '
+            '(соединений: {} и {})'.format(
+                self.repeat, new_connection_time, session_time,
+                connections_before, stand_in.connections_count - connections_before,
+            )
+        )
+        self.assertEqual(stand_in.connections_count - connections_before, 1)
+
+
+class UniSenderAttachmentsMemoryBenchmark(SimpleTestCase):
+    sizes_mb = (1, 4, 16, 64)
+
+    def setUp(self):
+        unisender_sessions.close_all()
+        self.addCleanup(unisender_sessions.close_all)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def create_file(self, size_mb):
+        path = os.path.join(self.directory.name, '{}.bin'.format(size_mb))
+        with open(path, 'wb') as attachment_file:
+            for _ in range(size_mb):
+                attachment_file.write(os.urandom(1024 * 1024))
+        return path
+
+    @staticmethod
+    def encode_in_memory(path):
+        # Прежний способ: base64 строка и JSON документ целиком
+        with open(path, 'rb') as attachment_file:
+            content = attachment_file.read()
+        attachments = [{'name': 'file.bin', 'content': base64.b64encode(content).decode('utf-8')}]
+        return json.dumps({'message': {'attachments': attachments}}, cls=LazyEncoder)
+
+    def test_peak_memory_does_not_grow_with_attachment_size(self):
+        streaming_peaks = []
+        with UniSenderStandIn(store_requests=False) as stand_in, self.settings(DJNEWSLETTER_UNISENDER_URL=stand_in.url):
+            client = UniSenderAPIClient(api_key='api_key', username='api_username')
+            print('\nUniSender, пиковая память при отправке вложения:')
+            for size_mb in self.sizes_mb:
+                path = self.create_file(size_mb)
+                streaming_peak = measure_peak_memory(lambda: client.send(
+                    subject='subject',
+                    body_html='body',
+                    from_email='example@email.com',
+                    from_name=None,
+                    recipients=['example@email.com'],
+                    attachments=[('file.bin', Path(path), 'application/octet-stream')],
+                    inline_attachments=[],
+                ))
+                in_memory_peak = measure_peak_memory(lambda: self.encode_in_memory(path))
+                streaming_peaks.append(streaming_peak)
+                print('  {:>3} МБ: потоковая отправка {:.2f} МБ, кодирование в памяти {:.2f} МБ'.format(
+                    size_mb, streaming_peak / 1024 / 1024, in_memory_peak / 1024 / 1024,
+                ))
+
+        # Пик не зависит от размера вложения: он определяется DJNEWSLETTER_UNISENDER_CHUNK_SIZE
+        self.assertLess(max(streaming_peaks), 2 * min(streaming_peaks) + 1024 * 1024)
+
+
+def create_bounced_inline(data):
+    # Прежний view: разбор и сохранение в потоке запроса, набор полей вычисляется для каждого события
+    new_items = []
+    for item in json.loads(data):
+        stamp = item.pop('timestamp')
+        category = item.pop('category', None)
+        available_fields = set(field.name for field in Bounced._meta.get_fields()) - {'id'}
+        item = {k: v for k, v in list(item.items()) if k in available_fields}
+        bounced = Bounced(**item)
+        bounced.eventDateTime = datetime.fromtimestamp(stamp)
+        if category:
+            bounced.category = str(category)
+        new_items.append(bounced)
+    # Без ignore_conflicts повторы нарушили бы уникальность (email, event)
+    Bounced.objects.bulk_create(new_items, ignore_conflicts=True)
+
+
+class SendGridBouncedBenchmark(TestCase):
+    events_count = 10000
+
+    def get_body(self):
+        timestamp = int(time.time())
+        return json.dumps([
+            {
+                'email': 'user_{}@email.com'.format(idx % (self.events_count // 2)),
+                'event': 'bounce',
+                'timestamp': timestamp,
+                'reason': '550 Mailbox unavailable',
+                'category': ['newsletter'],
+                'sg_event_id': 'event-{}'.format(idx % (self.events_count // 2)),
+                'sg_message_id': 'message-{}'.format(idx),
+                'smtp-id': '<message-{}@email.com>'.format(idx),
+            }
+            for idx in range(self.events_count)
+        ])
+
+    def test_view_response_time(self):
+        body = self.get_body()
+        request = RequestFactory().post('/bounced/', data=body, content_type='application/json')
+
+        inline_time = measure(lambda: create_bounced_inline(body), 1)
+        Bounced.objects.all().delete()
+        with mock.patch('djnewsletter.views.create_sendgrid_bounced_task.delay'):
+            view_time = measure(lambda: create_sendgrid_bounced_view(request), 1)
+        task_time = measure(lambda: create_sendgrid_bounced(body), 1)
+
+        print(
+            '\nSendGrid, {} событий: сохранение в запросе {:.3f} с; ответ view {:.4f} с, '
+            'задача {:.3f} с ({} строк после удаления повторов)'.format(
+                self.events_count, inline_time, view_time, task_time, Bounced.objects.count(),
+            )
+        )
+        self.assertEqual(Bounced.objects.count(), self.events_count // 2)
+        self.assertLess(view_time, inline_time)
@@ -0,0 +1,180 @@
+import json
+import socket
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    def send_line(self, line):
+        self.wfile.write('{}\r\n'.format(line).encode('utf-8'))
+
+    def handle(self):
+        self.server.connections_count += 1
+        self.server.active_sockets.append(self.request)
+        self.send_line('220 localhost SMTP sink')
+        mail_from, rcpt_to = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                self.send_line('250-localhost')
+                self.send_line('250 AUTH PLAIN LOGIN')
+            elif verb == 'HELO':
+                self.send_line('250 localhost')
+            elif verb == 'AUTH':
+                self.server.auth_count += 1
+                self.send_line('235 Authentication successful')
+            elif verb == 'MAIL':
+                mail_from, rcpt_to = command[10:], []
+                self.send_line('250 OK')
+            elif verb == 'RCPT':
+                if 'reject' in command:
+                    self.send_line('550 Mailbox unavailable')
+                    continue
+                rcpt_to.append(command[8:])
+                self.send_line('250 OK')
+            elif verb == 'DATA':
+                if any('closing' in recipient for recipient in rcpt_to):
+                    self.send_line('421 Service not available, closing transmission channel')
+                    return
+                self.send_line('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for data_line in iter(self.rfile.readline, b''):
+                    if data_line == b'.\r\n':
+                        break
+                    data.append(data_line)
+                self.server.messages.append((mail_from, rcpt_to, b''.join(data)))
+                self.send_line('250 OK')
+            elif verb in ('RSET', 'NOOP'):
+                self.send_line('250 OK')
+            elif verb == 'QUIT':
+                self.send_line('221 Bye')
+                return
+            else:
+                self.send_line('502 Command not implemented')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """
+    Локальный SMTP сервер для тестов: сохраняет письма в messages,
+    отклоняет получателей, в адресе которых есть 'reject', и закрывает соединение кодом 421
+    на письмах получателям, в адресе которых есть 'closing'.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+        self.messages = []
+        self.connections_count = 0
+        self.auth_count = 0
+        self.active_sockets = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def drop_connections(self):
+        """Разрывает все открытые соединения, как это делает сервер по тайм-ауту."""
+        while self.active_sockets:
+            try:
+                self.active_sockets.pop().shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class UniSenderStandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.connections_count += 1
+
+    def read_body(self):
+        content_length = int(self.headers['Content-Length'])
+        if self.server.store_requests:
+            body = self.rfile.read(content_length)
+            self.server.requests.append(body)
+            return [recipient['email'] for recipient in json.loads(body.decode('utf-8'))['message']['recipients']]
+
+        while content_length:
+            content_length -= len(self.rfile.read(min(content_length, 64 * 1024)))
+        return []
+
+    def do_POST(self):
+        recipients = self.read_body()
+        with self.server.lock:
+            self.server.requests_count += 1
+            job_id = 'job-{}'.format(self.server.requests_count)
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        time.sleep(self.server.response_delay)
+        with self.server.lock:
+            self.server.in_flight -= 1
+        response = json.dumps({
+            'status': 'success',
+            'job_id': job_id,
+            'emails': recipients,
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class UniSenderStandIn(ThreadingHTTPServer):
+    """
+    Локальная замена UniSender API для тестов: принимает любые POST запросы
+    с keep-alive соединениями и отвечает успешной отправкой.
+    При store_requests=False тело запроса читается по частям и не сохраняется.
+    """
+    daemon_threads = True
+
+    def __init__(self, response_delay=0, store_requests=True):
+        super().__init__(('127.0.0.1', 0), UniSenderStandInHandler)
+        self.store_requests = store_requests
+        self.requests = []
+        self.requests_count = 0
+        self.connections_count = 0
+        self.response_delay = response_delay
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def handle_error(self, request, client_address):
+        # Клиент мог закрыть соединение по тайм-ауту, не дождавшись ответа
+        if not issubclass(sys.exc_info()[0], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
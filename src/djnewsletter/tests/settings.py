@@ -48,6 +48,12 @@ DATABASES = {
 
 SECRET_KEY = 'something-something'
 
+ROOT_URLCONF = 'djnewsletter.tests.urls'
+
+STATIC_URL = '/static/'
+
+DJNEWSLETTER_CONTENT_STORAGE = 'django.core.files.storage.FileSystemStorage'
+
 from celery import Celery
 
 # set the default Django settings module for the 'celery' program.
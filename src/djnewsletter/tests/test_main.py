@@ -1,21 +1,71 @@
-from datetime import datetime, timedelta
+import base64
+import importlib
+import io
+import json
+import os
+import pathlib
+import pickle
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from email.mime.base import MIMEBase
+from smtplib import SMTPRecipientsRefused, SMTPResponseException
 
 import mock
+import requests
+from django.apps import apps
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core import mail
-from django.db import transaction
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import DataError, OperationalError, connection, transaction
+from django.db.models import F, Sum
+from django.template.loader import get_template
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
 from django.test.utils import override_settings
+from django.urls import reverse
 
 from djnewsletter.analytics import Analytics
-from djnewsletter.helpers import send_email
+from djnewsletter.archive import get_content_cutoff
+from djnewsletter.attachments import encoded_attachments_cache, load_attachment, store_attachment
+from djnewsletter.bounced import create_sendgrid_bounced as create_sendgrid_bounced_events
+from djnewsletter.helpers import send_email, send_mass_email
 from djnewsletter.mail import DJNewsLetterEmailMessage
-from djnewsletter.models import Emails, EmailServers, Domains, Bounced
+from djnewsletter.mixins import ApproxCountPaginator, approx_count_cache
+from djnewsletter.models import (
+    Emails, EmailsArchive, EmailRecipients, EmailServers, DailyStatistics, Domains, Bounced, Unsubscribers,
+)
+from djnewsletter.ratelimit import CacheRateLimitStorage, rate_limiter, take_token
+from djnewsletter.rendering import template_cache
+from djnewsletter.rollup import rebuild_daily_statistics
+from djnewsletter.routing import email_servers_router
+from djnewsletter.smtp import smtp_connection_pool
+from djnewsletter.statuses import DeliveryStatus
+from djnewsletter.storage import ContentStorage, content_storage, load_bytes
+from djnewsletter.suppression import BloomFilter, suppression_index
+from djnewsletter.tasks import create_sendgrid_bounced as create_sendgrid_bounced_task
+from djnewsletter.tasks import get_retry_countdown, send_batch_async, send_batch_by_smtp, send_by_smtp
 from djnewsletter.tests.mixins import EmailTestsMixin
-from djnewsletter.unisender import UniSenderAPIClient
+from djnewsletter.tests.servers import SMTPSink, UniSenderStandIn
+from djnewsletter.unisender import Base64Content, StreamingJSONBody, UniSenderAPIClient, unisender_sessions
+from djnewsletter.views import create_sendgrid_bounced
+
 
+delivery_status_migration = importlib.import_module('djnewsletter.migrations.0009_emails_delivery_status')
+email_recipients_migration = importlib.import_module('djnewsletter.migrations.0010_emailrecipients')
+suppression_unique_migration = importlib.import_module('djnewsletter.migrations.0012_suppression_unique_together')
+unisender_failed_migration = importlib.import_module('djnewsletter.migrations.0017_emailrecipients_failed')
 
 class SimpleEmailTest(TestCase, EmailTestsMixin):
+    def setUp(self):
+        email_servers_router.invalidate()
+
     def test_send_email(self):
         self.send_simple_mail()
         self.assertEqual(len(mail.outbox), 1)
@@ -23,7 +73,7 @@ class SimpleEmailTest(TestCase, EmailTestsMixin):
         self.assertEqual(Emails.objects.count(), 0)
 
     @override_settings(EMAIL_BACKEND='djnewsletter.backends.EmailBackend')
-    @mock.patch('djnewsletter.tasks.get_connection')
+    @mock.patch('djnewsletter.smtp.get_connection')
     def test_send_email_djnewsletter_backend(self, mocked_get_connection):
         email_server = self.create_smtp_email_server()
         self.add_preferred_domain('email.com', email_server)
@@ -58,7 +108,7 @@ class DummyBackendDJNewsletterEmailMessageTests(TestCase):
 @override_settings(
     EMAIL_BACKEND='djnewsletter.backends.EmailBackend'
 )
-@mock.patch('djnewsletter.tasks.get_connection')
+@mock.patch('djnewsletter.smtp.get_connection')
 class EmailBackendDJNewsletterEmailMessageTests(TestCase, EmailTestsMixin):
     @classmethod
     def setUpTestData(cls):
@@ -66,6 +116,10 @@ class EmailBackendDJNewsletterEmailMessageTests(TestCase, EmailTestsMixin):
         cls.email_server = cls.create_smtp_email_server()
         cls.email_server.preferred_domains.add(domain)
 
+    def setUp(self):
+        email_servers_router.invalidate()
+        smtp_connection_pool.close_all()
+
     def test_send_email(self, mocked_get_connection):
         with mock.patch.object(transaction, 'on_commit', lambda f: f()):
             send_email(
@@ -247,6 +301,28 @@ class EmailBackendDJNewsletterEmailMessageTests(TestCase, EmailTestsMixin):
             self.assertEqual(email_instance.recipient, "['some@email_2.com', 'some@email_3.com', 'some@email_4.com']")
             self.assertEqual(email_instance.status, "{'status': 'success'}")
 
+    @override_settings(DJNEWSLETTER_UNISENDER_URL='http://test.url')
+    @mock.patch('djnewsletter.unisender.UniSenderAPIClient._send_request')
+    def test_unisender_failed_emails_are_stored_per_recipient(self, mocked_unisender, mocked_get_connection):
+        mocked_unisender.return_value = {
+            'status': 'success',
+            'job_id': 'job_id',
+            'emails': ['some@email_2.com'],
+            'failed_emails': {'other@email_2.com': 'unsubscribed'},
+        }
+        email_server_2 = self.create_unisender_email_server()
+        self.add_preferred_domain('email_2.com', email_server_2)
+        with mock.patch.object(transaction, 'on_commit', lambda f: f()):
+            send_email(subject='Subject here', body='body', to=['some@email_2.com', 'other@email_2.com'])
+
+        email_instance = Emails.objects.get()
+        self.assertEqual(email_instance.delivery_status, DeliveryStatus.SENT)
+        self.assertEqual(email_instance.email_remote_id, 'job_id')
+        self.assertDictEqual(
+            dict(email_instance.recipients.values_list('recipient', 'failed')),
+            {'some@email_2.com': False, 'other@email_2.com': True},
+        )
+
     @override_settings(SITE_ID=1)
     def test_send_email_to_first_server_with_site_id(self, mocked_get_connection):
         email_server_2 = self.create_smtp_email_server(
@@ -407,24 +483,19 @@ class EmailBackendDJNewsletterEmailMessageTests(TestCase, EmailTestsMixin):
                 to=['some@email.com', 'get@email.com'],
                 category='test_category',
             )
-            for server in mocked_get_connection.call_args_list:
-                server.assert_called_with(
-                    backend='django.core.mail.backends.smtp.EmailBackend',
-                    fail_silently=email_server_2.email_fail_silently,
-                    host=email_server_2.email_host,
-                    password=email_server_2.email_password,
-                    port=email_server_2.email_port,
-                    timeout=email_server_2.email_timeout,
-                    use_ssl=email_server_2.email_use_ssl,
-                    use_tls=email_server_2.email_use_tls,
-                    username=email_server_2.email_username,
-                )
-
-            self.assertEqual(Emails.objects.count(), 1)
+            # Получатели распределяются между серверами сайта поровну
+            self.assertListEqual(
+                [call.kwargs['host'] for call in mocked_get_connection.call_args_list],
+                [email_server_2.email_host, email_server_3.email_host],
+            )
 
-            email_instance = Emails.objects.first()
-            self.assertEqual(email_instance.recipient, "['some@email.com', 'get@email.com']")
-            self.assertEqual(email_instance.status, 'sent to user')
+            emails = Emails.objects.order_by('id')
+            self.assertEqual(emails.count(), 2)
+            self.assertEqual(emails[0].recipient, "['some@email.com']")
+            self.assertEqual(emails[0].used_server, email_server_2)
+            self.assertEqual(emails[1].recipient, "['get@email.com']")
+            self.assertEqual(emails[1].used_server, email_server_3)
+            self.assertEqual(emails[0].status, 'sent to user')
 
     @override_settings(SITE_ID=1)
     def test_send_any_email_on_site_id_or_site_id_and_preferred(self, mocked_get_connection):
@@ -456,8 +527,11 @@ class EmailBackendDJNewsletterEmailMessageTests(TestCase, EmailTestsMixin):
         self.assertEqual(mocked_get_connection.call_args_list[0].kwargs['host'], email_server_2.email_host)
         self.assertEqual(mocked_get_connection.call_args_list[1].kwargs['host'], email_server_3.email_host)
         self.assertEqual(emails.count(), 2)
-        self.assertEqual(emails[0].recipient, "['some@email.com', 'some3@data.ru']")
-        self.assertEqual(emails[1].recipient, "['some2@email_preferred.com', 'some4@email_preferred.com']")
+        # Остальные домены распределяются между обоими серверами сайта
+        self.assertEqual(emails[0].recipient, "['some@email.com']")
+        self.assertEqual(
+            emails[1].recipient, "['some2@email_preferred.com', 'some3@data.ru', 'some4@email_preferred.com']",
+        )
 
     @override_settings(SITE_ID=3)
     def test_site_not_found(self, mocked_get_connection):
@@ -515,9 +589,1065 @@ class EmailBackendDJNewsletterEmailMessageTests(TestCase, EmailTestsMixin):
             "['some@email.com', 'some2@email_preferred.com', 'some3@data.ru', 'some4@email_preferred.com']",
         )
 
+    @override_settings(DJNEWSLETTER_INTERVAL_SENDING_TO_RECIPIENT=24, DJNEWSLETTER_SUPPRESSION_CHUNK_SIZE=2)
+    def test_suppression(self, mocked_get_connection):
+        Bounced.objects.create(email='bounced@email.com', event='bounce', eventDateTime=datetime.now())
+        Bounced.objects.create(email='both@email.com', event='dropped', eventDateTime=datetime.now())
+        Bounced.objects.create(email='delivered@email.com', event='delivered', eventDateTime=datetime.now())
+        Unsubscribers.objects.create(email='unsubscribed@email.com', newsletter='newsletter')
+        Unsubscribers.objects.create(email='both@email.com', newsletter='newsletter')
+        Unsubscribers.objects.create(email='delivered@email.com', newsletter='other newsletter')
+        EmailRecipients.objects.create_for_emails([Emails.objects.create(
+            sender='email@example.com',
+            recipient=['recently@email.com'],
+            newsletter='newsletter',
+            status='sent to user',
+            delivery_status=DeliveryStatus.SENT,
+        )])
+        with mock.patch.object(transaction, 'on_commit', lambda f: f()), \
+                CaptureQueriesContext(connection) as context:
+            send_email(
+                subject='Subject here',
+                body='Here is the <b>message</b>.',
+                to=['bounced@email.com', 'unsubscribed@email.com', 'both@email.com', 'recently@email.com',
+                    'delivered@email.com'],
+                newsletter='newsletter',
+                headers={'List-Unsubscribe': '<mailto:unsubscribe@email.com>'},
+            )
+
+        # 3 записи 'did not send' и запись для отправки в очередь одним bulk_create
+        # + все получатели одним bulk_create в EmailRecipients
+        inserts = [
+            query for query in context.captured_queries
+            if query['sql'].startswith(
+                ('INSERT INTO "djnewsletter_emails"', 'INSERT INTO "djnewsletter_emailrecipients"'),
+            )
+        ]
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(EmailRecipients.objects.filter(email__sender='did not send').count(), 4)
+
+        not_sent = dict(Emails.objects.filter(sender='did not send').values_list('status', 'recipient'))
+        self.assertDictEqual(
+            dict(Emails.objects.filter(sender='did not send').values_list('delivery_status', 'recipient')),
+            {
+                DeliveryStatus.BOUNCED: "['bounced@email.com', 'both@email.com']",
+                DeliveryStatus.UNSUBSCRIBED: "['unsubscribed@email.com']",
+                DeliveryStatus.TOO_FREQUENT: "['recently@email.com']",
+            },
+        )
+        self.assertDictEqual(not_sent, {
+            'There were problems with the recipient this letter previously': "['bounced@email.com', 'both@email.com']",
+            'Don\'t sent, because user is unsubscribe': "['unsubscribed@email.com']",
+            'Letters are sent too frequently': "['recently@email.com']",
+        })
+        email_instance = Emails.objects.get(used_server=self.email_server)
+        self.assertEqual(email_instance.recipient, "['delivered@email.com']")
+        self.assertEqual(email_instance.delivery_status, DeliveryStatus.SENT)
+
+    @override_settings(DJNEWSLETTER_INTERVAL_SENDING_TO_RECIPIENT=24)
+    def test_interval_sending_counts_only_sent_emails(self, mocked_get_connection):
+        for delivery_status in (DeliveryStatus.QUEUED, DeliveryStatus.FAILED):
+            EmailRecipients.objects.create_for_emails([Emails.objects.create(
+                sender='email@example.com',
+                recipient=['recently@email.com'],
+                newsletter='newsletter',
+                status='sent to user',
+                delivery_status=delivery_status,
+            )])
+        with mock.patch.object(transaction, 'on_commit', lambda f: f()):
+            send_email(subject='Subject here', body='body', to=['recently@email.com'], newsletter='newsletter')
+        self.assertFalse(Emails.objects.filter(delivery_status=DeliveryStatus.TOO_FREQUENT).exists())
+        self.assertEqual(Emails.objects.filter(delivery_status=DeliveryStatus.SENT).count(), 1)
+
+    def test_email_recipients(self, mocked_get_connection):
+        with mock.patch.object(transaction, 'on_commit', lambda f: f()):
+            send_email(
+                subject='Subject here',
+                body='body',
+                to=['some@email.com', 'other@email.com'],
+                newsletter='newsletter',
+            )
+        email = Emails.objects.get()
+        self.assertListEqual(
+            list(EmailRecipients.objects.order_by('id').values_list(
+                'email', 'recipient', 'newsletter', 'sentDateTime',
+            )),
+            [
+                (email.pk, 'some@email.com', 'newsletter', email.createDateTime),
+                (email.pk, 'other@email.com', 'newsletter', email.createDateTime),
+            ],
+        )
+
+    def test_email_recipients_backfill(self, mocked_get_connection):
+        for recipient in ("['some@email.com', 'other@email.com']", "['some@email.com']", 'some@email.com'):
+            Emails.objects.create(sender='email@example.com', recipient=recipient, newsletter='newsletter', status='')
+        with mock.patch.object(email_recipients_migration, 'BATCH_SIZE', 2):
+            email_recipients_migration.backfill_email_recipients(apps, None)
+        self.assertListEqual(
+            list(EmailRecipients.objects.order_by('email_id', 'id').values_list('recipient', flat=True)),
+            ['some@email.com', 'other@email.com', 'some@email.com', 'some@email.com'],
+        )
+        self.assertFalse(EmailRecipients.objects.exclude(sentDateTime=F('email__createDateTime')).exists())
+
+    def test_delivery_status_backfill(self, mocked_get_connection):
+        statuses = [
+            'sent to queue',
+            'sent to user',
+            'Letters are sent too frequently',
+            str({'status': 'success', 'job_id': 'job_id', 'emails': ['some@email.com']}),
+            str({'status': 'error', 'message': 'error'}),
+            'Connection refused',
+        ]
+        for status in statuses:
+            Emails.objects.create(sender='email@example.com', recipient='some@email.com', status=status)
+        with mock.patch.object(delivery_status_migration, 'BATCH_SIZE', 2):
+            delivery_status_migration.backfill_delivery_status(apps, None)
+        self.assertListEqual(
+            list(Emails.objects.order_by('id').values_list('delivery_status', flat=True)),
+            [
+                DeliveryStatus.QUEUED,
+                DeliveryStatus.SENT,
+                DeliveryStatus.TOO_FREQUENT,
+                DeliveryStatus.SENT,
+                DeliveryStatus.FAILED,
+                DeliveryStatus.FAILED,
+            ],
+        )
+
+    def test_attachments_are_stored_once_for_all_routes(self, mocked_get_connection):
+        email_server_2 = self.create_smtp_email_server(email_host='email_host_2')
+        self.add_preferred_domain('email_2.com', email_server_2)
+        attachment = ('file.pdf', b'x' * 1024, 'application/pdf')
+        with tempfile.TemporaryDirectory() as media_root, self.settings(MEDIA_ROOT=media_root), \
+                mock.patch.object(transaction, 'on_commit', lambda f: f()), \
+                mock.patch.object(send_by_smtp, 'apply_async', wraps=send_by_smtp.apply_async) as apply_async:
+            for idx in range(2):
+                send_email(
+                    subject='Subject here',
+                    body='Here is the <b>message</b>.',
+                    to=['some@email.com', 'some@email_2.com'],
+                    attachments=[attachment, ('copy.pdf', attachment[1], 'application/pdf')],
+                )
+            self.assertEqual(len(os.listdir(os.path.join(media_root, 'djnewsletter', 'attachments'))), 1)
+
+        self.assertEqual(apply_async.call_count, 4)
+        payloads = [call[1]['args'][0] for call in apply_async.call_args_list]
+        self.assertTrue(all(payload['attachments'] == payloads[0]['attachments'] for payload in payloads))
+        self.assertListEqual(
+            [payload['recipients'] for payload in payloads],
+            [['some@email.com'], ['some@email_2.com']] * 2,
+        )
+        self.assertLess(len(pickle.dumps(payloads[0])), len(attachment[1]))
+
+        sent_messages = [call[0][0][0] for call in mocked_get_connection.return_value.send_messages.call_args_list]
+        self.assertEqual(len(sent_messages), 4)
+        for message in sent_messages:
+            self.assertEqual(message.subject, 'Subject here')
+            self.assertListEqual(
+                [mime_part.get_filename() for mime_part in message.attachments],
+                ['file.pdf', 'copy.pdf'],
+            )
+            self.assertEqual(message.attachments[0].get_payload(decode=True), attachment[1])
+        self.assertTrue(all(email.status == 'sent to user' for email in Emails.objects.all()))
+
+    def test_routing_table_is_built_once(self, mocked_get_connection):
+        self.create_smtp_email_server(
+            email_default_from='email_2@example.com',
+            email_host='email_host_2',
+            main=True,
+        )
+        to = ['user_{}@email_{}.com'.format(idx, idx % 50) for idx in range(200)] + ['some@email.com']
+        with mock.patch.object(transaction, 'on_commit', lambda f: f()):
+            send_email(subject='Subject here', body='body', to=to)
+            # savepoint, INSERT в Emails, SELECT id и UPDATE метки (БД не возвращает id из bulk_create),
+            # 2 INSERT в EmailRecipients (ограничение SQLite на количество параметров), 2 UPDATE в DailyStatistics,
+            # release savepoint - маршрутизация без запросов к EmailServers; по 5 запросов на каждую из 2 задач
+            # (загрузка Emails и EmailServers, UPDATE статуса, 2 UPDATE в DailyStatistics)
+            with self.assertNumQueries(19):
+                send_email(subject='Subject here', body='body', to=to)
+
+    def test_bulk_create_with_ids(self, mocked_get_connection):
+        Emails.objects.create(recipient='other@email.com', status='', email_remote_id='remote-id')
+        emails = [Emails(recipient='user_{}@email.com'.format(idx), status='') for idx in range(5)]
+        with self.assertNumQueries(1 if connection.features.can_return_ids_from_bulk_insert else 3):
+            Emails.objects.bulk_create_with_ids(emails)
+        self.assertListEqual(
+            [(email.pk, email.recipient) for email in emails],
+            list(Emails.objects.exclude(recipient='other@email.com').order_by('id').values_list('id', 'recipient')),
+        )
+        self.assertListEqual(
+            list(Emails.objects.exclude(email_remote_id=None).values_list('email_remote_id', flat=True)),
+            ['remote-id'],
+        )
+        self.assertTrue(all(email.email_remote_id is None for email in emails))
+
+    def test_routing_table_invalidated_on_changes(self, mocked_get_connection):
+        table = email_servers_router.get_table()
+        self.assertEqual(table.get_email_server('email.com'), self.email_server)
+        self.assertIsNone(table.get_email_server('other.com'))
+
+        self.email_server.main = True
+        self.email_server.save(update_fields=('main',))
+        self.assertEqual(email_servers_router.get_email_server('other.com'), self.email_server)
+
+        self.email_server.preferred_domains.clear()
+        email_server_2 = self.create_smtp_email_server(email_host='email_host_2')
+        self.add_preferred_domain('email.com', email_server_2)
+        self.assertEqual(email_servers_router.get_email_server('email.com'), email_server_2)
+
+        site = Site.objects.get(id=1)
+        email_server_2.sites.add(site)
+        self.assertEqual(email_servers_router.get_email_server('email.com'), self.email_server)
+        self.assertEqual(email_servers_router.get_email_server('email.com', site), email_server_2)
+
+    def test_weighted_balancing(self, mocked_get_connection):
+        email_servers = [
+            self.create_smtp_email_server(email_host='email_host_{}'.format(weight), main=True)
+            for weight in (1, 2, 3, 0)
+        ]
+        for weight, email_server in zip((1, 2, 3, 0), email_servers):
+            email_server.weight = weight
+            email_server.save()
+
+        table = email_servers_router.get_table()
+        selected = [table.get_email_server('other.com') for _ in range(60)]
+        self.assertListEqual(
+            [selected.count(email_server) for email_server in email_servers],
+            [10, 20, 30, 0],
+        )
+        # Плавный перебор: сервер с наибольшим весом не выбирается больше 2 раз подряд
+        self.assertFalse(any(selected[idx:idx + 3] == [email_servers[2]] * 3 for idx in range(len(selected))))
+        # Предпочтительный домен по-прежнему важнее основных серверов
+        self.assertEqual({table.get_email_server('email.com') for _ in range(5)}, {self.email_server})
+
+    def test_recipients_are_split_between_servers(self, mocked_get_connection):
+        email_servers = [
+            self.create_smtp_email_server(email_host='email_host_{}'.format(idx), main=True) for idx in range(2)
+        ]
+        to = ['user_{}@other.com'.format(idx) for idx in range(10)]
+        with mock.patch.object(transaction, 'on_commit', lambda f: f()):
+            send_email(subject='Subject here', body='body', to=to)
+
+        routes = dict(Emails.objects.values_list('used_server', 'recipient'))
+        self.assertEqual(set(routes), {email_server.pk for email_server in email_servers})
+        self.assertEqual(
+            sorted(len(EmailRecipients.parse_recipients(recipients)) for recipients in routes.values()), [5, 5],
+        )
+
+
+@override_settings(EMAIL_BACKEND='djnewsletter.backends.EmailBackend')
+@mock.patch('djnewsletter.smtp.get_connection')
+class SendMassEmailTests(TestCase, EmailTestsMixin):
+    @classmethod
+    def setUpTestData(cls):
+        cls.email_server = cls.create_smtp_email_server(main=True)
+
+    def setUp(self):
+        email_servers_router.invalidate()
+
+    def test_send_mass_email_by_chunks(self, mocked_get_connection):
+        recipients = ('user_{}@email.com'.format(idx) for idx in range(25))
+        with mock.patch.object(transaction, 'on_commit', lambda f: f()):
+            count = send_mass_email(
+                recipients,
+                chunk_size=10,
+                subject='Subject here',
+                body='Here is the <b>message</b>.',
+                newsletter='newsletter',
+            )
+        self.assertEqual(count, 25)
+        self.assertEqual(mocked_get_connection.call_count, 3)
+        emails = Emails.objects.order_by('id')
+        self.assertEqual(emails.count(), 3)
+        self.assertEqual(emails[2].recipient, str(['user_{}@email.com'.format(idx) for idx in range(20, 25)]))
+        self.assertTrue(all(email.status == 'sent to user' for email in emails))
+
+    def test_send_mass_email_from_queryset_with_recipient_context(self, mocked_get_connection):
+        for idx in range(3):
+            Bounced.objects.create(email='user_{}@email.com'.format(idx), event='open', eventDateTime=datetime.now())
+        with mock.patch.object(transaction, 'on_commit', lambda f: f()):
+            send_mass_email(
+                Bounced.objects.order_by('id').values_list('email', flat=True),
+                get_recipient_context=lambda email: {'email': email},
+                chunk_size=2,
+                subject='Subject here',
+                template='email/test_email.html',
+                context={'username': 'username'},
+            )
+        emails = Emails.objects.order_by('id')
+        self.assertEqual(emails.count(), 3)
+        for idx, email in enumerate(emails):
+            self.assertEqual(email.recipient, "['user_{}@email.com']".format(idx))
+            self.assertIn('Электронная почта: user_{}@email.com'.format(idx), email.body)
+            self.assertIn('Имя пользователя: username', email.body)
+
+    def test_recipient_context_suppression_by_chunk(self, mocked_get_connection):
+        recipients = ['user_{}@email.com'.format(idx) for idx in range(10)]
+        for recipient in recipients[:3]:
+            Bounced.objects.create(email=recipient, event='bounce', eventDateTime=datetime.now())
+        rendered = []
+
+        def get_recipient_context(email):
+            rendered.append(email)
+            return {'email': email}
+
+        with mock.patch.object(transaction, 'on_commit', lambda f: f()), \
+                CaptureQueriesContext(connection) as context:
+            send_mass_email(
+                recipients,
+                get_recipient_context=get_recipient_context,
+                chunk_size=5,
+                subject='Subject here',
+                template='email/test_email.html',
+                newsletter='newsletter',
+            )
+        # Один запрос подавления на пачку, персональные письма только для оставшихся получателей
+        suppression_queries = [query for query in context.captured_queries if 'djnewsletter_bounced' in query['sql']]
+        self.assertEqual(len(suppression_queries), 2)
+        self.assertListEqual(rendered, recipients[3:])
+        self.assertEqual(
+            Emails.objects.get(sender='did not send').recipient, str(recipients[:3]),
+        )
+        self.assertEqual(Emails.objects.filter(delivery_status=DeliveryStatus.SENT).count(), 7)
+        self.assertEqual(EmailRecipients.objects.filter(email__sender='did not send').count(), 3)
+
+
+class StoredAttachmentTests(TestCase):
+    def setUp(self):
+        encoded_attachments_cache.clear()
+        self.addCleanup(encoded_attachments_cache.clear)
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media_root_settings = self.settings(MEDIA_ROOT=media_root.name)
+        media_root_settings.enable()
+        self.addCleanup(media_root_settings.disable)
+
+    def test_attachment_is_encoded_once(self):
+        content = bytes(range(256)) * 100
+        stored_attachment = load_attachment(store_attachment(('file.pdf', content, 'application/pdf')))
+        with mock.patch('djnewsletter.attachments.load_bytes', wraps=load_bytes) as mocked_load_bytes:
+            mime_parts = [stored_attachment.get_mime_part(DJNewsLetterEmailMessage()) for _ in range(3)]
+        self.assertEqual(mocked_load_bytes.call_count, 1)
+        self.assertIsNot(mime_parts[0], mime_parts[1])
+        for mime_part in mime_parts:
+            self.assertEqual(mime_part.get_payload(decode=True), content)
+            self.assertEqual(mime_part.get_filename(), 'file.pdf')
+
+    def test_cached_mime_part_headers_are_not_shared(self):
+        stored_attachment = load_attachment(store_attachment(('файл.txt', 'текст', 'text/plain')))
+        first, second = [stored_attachment.get_mime_part(DJNewsLetterEmailMessage()) for _ in range(2)]
+        # В кеше только строки: заголовки и закодированное содержимое
+        ((headers, payload), _), = encoded_attachments_cache._items.values()
+        self.assertIsInstance(payload, str)
+        self.assertTrue(all(isinstance(value, str) for _, value in headers))
+
+        first.replace_header('Content-ID', '<changed>')
+        self.assertNotEqual(second['Content-ID'], '<changed>')
+        self.assertEqual(second.get_payload(decode=True).decode('utf-8'), 'текст')
+        self.assertEqual(second.as_bytes(), stored_attachment.get_mime_part(DJNewsLetterEmailMessage()).as_bytes())
+
+    @override_settings(DJNEWSLETTER_ATTACHMENTS_CACHE_SIZE=3000)
+    def test_cache_size_is_bounded(self):
+        stored_attachments = [
+            load_attachment(store_attachment(('file_{}.bin'.format(idx), bytes([idx]) * 1000, None)))
+            for idx in range(5)
+        ]
+        for stored_attachment in stored_attachments:
+            stored_attachment.get_mime_part(DJNewsLetterEmailMessage())
+        self.assertLessEqual(encoded_attachments_cache.size, 3000)
+        mime_part = stored_attachments[-1].get_mime_part(DJNewsLetterEmailMessage())
+        self.assertEqual(mime_part.get_payload(decode=True), bytes([4]) * 1000)
+
+    def test_mime_part_attachment(self):
+        mime_part = DJNewsLetterEmailMessage().create_mime_attachment('file.txt', 'текст', 'text/plain')
+        ref = store_attachment(mime_part)
+        # MIME часть хранится в виде письма, а не pickle
+        self.assertEqual(load_bytes(ref['key']), mime_part.as_bytes())
+        loaded_mime_part = load_attachment(ref)
+        self.assertIsInstance(loaded_mime_part, MIMEBase)
+        self.assertEqual(loaded_mime_part.as_bytes(), mime_part.as_bytes())
+        self.assertEqual(loaded_mime_part.get_payload(decode=True).decode('utf-8'), 'текст')
+
+    @override_settings(DJNEWSLETTER_CONTENT_STORAGE=None)
+    def test_content_storage_is_required(self):
+        with self.assertRaises(ImproperlyConfigured):
+            ContentStorage()._setup()
+
+    def test_expired_content_is_deleted(self):
+        today = date(2026, 10, 17)
+        refs = {}
+        for days in (0, 6, 7, 8, 20):
+            with mock.patch('djnewsletter.storage.get_today', return_value=today - timedelta(days=days)):
+                refs[days] = store_attachment(('file.txt', 'content {}'.format(days), 'text/plain'))
+        mime_part = DJNewsLetterEmailMessage().create_mime_attachment('file.txt', 'text', 'text/plain')
+        with mock.patch('djnewsletter.storage.get_today', return_value=today - timedelta(days=30)):
+            refs[30] = store_attachment(mime_part)
+
+        self.assertEqual(get_content_cutoff(today), today - timedelta(days=7))
+        # Письмо, застрявшее в очереди дольше DJNEWSLETTER_CONTENT_QUEUED_MAX_AGE, очистку не задерживает
+        stuck_email = Emails.objects.create(
+            recipient='stuck@email.com', status='', delivery_status=DeliveryStatus.QUEUED,
+        )
+        stuck = datetime.combine(today, datetime.min.time()) - timedelta(days=60)
+        Emails.objects.filter(pk=stuck_email.pk).update(createDateTime=stuck)
+        self.assertEqual(get_content_cutoff(today), today - timedelta(days=7))
+        # Письмо в очереди: содержимое со дня накануне его создания сохраняется
+        email = Emails.objects.create(recipient='some@email.com', status='', delivery_status=DeliveryStatus.QUEUED)
+        created = datetime.combine(today, datetime.min.time()) - timedelta(days=19)
+        Emails.objects.filter(pk=email.pk).update(createDateTime=created)
+        self.assertEqual(get_content_cutoff(today), today - timedelta(days=20))
+        Emails.objects.filter(pk=email.pk).update(delivery_status=DeliveryStatus.SENT)
+
+        with mock.patch('djnewsletter.management.commands.delete_expired_content.get_content_cutoff',
+                        side_effect=lambda: get_content_cutoff(today)):
+            call_command('delete_expired_content', stdout=io.StringIO())
+        self.assertListEqual(
+            [days for days, ref in sorted(refs.items()) if content_storage.exists(ref['key'])],
+            [0, 6, 7],
+        )
+        self.assertFalse(content_storage.exists(refs[30]['key'].rsplit('/', 1)[0]))
+
+
+class TemplateCacheTests(TestCase):
+    def setUp(self):
+        template_cache.clear()
+        self.addCleanup(template_cache.clear)
+
+    def render(self, template='email/test_email.html', **context):
+        email_message = DJNewsLetterEmailMessage(template=template, context=context)
+        email_message.render_body()
+        return email_message.body
+
+    @override_settings(DJNEWSLETTER_LETTER_CONTEXT={'username': 'default'})
+    def test_letter_context_is_not_mutated(self):
+        body = self.render(username='username', email='user@email.com')
+        self.assertIn('Имя пользователя: username', body)
+        self.assertIn('Электронная почта: user@email.com', body)
+        self.assertEqual(settings.DJNEWSLETTER_LETTER_CONTEXT, {'username': 'default'})
+
+        # Контекст предыдущего письма не попадает в следующее
+        body = self.render()
+        self.assertIn('Имя пользователя: default', body)
+        self.assertIn('Электронная почта: </li>', body)
+
+    def test_template_is_compiled_once(self):
+        with mock.patch('djnewsletter.rendering.get_template', wraps=get_template) as mocked_get_template:
+            for idx in range(5):
+                self.assertIn('Имя пользователя: user_{}'.format(idx), self.render(username='user_{}'.format(idx)))
+        self.assertEqual(mocked_get_template.call_count, 1)
+
+    def test_template_is_reloaded_on_change_in_debug(self):
+        templates_dir = tempfile.mkdtemp()
+        template_path = os.path.join(templates_dir, 'letter.html')
+        with open(template_path, 'w') as template_file:
+            template_file.write('Привет, {{ username }}')
+        templates = [{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'DIRS': [templates_dir],
+        }]
+        with override_settings(TEMPLATES=templates, DEBUG=True):
+            self.assertEqual(self.render('letter.html', username='username'), 'Привет, username')
+            with open(template_path, 'w') as template_file:
+                template_file.write('Здравствуйте, {{ username }}')
+            os.utime(template_path, (time.time() + 10, time.time() + 10))
+            self.assertEqual(self.render('letter.html', username='username'), 'Здравствуйте, username')
+
+
+@override_settings(EMAIL_BACKEND='djnewsletter.backends.EmailBackend')
+class SMTPConnectionPoolTests(TestCase, EmailTestsMixin):
+    def setUp(self):
+        email_servers_router.invalidate()
+        smtp_connection_pool.close_all()
+        self.smtp_sink = SMTPSink()
+        self.smtp_sink.__enter__()
+        self.addCleanup(self.smtp_sink.__exit__)
+        self.addCleanup(smtp_connection_pool.close_all)
+        self.email_server = self.create_smtp_email_server(
+            email_host='127.0.0.1',
+            email_port=self.smtp_sink.port,
+            email_use_ssl=False,
+            email_fail_silently=False,
+            email_timeout=5,
+            main=True,
+        )
+
+    def send(self, count):
+        with mock.patch.object(transaction, 'on_commit', lambda f: f()):
+            for idx in range(count):
+                send_email(subject='Subject {}'.format(idx), body='body', to=['user_{}@email.com'.format(idx)])
+
+    def test_connection_is_reused(self):
+        self.send(5)
+        self.assertEqual(len(self.smtp_sink.messages), 5)
+        self.assertEqual(self.smtp_sink.connections_count, 1)
+        self.assertEqual(self.smtp_sink.auth_count, 1)
+        self.assertEqual(Emails.objects.filter(status='sent to user').count(), 5)
+        self.assertEqual(Emails.objects.filter(delivery_status=DeliveryStatus.SENT).count(), 5)
+
+    @override_settings(DJNEWSLETTER_SMTP_POOL_MAX_MESSAGES=2)
+    def test_max_messages_per_connection(self):
+        self.send(5)
+        self.assertEqual(len(self.smtp_sink.messages), 5)
+        self.assertEqual(self.smtp_sink.connections_count, 3)
+
+    def test_idle_timeout(self):
+        self.send(1)
+        with override_settings(DJNEWSLETTER_SMTP_POOL_IDLE_TIMEOUT=0):
+            self.send(1)
+        self.assertEqual(len(self.smtp_sink.messages), 2)
+        self.assertEqual(self.smtp_sink.connections_count, 2)
+
+    def test_reconnect_when_server_disconnected(self):
+        self.send(1)
+        self.smtp_sink.drop_connections()
+        self.send(1)
+        self.assertEqual(len(self.smtp_sink.messages), 2)
+        self.assertEqual(self.smtp_sink.connections_count, 2)
+        self.assertEqual(Emails.objects.filter(status='sent to user').count(), 2)
+
+    @override_settings(DJNEWSLETTER_TASK_BATCH_SIZE=3)
+    def test_batch_task(self):
+        recipients = ['user_{}@email.com'.format(idx) for idx in range(7)]
+        recipients[4] = 'reject@email.com'
+        apply_async = mock.patch.object(send_batch_by_smtp, 'apply_async', wraps=send_batch_by_smtp.apply_async)
+        with mock.patch.object(transaction, 'on_commit', lambda f: f()), apply_async as apply_async:
+            send_mass_email(
+                recipients,
+                get_recipient_context=lambda email: {'email': email},
+                subject='Subject here',
+                template='email/test_email.html',
+            )
+        self.assertListEqual([len(call[1]['args'][0]) for call in apply_async.call_args_list], [3, 3, 1])
+        self.assertEqual(len(self.smtp_sink.messages), 6)
+        self.assertEqual(self.smtp_sink.connections_count, 1)
+        statuses = dict(Emails.objects.values_list('recipient', 'status'))
+        self.assertIn('reject@email.com', statuses.pop("['reject@email.com']"))
+        self.assertSetEqual(set(statuses.values()), {'sent to user'})
+
+    def test_connection_is_discarded_on_server_error(self):
+        email_message = DJNewsLetterEmailMessage(subject='Subject', body='body', to=['closing@email.com'])
+        with self.assertRaises(SMTPResponseException) as raised:
+            smtp_connection_pool.send_messages(self.email_server, [email_message])
+        self.assertEqual(raised.exception.smtp_code, 421)
+        # Соединение, на котором сервер ответил ошибкой, не возвращается в пул
+        self.assertListEqual(smtp_connection_pool._idle_connections[self.email_server.pk], [])
+
+        email_message = DJNewsLetterEmailMessage(subject='Subject', body='body', to=['reject@email.com'])
+        with self.assertRaises(SMTPRecipientsRefused):
+            smtp_connection_pool.send_messages(self.email_server, [email_message])
+        self.assertEqual(len(smtp_connection_pool._idle_connections[self.email_server.pk]), 1)
+
+        self.send(1)
+        self.assertEqual(len(self.smtp_sink.messages), 1)
+        self.assertEqual(self.smtp_sink.connections_count, 2)
+
+    @override_settings(DJNEWSLETTER_TASK_BATCH_SIZE=5, DJNEWSLETTER_SMTP_STATUS_FLUSH_SIZE=2)
+    def test_batch_task_statuses_are_flushed(self):
+        recipients = ['user_{}@email.com'.format(idx) for idx in range(5)]
+        sent_counts = []
+
+        def deliver(email_message):
+            sent_counts.append(Emails.objects.filter(delivery_status=DeliveryStatus.SENT).count())
+            return DeliveryStatus.SENT, 'sent to user', None
+
+        with mock.patch.object(transaction, 'on_commit', lambda f: f()), \
+                mock.patch('djnewsletter.tasks.deliver_by_smtp', side_effect=deliver):
+            send_mass_email(recipients, get_recipient_context=lambda email: {}, subject='Subject', body='body')
+        # Статусы сохраняются по 2 письма, а не после отправки всей пачки
+        self.assertListEqual(sent_counts, [0, 0, 2, 2, 4])
+        self.assertEqual(Emails.objects.filter(delivery_status=DeliveryStatus.SENT).count(), 5)
+
+    @override_settings(DJNEWSLETTER_SMTP_POOL=False)
+    def test_pool_disabled(self):
+        self.send(3)
+        self.assertEqual(len(self.smtp_sink.messages), 3)
+        self.assertEqual(self.smtp_sink.connections_count, 3)
+
+
+@override_settings(EMAIL_BACKEND='djnewsletter.backends.EmailBackend', DJNEWSLETTER_ASYNC_ENGINE=True)
+class AsyncDeliveryEngineTests(TestCase, EmailTestsMixin):
+    def setUp(self):
+        email_servers_router.invalidate()
+        smtp_connection_pool.close_all()
+        unisender_sessions.close_all()
+        self.addCleanup(smtp_connection_pool.close_all)
+        self.addCleanup(unisender_sessions.close_all)
+        self.smtp_sink = SMTPSink().__enter__()
+        self.addCleanup(self.smtp_sink.__exit__)
+        self.smtp_server = self.create_smtp_email_server(
+            email_host='127.0.0.1',
+            email_port=self.smtp_sink.port,
+            email_use_ssl=False,
+            email_fail_silently=False,
+            email_timeout=5,
+            main=True,
+        )
+        self.unisender_server = self.create_unisender_email_server()
+        self.add_preferred_domain('unisender.com', self.unisender_server)
+
+    def send(self, recipients):
+        with mock.patch.object(transaction, 'on_commit', lambda f: f()):
+            send_mass_email(
+                recipients,
+                get_recipient_context=lambda email: {'email': email},
+                subject='Subject here',
+                template='email/test_email.html',
+            )
+
+    def test_send_by_smtp_and_unisender(self):
+        recipients = ['user_{}@{}'.format(idx, ['email.com', 'unisender.com'][idx % 2]) for idx in range(20)]
+        recipients[2] = 'reject@email.com'
+        with UniSenderStandIn() as stand_in, self.settings(DJNEWSLETTER_UNISENDER_URL=stand_in.url):
+            self.send(recipients)
+
+        self.assertEqual(len(self.smtp_sink.messages), 9)
+        self.assertEqual(len(stand_in.requests), 10)
+        smtp_statuses = dict(Emails.objects.filter(used_server=self.smtp_server).values_list('recipient', 'status'))
+        self.assertIn('reject@email.com', smtp_statuses.pop("['reject@email.com']"))
+        self.assertSetEqual(set(smtp_statuses.values()), {'sent to user'})
+        for email in Emails.objects.filter(used_server=self.unisender_server):
+            self.assertIn("'status': 'success'", email.status)
+            self.assertTrue(email.email_remote_id.startswith('job-'))
+
+    @override_settings(DJNEWSLETTER_ASYNC_SERVER_CONCURRENCY=3)
+    def test_server_concurrency(self):
+        recipients = ['user_{}@unisender.com'.format(idx) for idx in range(9)]
+        with UniSenderStandIn(response_delay=0.2) as stand_in, self.settings(DJNEWSLETTER_UNISENDER_URL=stand_in.url):
+            started_at = time.monotonic()
+            self.send(recipients)
+            elapsed = time.monotonic() - started_at
+
+        self.assertEqual(len(stand_in.requests), 9)
+        self.assertEqual(stand_in.max_in_flight, 3)
+        self.assertLess(elapsed, 9 * 0.2)
+
+
+@override_settings(EMAIL_BACKEND='djnewsletter.backends.EmailBackend')
+class RateLimitTests(TestCase, EmailTestsMixin):
+    def setUp(self):
+        email_servers_router.invalidate()
+        smtp_connection_pool.close_all()
+        cache.clear()
+        rate_limiter.reset()
+        self.addCleanup(smtp_connection_pool.close_all)
+        self.addCleanup(cache.clear)
+        self.smtp_sink = SMTPSink().__enter__()
+        self.addCleanup(self.smtp_sink.__exit__)
+        self.email_server = self.create_smtp_email_server(
+            email_host='127.0.0.1',
+            email_port=self.smtp_sink.port,
+            email_use_ssl=False,
+            email_fail_silently=False,
+            email_timeout=5,
+            main=True,
+        )
+        self.email_server.send_rate = 60
+        self.email_server.send_burst = 2
+        self.email_server.save()
+
+    def send(self, count):
+        with mock.patch.object(transaction, 'on_commit', lambda f: f()):
+            for idx in range(count):
+                send_email(subject='Subject {}'.format(idx), body='body', to=['user_{}@email.com'.format(idx)])
+
+    def get_statuses(self):
+        return list(Emails.objects.order_by('id').values_list('delivery_status', flat=True))
+
+    def test_take_token(self):
+        state, wait = take_token(None, rate=2, capacity=2, now=100)
+        self.assertEqual((state, wait), ((1, 100), 0))
+        state, wait = take_token(state, rate=2, capacity=2, now=100)
+        self.assertEqual((state, wait), ((0, 100), 0))
+        state, wait = take_token(state, rate=2, capacity=2, now=100.25)
+        self.assertEqual((state, wait), ((-0.5, 100.25), 0.25))
+        # Токен в счёт будущих: следующее письмо на 1 / rate секунд позже
+        state, wait = take_token(state, rate=2, capacity=2, now=100.25)
+        self.assertEqual((state, wait), ((-1.5, 100.25), 0.75))
+        state, wait = take_token(state, rate=2, capacity=2, now=110)
+        self.assertEqual((state, wait), ((1, 110), 0))
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'rate_limit': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'rate_limit_cache'},
+    }, DJNEWSLETTER_RATE_LIMIT_CACHE='rate_limit')
+    def test_storages(self):
+        call_command('createcachetable', verbosity=0)
+        for storage in ('db', 'cache', 'local'):
+            with self.settings(DJNEWSLETTER_RATE_LIMIT_STORAGE=storage):
+                waits = [rate_limiter.acquire(self.email_server) for _ in range(4)]
+            self.assertEqual(waits[:2], [0, 0])
+            self.assertAlmostEqual(waits[2], 1, places=1)
+            self.assertAlmostEqual(waits[3], 2, places=1)
+
+    def test_unshared_cache_is_rejected(self):
+        for backend in ('locmem.LocMemCache', 'dummy.DummyCache', 'filebased.FileBasedCache'):
+            with self.settings(CACHES={
+                'default': {'BACKEND': 'django.core.cache.backends.{}'.format(backend), 'LOCATION': '/tmp/cache'},
+            }), self.assertRaises(ImproperlyConfigured):
+                CacheRateLimitStorage()
+
+    def test_locked_bucket(self):
+        with mock.patch.object(CacheRateLimitStorage, '__init__', return_value=None):
+            storage = CacheRateLimitStorage()
+        key = rate_limiter.get_key(self.email_server)
+        cache.add('{}:lock'.format(key), 'other')
+        with mock.patch.object(CacheRateLimitStorage, 'lock_delay', 0):
+            self.assertIsNone(storage.take(key, rate=1, capacity=1))
+        # Блокировка другого воркера не удаляется
+        self.assertEqual(cache.get('{}:lock'.format(key)), 'other')
+
+        with mock.patch.object(rate_limiter, 'get_storage', return_value=storage):
+            payload = {}
+            self.assertEqual(rate_limiter.reserve(self.email_server, payload, max_wait=1), 2)
+            self.assertDictEqual(payload, {})
+
+    def test_expired_lock_of_other_worker_is_kept(self):
+        with mock.patch.object(CacheRateLimitStorage, '__init__', return_value=None):
+            storage = CacheRateLimitStorage()
+        key = rate_limiter.get_key(self.email_server)
+        lock_key = '{}:lock'.format(key)
+
+        def take_token_after_lock_expired(*args):
+            # Блокировка истекла, и её взял другой воркер
+            cache.set(lock_key, 'other')
+            return take_token(*args)
+
+        with mock.patch('djnewsletter.ratelimit.take_token', side_effect=take_token_after_lock_expired):
+            self.assertEqual(storage.take(key, rate=1, capacity=1), 0)
+        self.assertEqual(cache.get(lock_key), 'other')
+
+    def test_server_without_limit(self):
+        self.email_server.send_rate = None
+        self.assertEqual([rate_limiter.acquire(self.email_server) for _ in range(10)], [0] * 10)
+
+    @override_settings(DJNEWSLETTER_RATE_LIMIT_MAX_SLEEP=0)
+    def test_rate_limited_task_is_rescheduled(self):
+        with mock.patch('djnewsletter.tasks.reschedule') as reschedule:
+            self.send(5)
+
+        self.assertEqual(len(self.smtp_sink.messages), 2)
+        self.assertEqual(self.get_statuses(), [DeliveryStatus.SENT] * 2 + [DeliveryStatus.QUEUED] * 3)
+        self.assertTrue(all(call[0][0] is send_by_smtp for call in reschedule.call_args_list))
+        self.assertEqual(
+            [call[0][1]['recipients'] for call in reschedule.call_args_list],
+            [['user_{}@email.com'.format(idx)] for idx in (2, 3, 4)],
+        )
+        # Отложенные задачи получают время отправки по очереди и не просыпаются одновременно
+        self.assertEqual([round(call[0][2]) for call in reschedule.call_args_list], [1, 2, 3])
+
+    @override_settings(DJNEWSLETTER_RATE_LIMIT_MAX_SLEEP=0)
+    def test_rescheduled_task_uses_reserved_token(self):
+        with mock.patch('djnewsletter.tasks.reschedule') as reschedule:
+            self.send(3)
+        payload = reschedule.call_args[0][1]
+        payload[rate_limiter.payload_key] = time.time() - 1
+
+        with mock.patch.object(rate_limiter, 'acquire') as acquire:
+            send_by_smtp(payload)
+        self.assertFalse(acquire.called)
+        self.assertEqual(len(self.smtp_sink.messages), 3)
+        self.assertEqual(self.get_statuses(), [DeliveryStatus.SENT] * 3)
+        self.assertNotIn(rate_limiter.payload_key, payload)
+
+    def test_short_wait_sleeps_in_task(self):
+        with mock.patch('djnewsletter.tasks.reschedule') as reschedule, \
+                mock.patch('djnewsletter.tasks.time.sleep') as sleep:
+            self.send(3)
+        self.assertFalse(reschedule.called)
+        self.assertTrue(0 < sleep.call_args[0][0] <= 1)
+        self.assertEqual(self.get_statuses(), [DeliveryStatus.SENT] * 3)
+
+    def test_eager_task_waits_for_token(self):
+        self.email_server.send_rate = 600
+        self.email_server.save()
+        started_at = time.monotonic()
+        self.send(3)
+
+        self.assertEqual(len(self.smtp_sink.messages), 3)
+        self.assertEqual(self.get_statuses(), [DeliveryStatus.SENT] * 3)
+        self.assertGreater(time.monotonic() - started_at, 0.05)
+
+    @override_settings(DJNEWSLETTER_TASK_BATCH_SIZE=5, DJNEWSLETTER_RATE_LIMIT_MAX_SLEEP=0)
+    def test_rate_limited_batch_part_is_rescheduled(self):
+        with mock.patch('djnewsletter.tasks.reschedule') as reschedule, \
+                mock.patch.object(transaction, 'on_commit', lambda f: f()):
+            send_mass_email(
+                ['user_{}@email.com'.format(idx) for idx in range(5)],
+                get_recipient_context=lambda email: {'email': email},
+                subject='Subject here',
+                template='email/test_email.html',
+            )
+
+        self.assertEqual(len(self.smtp_sink.messages), 2)
+        self.assertEqual(self.get_statuses(), [DeliveryStatus.SENT] * 2 + [DeliveryStatus.QUEUED] * 3)
+        task, payloads, wait = reschedule.call_args[0]
+        self.assertIs(task, send_batch_by_smtp)
+        self.assertEqual(
+            [payload['recipients'] for payload in payloads],
+            [['user_{}@email.com'.format(idx)] for idx in (2, 3, 4)],
+        )
+        # Время отправки зарезервировано для всех отложенных писем
+        send_at = [payload[rate_limiter.payload_key] for payload in payloads]
+        self.assertEqual([round(b - a) for a, b in zip(send_at, send_at[1:])], [1, 1])
+
+    @override_settings(DJNEWSLETTER_ASYNC_ENGINE=True, DJNEWSLETTER_RATE_LIMIT_MAX_SLEEP=0)
+    def test_rate_limited_async_batch_part_is_rescheduled(self):
+        with mock.patch('djnewsletter.tasks.reschedule') as reschedule, \
+                mock.patch.object(transaction, 'on_commit', lambda f: f()):
+            send_mass_email(
+                ['user_{}@email.com'.format(idx) for idx in range(5)],
+                get_recipient_context=lambda email: {'email': email},
+                subject='Subject here',
+                template='email/test_email.html',
+            )
+
+        self.assertEqual(len(self.smtp_sink.messages), 2)
+        self.assertEqual(sorted(self.get_statuses()), [DeliveryStatus.QUEUED] * 3 + [DeliveryStatus.SENT] * 2)
+        task, payloads, wait = reschedule.call_args[0]
+        self.assertIs(task, send_batch_async)
+        self.assertEqual(len(payloads), 3)
+        self.assertTrue(0 < wait <= 1)
+
+    def test_retry_countdown(self):
+        with mock.patch('djnewsletter.tasks.current') as current:
+            current.request.retries = 0
+            self.assertEqual(get_retry_countdown(), 60)
+            current.request.retries = 2
+            self.assertEqual(get_retry_countdown(), 180)
+
+
+@override_settings(
+    EMAIL_BACKEND='djnewsletter.backends.EmailBackend',
+    DJNEWSLETTER_SUPPRESSION_INDEX=True,
+    DJNEWSLETTER_SUPPRESSION_INDEX_REFRESH_INTERVAL=0,
+)
+@mock.patch('djnewsletter.smtp.get_connection')
+class SuppressionIndexTests(TestCase, EmailTestsMixin):
+    @classmethod
+    def setUpTestData(cls):
+        cls.email_server = cls.create_smtp_email_server(main=True)
+
+    def setUp(self):
+        email_servers_router.invalidate()
+        suppression_index.reset()
+
+    def send(self, to):
+        with mock.patch.object(transaction, 'on_commit', lambda f: f()):
+            send_email(
+                subject='Subject here',
+                body='Here is the <b>message</b>.',
+                to=to,
+                newsletter='newsletter',
+                headers={'List-Unsubscribe': '<mailto:unsubscribe@email.com>'},
+            )
+
+    def test_bloom_filter(self, mocked_get_connection):
+        bloom_filter = BloomFilter(capacity=1000, error_rate=0.01)
+        emails = ['user_{}@email.com'.format(idx) for idx in range(1000)]
+        for email in emails:
+            bloom_filter.add(email)
+        self.assertTrue(all(email in bloom_filter for email in emails))
+        false_positives = sum('other_{}@email.com'.format(idx) in bloom_filter for idx in range(10000))
+        self.assertLess(false_positives, 300)
+        self.assertFalse(bloom_filter.is_overflowed())
+
+    def test_clean_recipients_are_not_checked_in_db(self, mocked_get_connection):
+        Bounced.objects.create(email='bounced@email.com', event='bounce', eventDateTime=datetime.now())
+        with CaptureQueriesContext(connection) as context:
+            self.send(['clean_{}@email.com'.format(idx) for idx in range(10)])
+        self.assertFalse([
+            query for query in context.captured_queries
+            if 'djnewsletter_unsubscribers"."email" IN' in query['sql']
+            or 'djnewsletter_bounced"."email" IN' in query['sql']
+        ])
+        self.assertFalse(Emails.objects.filter(sender='did not send').exists())
+
+    def test_suppression_with_index(self, mocked_get_connection):
+        Bounced.objects.create(email='bounced@email.com', event='bounce', eventDateTime=datetime.now())
+        self.send(['clean@email.com'])
+
+        # Добавлены после построения индекса, подхватываются инкрементальным обновлением
+        Bounced.objects.create(email='Bounced_2@email.com', event='dropped', eventDateTime=datetime.now())
+        Unsubscribers.objects.create(email='unsubscribed@email.com', newsletter='newsletter')
+        self.send(['clean@email.com', 'bounced@email.com', 'Bounced_2@email.com', 'unsubscribed@email.com'])
+
+        not_sent = dict(Emails.objects.filter(sender='did not send').values_list('status', 'recipient'))
+        self.assertDictEqual(not_sent, {
+            'There were problems with the recipient this letter previously':
+                "['bounced@email.com', 'Bounced_2@email.com']",
+            'Don\'t sent, because user is unsubscribe': "['unsubscribed@email.com']",
+        })
+        self.assertEqual(Emails.objects.filter(used_server=self.email_server).last().recipient, "['clean@email.com']")
+
+
+class SendGridBouncedTests(TestCase):
+    def post(self, body):
+        request = RequestFactory().post('/bounced/', data=body, content_type='application/json')
+        return create_sendgrid_bounced(request)
+
+    def test_events_are_saved(self):
+        timestamp = int(time.time())
+        events = [
+            {'email': 'bounced@email.com', 'event': 'bounce', 'timestamp': timestamp, 'reason': 'reason',
+             'sg_event_id': 'event-1', 'unknown_field': 'value'},
+            {'email': 'bounced@email.com', 'event': 'bounce', 'timestamp': timestamp, 'reason': 'reason',
+             'sg_event_id': 'event-1', 'unknown_field': 'value'},
+            {'email': 'dropped@email.com', 'event': 'dropped', 'timestamp': timestamp, 'category': ['cat']},
+            {'email': 'dropped@email.com', 'event': 'dropped', 'timestamp': timestamp, 'category': ['cat']},
+            {'email': 'no-timestamp@email.com', 'event': 'bounce'},
+        ]
+        response = self.post(json.dumps(events))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            list(Bounced.objects.order_by('email').values_list('email', 'event', 'category', 'reason')),
+            [
+                ('bounced@email.com', 'bounce', None, 'reason'),
+                ('dropped@email.com', 'dropped', "['cat']", None),
+            ],
+        )
+        self.assertEqual(Bounced.objects.get(event='bounce').eventDateTime, datetime.fromtimestamp(timestamp))
+
+    def test_events_are_saved_in_batches(self):
+        events = [
+            {'email': 'user_{}@email.com'.format(idx), 'event': 'bounce', 'timestamp': 1000000000}
+            for idx in range(5)
+        ]
+        with self.settings(DJNEWSLETTER_BOUNCED_BATCH_SIZE=2), CaptureQueriesContext(connection) as queries:
+            self.post(json.dumps(events))
+
+        self.assertEqual(Bounced.objects.count(), 5)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('INSERT')]), 3)
+
+    def test_repeated_events_are_skipped(self):
+        events = [
+            {'email': 'bounced@email.com', 'event': 'bounce', 'timestamp': 1000000000},
+            {'email': 'bounced@email.com', 'event': 'delivered', 'timestamp': 1000000000},
+        ]
+        self.post(json.dumps(events))
+        events.append({'email': 'other@email.com', 'event': 'bounce', 'timestamp': 1000000100})
+        self.post(json.dumps(events))
+
+        self.assertEqual(
+            sorted(Bounced.objects.values_list('email', 'event')),
+            [('bounced@email.com', 'bounce'), ('bounced@email.com', 'delivered'), ('other@email.com', 'bounce')],
+        )
+
+    def test_invalid_body(self):
+        for body in ('', '{"email": "bounced@email.com"}', 'not json'):
+            self.assertEqual(self.post(body).status_code, 400)
+        self.assertEqual(self.post(b'[\xff]').status_code, 400)
+        self.assertFalse(Bounced.objects.exists())
+
+    def test_view_does_not_parse_body(self):
+        with mock.patch('djnewsletter.views.create_sendgrid_bounced_task.delay') as delay:
+            response = self.post('[{"email": "bounced@email.com"}]')
+
+        self.assertEqual(response.status_code, 200)
+        delay.assert_called_once_with('[{"email": "bounced@email.com"}]')
+        self.assertFalse(Bounced.objects.exists())
+
+    def test_task_is_retried_on_database_error(self):
+        calls = []
+
+        def create_bounced(data):
+            calls.append(data)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return create_sendgrid_bounced_events(data)
+
+        body = json.dumps([{'email': 'bounced@email.com', 'event': 'bounce', 'timestamp': int(time.time())}])
+        with mock.patch('djnewsletter.tasks.create_bounced', side_effect=create_bounced):
+            self.assertEqual(self.post(body).status_code, 200)
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(Bounced.objects.filter(email='bounced@email.com').exists())
+        self.assertEqual(create_sendgrid_bounced_task.queue, 'bounced')
+
+    def test_task_is_not_retried_on_data_error(self):
+        calls = []
+
+        def create_bounced(data):
+            calls.append(data)
+            raise DataError('value too long for type character varying(255)')
+
+        body = json.dumps([{'email': 'bounced@email.com', 'event': 'bounce', 'timestamp': int(time.time())}])
+        with mock.patch('djnewsletter.tasks.create_bounced', side_effect=create_bounced):
+            self.assertEqual(self.post(body).status_code, 200)
+        # Ошибка данных повторится при каждом повторе, задача не повторяется
+        self.assertEqual(len(calls), 1)
+
+    def test_long_values_are_truncated(self):
+        timestamp = int(time.time())
+        body = json.dumps([
+            {'email': 'bounced@email.com', 'event': 'bounce', 'timestamp': timestamp, 'reason': 'r' * 1000,
+             'category': ['c' * 300]},
+            {'email': '{}@email.com'.format('a' * 100), 'event': 'bounce', 'timestamp': timestamp},
+            {'email': 'other@email.com', 'event': 'e' * 300, 'timestamp': timestamp},
+        ])
+        self.assertEqual(self.post(body).status_code, 200)
+        bounced = Bounced.objects.get()
+        self.assertEqual(bounced.email, 'bounced@email.com')
+        self.assertEqual(bounced.reason, 'r' * 255)
+        self.assertEqual(len(bounced.category), 255)
+
+
+class SuppressionTablesTests(TestCase):
+    def get_query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' '.join(str(row[-1]) for row in cursor.fetchall())
+
+    def test_unsubscribe(self):
+        Unsubscribers.objects.unsubscribe(['some@email.com', 'other@email.com'], 'newsletter')
+        Unsubscribers.objects.unsubscribe(['some@email.com', 'new@email.com'], 'newsletter')
+        Unsubscribers.objects.unsubscribe(['some@email.com'], 'other_newsletter')
+
+        self.assertEqual(
+            sorted(Unsubscribers.objects.values_list('email', 'newsletter')),
+            [
+                ('new@email.com', 'newsletter'),
+                ('other@email.com', 'newsletter'),
+                ('some@email.com', 'newsletter'),
+                ('some@email.com', 'other_newsletter'),
+            ],
+        )
+
+    def test_suppression_lookups_use_covering_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN есть только в SQLite')
+        bounced = Bounced.objects.filter(
+            email__in=['some@email.com', 'other@email.com'],
+            event__in=Bounced.SUPPRESSION_EVENTS,
+        ).values_list('email')
+        unsubscribers = Unsubscribers.objects.filter(
+            email__in=['some@email.com', 'other@email.com'],
+            newsletter='newsletter',
+        ).values_list('email')
+
+        self.assertIn('COVERING INDEX', self.get_query_plan(bounced))
+        self.assertIn('COVERING INDEX', self.get_query_plan(unsubscribers))
+
+    def test_delete_duplicates(self):
+        email = Emails.objects.create(sender='email@example.com', recipient='some@email.com', status='')
+        for recipient, newsletter in [('some@email.com', 'a'), ('some@email.com', 'a'), ('some@email.com', 'b'),
+                                      ('other@email.com', 'a'), ('other@email.com', 'a'), ('other@email.com', 'a')]:
+            EmailRecipients.objects.create(
+                email=email, recipient=recipient, newsletter=newsletter, sentDateTime=datetime.now(),
+            )
+        first_ids = list(EmailRecipients.objects.order_by('id').values_list('id', flat=True))
+
+        with mock.patch.object(suppression_unique_migration, 'BATCH_SIZE', 1):
+            suppression_unique_migration.delete_duplicates(EmailRecipients, ('recipient', 'newsletter'))
+
+        self.assertEqual(
+            list(EmailRecipients.objects.order_by('id').values_list('id', flat=True)),
+            [first_ids[0], first_ids[2], first_ids[3]],
+        )
+
 
 @override_settings(DJNEWSLETTER_UNISENDER_URL='http://test.url')
-@mock.patch('djnewsletter.unisender.requests.post')
+@mock.patch('djnewsletter.unisender.requests.Session.post')
 class UniSenderAPIClientTestCase(TestCase):
     def test_can_pass_lazy_args_to_send_email_func(self, mock_requests_post):
         unisender_api = UniSenderAPIClient(
@@ -546,6 +1676,500 @@ class UniSenderAPIClientTestCase(TestCase):
             )
 
 
+class UniSenderStreamingBodyTests(TestCase):
+    def test_attachments_are_streamed(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        file_path = pathlib.Path(media_root.name, 'file.bin')
+        file_path.write_bytes(bytes(range(256)) * 1000)
+        with self.settings(MEDIA_ROOT=media_root.name):
+            stored_attachment = load_attachment(store_attachment(('stored.bin', b'stored' * 1000, 'text/plain')))
+
+        attachments = [
+            ('bytes.bin', bytes(range(256)) * 10 + b'x', 'application/octet-stream'),
+            ('text.txt', 'тест', 'text/plain'),
+            ('path.bin', file_path, 'application/octet-stream'),
+            ('file.bin', io.BytesIO(b'file object'), 'application/octet-stream'),
+        ]
+        with UniSenderStandIn() as stand_in, self.settings(
+                DJNEWSLETTER_UNISENDER_URL=stand_in.url,
+                DJNEWSLETTER_UNISENDER_CHUNK_SIZE=1000,
+                MEDIA_ROOT=media_root.name,
+        ):
+            response_json = UniSenderAPIClient(api_key='api_key', username='api_username').send(
+                subject='тема "в кавычках"',
+                body_html='body',
+                from_email='example@email.com',
+                from_name=None,
+                recipients=['example@email.com'],
+                attachments=attachments,
+                inline_attachments=[stored_attachment],
+            )
+        self.assertEqual(response_json['status'], 'success')
+
+        message = json.loads(stand_in.requests[0].decode('utf-8'))['message']
+        self.assertEqual(message['subject'], 'тема "в кавычках"')
+        self.assertListEqual(
+            [(attachment['name'], base64.b64decode(attachment['content'])) for attachment in message['attachments']],
+            [
+                ('bytes.bin', attachments[0][1]),
+                ('text.txt', 'тест'.encode('utf-8')),
+                ('path.bin', file_path.read_bytes()),
+                ('file.bin', b'file object'),
+            ],
+        )
+        self.assertEqual(message['inline_attachments'][0]['type'], 'text/plain')
+        self.assertEqual(base64.b64decode(message['inline_attachments'][0]['content']), b'stored' * 1000)
+
+    def test_body_length_and_chunks(self):
+        body = StreamingJSONBody(
+            {'content': Base64Content(b'x' * 10000), 'name': 'file'},
+            chunk_size=1024,
+        )
+        chunks = list(body)
+        self.assertEqual(len(body), len(b''.join(chunks)))
+        self.assertTrue(all(len(chunk) < 2 * 1024 for chunk in chunks))
+        body_json = json.loads(b''.join(chunks).decode('utf-8'))
+        self.assertEqual(body_json['content'], base64.b64encode(b'x' * 10000).decode())
+        # Тело можно отправить повторно
+        self.assertEqual(b''.join(body), b''.join(chunks))
+
+
+class UniSenderSessionTests(TestCase):
+    def setUp(self):
+        unisender_sessions.close_all()
+        self.addCleanup(unisender_sessions.close_all)
+
+    def send(self, api_key='api_key'):
+        return UniSenderAPIClient(api_key=api_key, username='api_username').send(
+            subject='subject',
+            body_html='body',
+            from_email='example@email.com',
+            from_name=None,
+            recipients=['example@email.com'],
+            attachments=[],
+            inline_attachments=[],
+        )
+
+    def test_session_is_reused(self):
+        with UniSenderStandIn() as stand_in, self.settings(DJNEWSLETTER_UNISENDER_URL=stand_in.url):
+            for _ in range(5):
+                self.assertEqual(self.send()['status'], 'success')
+            self.send(api_key='other_api_key')
+        self.assertEqual(len(stand_in.requests), 6)
+        self.assertEqual(stand_in.connections_count, 2)
+
+    def test_read_timeout(self):
+        with UniSenderStandIn(response_delay=0.5) as stand_in, self.settings(
+                DJNEWSLETTER_UNISENDER_URL=stand_in.url,
+                DJNEWSLETTER_UNISENDER_READ_TIMEOUT=0.1,
+        ):
+            with self.assertRaises(requests.exceptions.ReadTimeout):
+                self.send()
+
+
+@override_settings(EMAIL_BACKEND='djnewsletter.backends.EmailBackend')
+class DailyStatisticsTests(TestCase, EmailTestsMixin):
+    def setUp(self):
+        email_servers_router.invalidate()
+        smtp_connection_pool.close_all()
+        self.smtp_sink = SMTPSink()
+        self.smtp_sink.__enter__()
+        self.addCleanup(self.smtp_sink.__exit__)
+        self.addCleanup(smtp_connection_pool.close_all)
+        self.email_server = self.create_smtp_email_server(
+            email_host='127.0.0.1',
+            email_port=self.smtp_sink.port,
+            email_use_ssl=False,
+            email_fail_silently=False,
+            email_timeout=5,
+            main=True,
+        )
+        Bounced.objects.create(email='bounced@email.com', event='bounce', eventDateTime=datetime.now())
+
+    def send(self):
+        recipients = ['user_{}@email.com'.format(idx) for idx in range(5)] + ['bounced@email.com']
+        recipients[1] = 'reject@email.com'
+        with mock.patch.object(transaction, 'on_commit', lambda f: f()):
+            send_mass_email(
+                recipients,
+                get_recipient_context=lambda email: {'email': email},
+                subject='Subject here',
+                template='email/test_email.html',
+                newsletter='newsletter',
+            )
+
+    @staticmethod
+    def get_statistics():
+        return dict(
+            DailyStatistics.objects.values('delivery_status').annotate(
+                total=Sum('count'),
+            ).filter(total__gt=0).values_list('delivery_status', 'total')
+        )
+
+    def assertStatisticsEqualRebuilt(self):
+        statistics = self.get_statistics()
+        today = datetime.now().date()
+        rebuild_daily_statistics(today, today)
+        self.assertDictEqual(statistics, self.get_statistics())
+        self.assertDictEqual(statistics, {
+            DeliveryStatus.SENT: 4,
+            DeliveryStatus.FAILED: 1,
+            DeliveryStatus.BOUNCED: 1,
+        })
+
+    def test_statistics_are_updated_incrementally(self):
+        self.send()
+        self.assertStatisticsEqualRebuilt()
+        self.assertTrue(DailyStatistics.objects.filter(
+            used_server=None, newsletter='newsletter', delivery_status=DeliveryStatus.BOUNCED,
+        ).exists())
+
+    @override_settings(DJNEWSLETTER_TASK_BATCH_SIZE=3)
+    def test_statistics_are_updated_by_batch_task(self):
+        self.send()
+        self.assertStatisticsEqualRebuilt()
+
+    @override_settings(DJNEWSLETTER_ASYNC_ENGINE=True)
+    def test_statistics_are_updated_by_async_engine(self):
+        self.send()
+        self.assertStatisticsEqualRebuilt()
+
+    def test_get_daily_stats(self):
+        self.send()
+        today = datetime.now().date()
+        analytics = Analytics([])
+        with self.assertNumQueries(1):
+            statistics = analytics.get_daily_stats(today - timedelta(days=7), today)
+        self.assertDictEqual(statistics, {today: {'success': 4, 'error': 2, 'total': 6}})
+        self.assertDictEqual(
+            analytics.get_daily_stats(today, today, used_server=self.email_server, newsletter='newsletter'),
+            {today: {'success': 4, 'error': 1, 'total': 5}},
+        )
+        self.assertDictEqual(analytics.get_daily_stats(today, today, newsletter='other'), {})
+
+    def test_rebuild_command(self):
+        self.send()
+        DailyStatistics.objects.update(count=0)
+        today = datetime.now().date()
+        stdout = io.StringIO()
+        call_command(
+            'rebuild_daily_statistics',
+            (today - timedelta(days=2)).isoformat(),
+            today.isoformat(),
+            batch_days=2,
+            stdout=stdout,
+        )
+        self.assertEqual(len(stdout.getvalue().splitlines()), 2)
+        self.assertDictEqual(self.get_statistics(), {
+            DeliveryStatus.SENT: 4,
+            DeliveryStatus.FAILED: 1,
+            DeliveryStatus.BOUNCED: 1,
+        })
+
+    def test_rebuild_filters_by_create_datetime_range(self):
+        day = date(2026, 10, 10)
+        for created in (datetime(2026, 10, 9, 23, 59, 59), datetime(2026, 10, 10), datetime(2026, 10, 10, 23, 59, 59),
+                        datetime(2026, 10, 11)):
+            email = Emails.objects.create(recipient='some@email.com', status='', delivery_status=DeliveryStatus.SENT)
+            Emails.objects.filter(pk=email.pk).update(createDateTime=created)
+
+        with CaptureQueriesContext(connection) as context:
+            rebuild_daily_statistics(day, day)
+        selects = [query['sql'] for query in context.captured_queries if 'FROM "djnewsletter_emails"' in query['sql']]
+        self.assertEqual(len(selects), 1)
+        # Условие по самому полю, а не по дате от него, которая не использует индекс
+        where = selects[0].split('WHERE', 1)[1].split('GROUP BY', 1)[0]
+        self.assertIn('"djnewsletter_emails"."createDateTime" >=', where)
+        self.assertNotIn('django_datetime_cast_date', where)
+        self.assertListEqual(
+            list(DailyStatistics.objects.filter(day=day).values_list('delivery_status', 'count')),
+            [(DeliveryStatus.SENT, 2)],
+        )
+
+
+@override_settings(
+    DJNEWSLETTER_EMAILS_RETENTION=30,
+    DJNEWSLETTER_EMAILS_RETENTION_BY_NEWSLETTER={'weekly': 7, 'forever': None},
+)
+class EmailsArchiveTests(TestCase):
+    def setUp(self):
+        now = datetime.now()
+        self.emails = {}
+        for newsletter, days in [(None, 40), (None, 20), ('weekly', 10), ('weekly', 5), ('forever', 400),
+                                 ('other', 31), ('other', 29)]:
+            email = Emails.objects.create(
+                sender='email@example.com',
+                recipient="['some@email.com', 'other@email.com']",
+                body='body',
+                newsletter=newsletter,
+                status='sent to user',
+                delivery_status=DeliveryStatus.SENT,
+            )
+            Emails.objects.filter(id=email.id).update(createDateTime=now - timedelta(days=days))
+            email.refresh_from_db()
+            self.emails[(newsletter, days)] = email
+        EmailRecipients.objects.create_for_emails(self.emails.values())
+        self.expired_ids = sorted(self.emails[key].id for key in [(None, 40), ('weekly', 10), ('other', 31)])
+
+    def test_expired_emails_are_archived(self):
+        with CaptureQueriesContext(connection) as queries:
+            call_command('archive_emails', chunk_size=2, stdout=io.StringIO())
+
+        self.assertFalse(Emails.objects.filter(id__in=self.expired_ids).exists())
+        self.assertEqual(Emails.objects.count(), 4)
+        self.assertFalse(EmailRecipients.objects.filter(email_id__in=self.expired_ids).exists())
+        self.assertEqual(EmailRecipients.objects.count(), 8)
+        self.assertListEqual(list(EmailsArchive.objects.order_by('id').values_list('id', flat=True)), self.expired_ids)
+
+        email = self.emails[('weekly', 10)]
+        archived = EmailsArchive.objects.get(id=email.id)
+        self.assertEqual(archived.month, email.createDateTime.date().replace(day=1))
+        for field in ('recipient', 'body', 'newsletter', 'status', 'delivery_status', 'createDateTime'):
+            self.assertEqual(getattr(archived, field), getattr(email, field))
+        # Тела писем читаются только пачками для переноса в архив (2 пачки и пустой ответ), но не при удалении
+        self.assertEqual(
+            len([query for query in queries if query['sql'].startswith('SELECT') and '"body"' in query['sql']]), 3,
+        )
+
+    def test_expired_emails_are_purged(self):
+        out = io.StringIO()
+        call_command('archive_emails', purge=True, stdout=out)
+
+        self.assertEqual(Emails.objects.count(), 4)
+        self.assertFalse(Emails.objects.filter(id__in=self.expired_ids).exists())
+        self.assertFalse(EmailsArchive.objects.exists())
+        self.assertIn('Всего: 3 писем', out.getvalue())
+
+    @override_settings(DJNEWSLETTER_EMAILS_RETENTION=None, DJNEWSLETTER_EMAILS_RETENTION_BY_NEWSLETTER={})
+    def test_without_retention(self):
+        call_command('archive_emails', stdout=io.StringIO())
+        self.assertEqual(Emails.objects.count(), 7)
+
+    def test_statistics_are_rebuilt_with_archive(self):
+        email = self.emails[(None, 40)]
+        day = email.createDateTime.date()
+        rebuild_daily_statistics(day, day)
+        before = list(DailyStatistics.objects.values_list('day', 'newsletter', 'delivery_status', 'count'))
+
+        call_command('archive_emails', stdout=io.StringIO())
+        rebuild_daily_statistics(day, day)
+
+        self.assertEqual(
+            list(DailyStatistics.objects.values_list('day', 'newsletter', 'delivery_status', 'count')), before,
+        )
+        self.assertEqual(before, [(day, '', DeliveryStatus.SENT, 1)])
+
+
+class FakeExplainPaginator(ApproxCountPaginator):
+    explained = []
+
+    def get_filtered_approx_count_sqlite(self, connection, sql, params):
+        self.explained.append((sql, params))
+        return 5000
+
+
+@override_settings(DJNEWSLETTER_MIN_APPROX_COUNT=3)
+class ApproxCountPaginatorTests(TestCase):
+    def setUp(self):
+        approx_count_cache.clear()
+        self.addCleanup(approx_count_cache.clear)
+        FakeExplainPaginator.explained = []
+        for idx in range(6):
+            Bounced.objects.create(email='user_{}@email.com'.format(idx), event='bounce', eventDateTime=datetime.now())
+
+    def test_unfiltered_count_is_estimated(self):
+        Bounced.objects.filter(email='user_0@email.com').delete()
+        # Без статистики ANALYZE оценка - наибольший rowid
+        self.assertEqual(ApproxCountPaginator(Bounced.objects.order_by('-id'), 10).count, 6)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        approx_count_cache.clear()
+        self.assertEqual(ApproxCountPaginator(Bounced.objects.order_by('-id'), 10).count, 5)
+
+    def test_small_estimate_is_counted_exactly(self):
+        with self.settings(DJNEWSLETTER_MIN_APPROX_COUNT=10):
+            Bounced.objects.create(email='new@email.com', event='bounce', eventDateTime=datetime.now())
+            self.assertEqual(ApproxCountPaginator(Bounced.objects.order_by('id'), 10).count, 7)
+
+    def test_filtered_count_is_exact_without_explain_estimate(self):
+        queryset = Bounced.objects.filter(email__startswith='user_1').order_by('id')
+        self.assertEqual(ApproxCountPaginator(queryset, 10).count, 1)
+
+    def test_filtered_count_is_estimated_and_cached(self):
+        queryset = Bounced.objects.filter(email__startswith='user_1').order_by('-id')
+        with self.assertNumQueries(0):
+            self.assertEqual(FakeExplainPaginator(queryset, 10).count, 5000)
+            self.assertEqual(FakeExplainPaginator(queryset.order_by('email'), 10).count, 5000)
+        self.assertEqual(len(FakeExplainPaginator.explained), 1)
+        sql, params = FakeExplainPaginator.explained[0]
+        self.assertIn('WHERE', sql)
+        self.assertNotIn('ORDER BY', sql)
+
+        FakeExplainPaginator(Bounced.objects.filter(email__startswith='user_2').order_by('id'), 10).count
+        self.assertEqual(len(FakeExplainPaginator.explained), 2)
+
+        with self.settings(DJNEWSLETTER_APPROX_COUNT_TIMEOUT=0):
+            FakeExplainPaginator(queryset, 10).count
+        self.assertEqual(len(FakeExplainPaginator.explained), 3)
+
+    def test_admin_does_not_count_full_result(self):
+        user = User.objects.create_superuser('admin', 'admin@email.com', 'password')
+        Unsubscribers.objects.unsubscribe(['user_{}@email.com'.format(idx) for idx in range(5)], 'news')
+        Unsubscribers.objects.unsubscribe(['user_0@email.com'], 'other')
+        for model, result_count in ((Unsubscribers, 5), (EmailsArchive, 0)):
+            request = RequestFactory().get('/', {'newsletter': 'news'})
+            request.user = user
+            with CaptureQueriesContext(connection) as queries:
+                changelist = admin.site._registry[model].get_changelist_instance(request)
+            self.assertEqual(changelist.result_count, result_count)
+            self.assertIsNone(changelist.full_result_count)
+            # Только количество отфильтрованных строк, без COUNT(*) всей таблицы
+            self.assertEqual(len([query for query in queries if 'COUNT(' in query['sql']]), 1)
+
+    def test_cache_size_is_limited(self):
+        with self.settings(DJNEWSLETTER_APPROX_COUNT_CACHE_SIZE=2):
+            for idx in (0, 1, 2, 2, 0):
+                queryset = Bounced.objects.filter(email='user_{}@email.com'.format(idx)).order_by('id')
+                FakeExplainPaginator(queryset, 10).count
+        self.assertEqual(len(FakeExplainPaginator.explained), 4)
+
+
+class KeysetPaginationAdminTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@email.com', 'password')
+        self.model_admin = admin.site._registry[Emails]
+        self.model_admin.list_per_page = 3
+        self.addCleanup(setattr, self.model_admin, 'list_per_page', 100)
+        now = datetime.now()
+        for idx in range(8):
+            email = Emails.objects.create(
+                sender='email@example.com',
+                recipient='user_{}@email.com'.format(idx),
+                subject='Subject {}'.format(idx),
+                body='<p>body</p>',
+                status='',
+            )
+            # Одинаковое время у соседних писем: порядок внутри определяется id
+            Emails.objects.filter(id=email.id).update(createDateTime=now - timedelta(minutes=idx // 2))
+
+    def get_changelist(self, **params):
+        request = RequestFactory().get('/admin/djnewsletter/emails/', params)
+        request.user = self.user
+        return self.model_admin.get_changelist_instance(request)
+
+    def test_pages_follow_cursor(self):
+        expected_ids = list(Emails.objects.order_by('-createDateTime', '-id').values_list('id', flat=True))
+        ids, cursor, pages_count = [], None, 0
+        while True:
+            changelist = self.get_changelist(**({'cursor': cursor} if cursor else {}))
+            self.assertTrue(changelist.is_keyset_pagination)
+            ids.extend(email.id for email in changelist.result_list)
+            pages_count += 1
+            cursor = changelist.next_cursor
+            if cursor is None:
+                break
+            self.assertIn('cursor=', changelist.next_page_url)
+
+        self.assertListEqual(ids, expected_ids)
+        self.assertEqual(pages_count, 3)
+        self.assertNotIn('cursor', changelist.first_page_url)
+        self.assertTrue(changelist.multi_page)
+
+    def test_cursor_is_combined_with_filters(self):
+        Emails.objects.filter(recipient__in=['user_1@email.com', 'user_2@email.com']).update(
+            delivery_status=DeliveryStatus.SENT,
+        )
+        changelist = self.get_changelist(delivery_status__exact=DeliveryStatus.SENT)
+        self.assertEqual(
+            [email.recipient for email in changelist.result_list], ['user_1@email.com', 'user_2@email.com'],
+        )
+        self.assertIsNone(changelist.next_cursor)
+        self.assertFalse(changelist.multi_page)
+
+        email = Emails.objects.get(recipient='user_1@email.com')
+        changelist = self.get_changelist(
+            delivery_status__exact=DeliveryStatus.SENT,
+            cursor=changelist.format_cursor(email.createDateTime, email.id),
+        )
+        self.assertEqual([email.recipient for email in changelist.result_list], ['user_2@email.com'])
+
+    def test_invalid_cursor(self):
+        for cursor in ('invalid', '2020-01-01T00:00:00_id', '_1'):
+            with self.assertRaises(IncorrectLookupParameters):
+                self.get_changelist(cursor=cursor)
+
+    def test_sorting_uses_page_numbers(self):
+        changelist = self.get_changelist(o='1', p='1')
+        self.assertFalse(changelist.is_keyset_pagination)
+        self.assertEqual(len(changelist.result_list), 3)
+        self.assertEqual(changelist.result_count, 8)
+
+    def test_full_text_search(self):
+        queryset, use_distinct = self.model_admin.get_search_results(None, Emails.objects.all(), 'Subject 3')
+        self.assertEqual([email.recipient for email in queryset], ['user_3@email.com'])
+
+        with mock.patch.object(self.model_admin, 'is_full_text_search_available', return_value=True):
+            queryset, use_distinct = self.model_admin.get_search_results(None, Emails.objects.all(), 'Subject 3')
+        sql, params = queryset.query.sql_with_params()
+        self.assertIn('"search_vector" @@ plainto_tsquery(%s, %s)', sql)
+        self.assertEqual(params[-2:], ('simple', 'Subject 3'))
+        self.assertFalse(use_distinct)
+
+    def test_template(self):
+        get_template('admin/djnewsletter/keyset_change_list.html')
+
+
+class EmailsAdminTests(TestCase):
+    body = '<p>{}</p>'.format('body ' * 20000)
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@email.com', 'password'))
+        self.emails = [
+            Emails.objects.create(
+                sender='email@example.com',
+                recipient='user_{}@email.com'.format(idx),
+                subject='Subject',
+                body=self.body,
+                status='',
+            )
+            for idx in range(3)
+        ]
+
+    def test_changelist_does_not_load_bodies(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:djnewsletter_emails_changelist'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(len(response.content), len(self.body))
+        self.assertContains(response, '&lt;p&gt;body body', count=3)
+        self.assertContains(response, reverse('admin:djnewsletter_emails_body', args=[self.emails[0].pk]))
+        for query in queries:
+            self.assertEqual(
+                query['sql'].count('"djnewsletter_emails"."body"'),
+                query['sql'].count('SUBSTR("djnewsletter_emails"."body"'),
+            )
+
+    def test_body_view(self):
+        response = self.client.get(reverse('admin:djnewsletter_emails_body', args=[self.emails[0].pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.decode('utf-8'), self.body)
+        self.assertEqual(response['Content-Security-Policy'], 'sandbox')
+
+        response = self.client.get(reverse('admin:djnewsletter_emails_body', args=[0]))
+        self.assertEqual(response.status_code, 404)
+
+        self.client.logout()
+        response = self.client.get(reverse('admin:djnewsletter_emails_body', args=[self.emails[0].pk]))
+        self.assertEqual(response.status_code, 302)
+
+    def test_change_view_shows_body(self):
+        response = self.client.get(reverse('admin:djnewsletter_emails_change', args=[self.emails[0].pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'body ' * 100)
+
+
 class AnalyticsTests(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -557,8 +2181,8 @@ class AnalyticsTests(TestCase):
         )
         cls.recipient = '[email@email.com]'
 
-    def _create_email(self, email_server, recipient, status):
-        return Emails.objects.create(
+    def _create_email(self, email_server, recipient, status, delivery_status=DeliveryStatus.SENT):
+        email = Emails.objects.create(
             type='html',
             sender='send',
             recipient=recipient,
@@ -566,16 +2190,21 @@ class AnalyticsTests(TestCase):
             subject='subject',
             used_server=email_server,
             status=status,
+            delivery_status=delivery_status,
         )
+        EmailRecipients.objects.create_for_emails([email])
+        return email
 
     def _shift_create_datetime(self, email, days_offset):
         email.createDateTime = email.createDateTime - timedelta(days=days_offset)
         email.save(update_fields=('createDateTime',))
+        email.recipients.update(sentDateTime=email.createDateTime)
 
     def test_get_email_stats(self):
         self._create_email(self.smtp, self.recipient, 'sent to user')
         self._create_email(self.smtp, '[email2@email.com, email@email.com]', 'sent to user')
         self._create_email(self.smtp, '[email2@email.com]', 'sent to user')
+        self._create_email(self.smtp, '[other_email@email.com]', 'sent to user')
         email_2_day_ago = self._create_email(self.smtp, self.recipient, 'sent to user')
         self._shift_create_datetime(email_2_day_ago, 2)
         unisender_response = {
@@ -607,10 +2236,26 @@ class AnalyticsTests(TestCase):
         analytics = Analytics(['today', 5, '30'])
         self.assertDictEqual(excepted_dict, analytics.get_email_stats('email@email.com'))
 
+    def test_get_email_stats_in_one_query(self):
+        for days_offset in (0, 1.5, 2.5, 5, 6.5, 8, 20, 40):
+            email = self._create_email(self.smtp, self.recipient, 'sent to user')
+            self._shift_create_datetime(email, days_offset)
+        self._create_email(self.smtp, self.recipient, 'Connection refused', DeliveryStatus.FAILED)
+        analytics = Analytics(['today', 1, '3', 7, 30])
+        with self.assertNumQueries(1):
+            statistics = analytics.get_email_stats('email@email.com')
+        self.assertDictEqual(statistics, {
+            'today': {'success': 1, 'error': 1, 'total': 2},
+            1: {'success': 1, 'error': 1, 'total': 2},
+            '3': {'success': 3, 'error': 1, 'total': 4},
+            7: {'success': 5, 'error': 1, 'total': 6},
+            30: {'success': 7, 'error': 1, 'total': 8},
+        })
+
     def test_get_email_stats_with_errors(self):
         self._create_email(self.smtp, self.recipient, 'sent to user')
         self._create_email(self.smtp, '[email2@email.com, email@email.com]', 'sent to user')
-        self._create_email(self.smtp, self.recipient, 'sent to queue')
+        self._create_email(self.smtp, self.recipient, 'sent to queue', DeliveryStatus.QUEUED)
         self._create_email(self.unisender, self.recipient, str({
             'job_id': 'xxx-xxx',
             'status': 'success',
@@ -618,15 +2263,17 @@ class AnalyticsTests(TestCase):
         }))
         self._create_email(self.unisender, self.recipient, str({
             'job_id': 'xxx-xxx',
-        }))
-        self._create_email(self.unisender, self.recipient, str({
+        }), DeliveryStatus.FAILED)
+        email = self._create_email(self.unisender, '[email2@email.com, email@email.com]', str({
             'job_id': 'xxx-xxx',
             'status': 'success',
-            'emails': '[email2@email.com]',
+            'emails': ['email2@email.com'],
             'failed_emails': {
                 'email@email.com': 'unsubscribed',
             },
         }))
+        email.failed_recipients = ['email@email.com']
+        EmailRecipients.objects.mark_failed([email])
         analytics = Analytics(['today'])
         excepted_today_dict = {
             'success': 3,
@@ -634,3 +2281,44 @@ class AnalyticsTests(TestCase):
             'total': 6,
         }
         self.assertDictEqual(excepted_today_dict, analytics.get_email_stats('email@email.com')['today'])
+        self.assertDictEqual(
+            {'success': 2, 'error': 0, 'total': 2}, analytics.get_email_stats('email2@email.com')['today'],
+        )
+
+    def test_unisender_failed_recipients_backfill(self):
+        response_json = {
+            'status': 'success',
+            'emails': ['email2@email.com'],
+            'failed_emails': {'email@email.com': 'unsubscribed'},
+        }
+        failed = self._create_email(
+            self.unisender, '[email2@email.com, email@email.com]', str(response_json), DeliveryStatus.FAILED,
+        )
+        sent = self._create_email(self.unisender, '[email2@email.com, email@email.com]', str(response_json))
+        error = self._create_email(self.unisender, self.recipient, str({'status': 'error'}), DeliveryStatus.FAILED)
+        smtp = self._create_email(self.smtp, self.recipient, 'Connection refused', DeliveryStatus.FAILED)
+        # Ответ без failed_emails и emails: получатели не выбираются
+        self._create_email(self.unisender, self.recipient, str({'status': 'success'}))
+        rebuild_daily_statistics(date.today(), date.today())
+
+        with mock.patch.object(unisender_failed_migration, 'BATCH_SIZE', 2), \
+                CaptureQueriesContext(connection) as context:
+            unisender_failed_migration.mark_unisender_failed_recipients(apps, None)
+        # Один запрос получателей на диапазон id, в котором есть ответы с failed_emails или emails
+        recipients_selects = [
+            query for query in context.captured_queries
+            if query['sql'].startswith('SELECT') and 'FROM "djnewsletter_emailrecipients"' in query['sql']
+        ]
+        self.assertEqual(len(recipients_selects), 2)
+        self.assertListEqual(
+            [Emails.objects.get(pk=email.pk).delivery_status for email in (failed, sent, error, smtp)],
+            [DeliveryStatus.SENT, DeliveryStatus.SENT, DeliveryStatus.FAILED, DeliveryStatus.FAILED],
+        )
+        self.assertListEqual(
+            list(EmailRecipients.objects.filter(failed=True).order_by('email_id').values_list('email_id', 'recipient')),
+            [(failed.pk, 'email@email.com'), (sent.pk, 'email@email.com')],
+        )
+        self.assertDictEqual(
+            dict(DailyStatistics.objects.values_list('delivery_status').annotate(Sum('count'))),
+            {DeliveryStatus.SENT: 3, DeliveryStatus.FAILED: 2},
+        )
@@ -1,11 +1,18 @@
 import base64
+import contextlib
+import io
 import json
+import os
+import re
+import threading
 import urllib.parse
 
 import requests
+from requests.adapters import HTTPAdapter
 from django.utils.encoding import force_text
 from django.utils.functional import Promise
 
+from djnewsletter.attachments import StoredAttachment
 from djnewsletter.conf import settings
 
 
@@ -16,10 +23,168 @@ class LazyEncoder(json.JSONEncoder):
         return obj
 
 
+class Base64Content:
+    def __init__(self, content):
+        """
+        Содержимое вложения, которое кодируется в base64 по частям во время отправки запроса.
+        :param content: bytes, str, путь к файлу (os.PathLike), файловый объект или StoredAttachment
+        """
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        self.content = content
+        self.size = self.get_size()
+
+    def get_size(self):
+        if isinstance(self.content, bytes):
+            return len(self.content)
+        if isinstance(self.content, StoredAttachment):
+            return self.content.size()
+        if isinstance(self.content, os.PathLike):
+            return os.path.getsize(self.content)
+        position = self.content.tell()
+        size = self.content.seek(0, os.SEEK_END) - position
+        self.content.seek(position)
+        return size
+
+    @contextlib.contextmanager
+    def open(self):
+        if isinstance(self.content, bytes):
+            yield io.BytesIO(self.content)
+        elif isinstance(self.content, StoredAttachment):
+            with self.content.open() as content_file:
+                yield content_file
+        elif isinstance(self.content, os.PathLike):
+            with open(self.content, 'rb') as content_file:
+                yield content_file
+        else:
+            position = self.content.tell()
+            try:
+                yield self.content
+            finally:
+                self.content.seek(position)
+
+    def iter_encoded(self, read_size):
+        """
+        :param read_size: кратен 3, чтобы части base64 можно было склеить без выравнивания
+        """
+        remainder = b''
+        with self.open() as content_file:
+            while True:
+                chunk = content_file.read(read_size)
+                if not chunk:
+                    break
+                chunk = remainder + chunk
+                end = len(chunk) - len(chunk) % 3
+                remainder = chunk[end:]
+                yield base64.b64encode(chunk[:end])
+        if remainder:
+            yield base64.b64encode(remainder)
+
+    def __len__(self):
+        return (self.size + 2) // 3 * 4
+
+
+class StreamingJSONEncoder(LazyEncoder):
+    placeholder = '\x00djnewsletter-base64-{}\x00'
+
+    def __init__(self, *args, contents, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.contents = contents
+
+    def default(self, obj):
+        if isinstance(obj, Base64Content):
+            self.contents.append(obj)
+            return self.placeholder.format(len(self.contents) - 1)
+        return super().default(obj)
+
+
+class StreamingJSONBody:
+    placeholder_re = re.compile(r'"\\u0000djnewsletter-base64-(\d+)\\u0000"')
+
+    def __init__(self, data, chunk_size=None):
+        """
+        Тело запроса в JSON, в котором вложения (Base64Content) кодируются по частям во время отправки:
+        ни base64 строки вложения, ни всего JSON документа в памяти не бывает, расход памяти
+        ограничен chunk_size. Длина известна заранее, поэтому запрос уходит с Content-Length.
+        """
+        self.chunk_size = chunk_size or settings.DJNEWSLETTER_UNISENDER_CHUNK_SIZE
+        contents = []
+        json_string = json.dumps(data, cls=StreamingJSONEncoder, contents=contents)
+        self.parts = []
+        for idx, part in enumerate(self.placeholder_re.split(json_string)):
+            if idx % 2:
+                self.parts.append(contents[int(part)])
+            else:
+                self.parts.append(part.encode('utf-8'))
+
+    def __len__(self):
+        return sum(len(part) if isinstance(part, bytes) else len(part) + 2 for part in self.parts)
+
+    def iter_chunks(self):
+        read_size = self.chunk_size // 4 * 3
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            yield b'"'
+            yield from part.iter_encoded(read_size)
+            yield b'"'
+
+    def __iter__(self):
+        # Мелкие части склеиваются, чтобы не отправлять в сокет по несколько байт
+        buffer = bytearray()
+        for chunk in self.iter_chunks():
+            buffer += chunk
+            if len(buffer) >= self.chunk_size:
+                yield bytes(buffer)
+                buffer = bytearray()
+        if buffer:
+            yield bytes(buffer)
+
+
+class UniSenderSessions:
+    def __init__(self):
+        """
+        HTTP сессии с keep-alive соединениями, по одной на api_key в каждом процессе (воркере).
+        """
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    @staticmethod
+    def create_session():
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=settings.DJNEWSLETTER_UNISENDER_POOL_SIZE,
+            pool_block=True,
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get_session(self, api_key):
+        with self._lock:
+            session = self._sessions.get(api_key)
+            if session is None:
+                session = self._sessions[api_key] = self.create_session()
+            return session
+
+    def close_all(self):
+        with self._lock:
+            sessions = self._sessions
+            self._sessions = {}
+        for session in sessions.values():
+            session.close()
+
+
+unisender_sessions = UniSenderSessions()
+
+
 class UniSenderAPIClient(object):
     def __init__(self, api_key, username):
         self.api_key = api_key
         self.username = username
+        self.session = unisender_sessions.get_session(api_key)
 
         if not settings.DJNEWSLETTER_UNISENDER_URL:
             raise AttributeError('DJNEWSLETTER_UNISENDER_URL variable required.')
@@ -32,25 +197,29 @@ class UniSenderAPIClient(object):
     @staticmethod
     def _prepare_attachments(attachments):
         prepared_attachments = []
-        for filename, content, mimetype in attachments:
-            if not isinstance(content, bytes):
-                content = content.encode('utf-8')
+        for attachment in attachments:
+            if isinstance(attachment, StoredAttachment):
+                filename, content, mimetype = attachment.filename, attachment, attachment.mimetype
+            else:
+                filename, content, mimetype = attachment
             prepared_attachments.append({
                 'type': mimetype,
                 'name': filename,
-                'content': base64.b64encode(content).decode('utf-8'),
+                'content': Base64Content(content),
             })
         return prepared_attachments
 
-    @staticmethod
-    def _send_request(url, json_data):
-        json_string = json.dumps(json_data, cls=LazyEncoder)
-        response = requests.post(
+    def _send_request(self, url, json_data):
+        response = self.session.post(
             url=url,
-            data=json_string,
+            data=StreamingJSONBody(json_data),
             headers={
                 'Content-Type': 'application/json',
             },
+            timeout=(
+                settings.DJNEWSLETTER_UNISENDER_CONNECT_TIMEOUT,
+                settings.DJNEWSLETTER_UNISENDER_READ_TIMEOUT,
+            ),
         )
         response_json = response.json()
         return response_json
@@ -1,34 +1,27 @@
-import json
-from datetime import datetime
-
 from django.http import HttpResponse, Http404, HttpResponseBadRequest
 from django.views.decorators.csrf import csrf_exempt
 
-from djnewsletter.models import Bounced
+from djnewsletter.bounced import is_sendgrid_payload
+from djnewsletter.tasks import create_sendgrid_bounced as create_sendgrid_bounced_task
 
 
 @csrf_exempt
 def create_sendgrid_bounced(request):
+    """
+    Принимает события SendGrid и сразу отвечает: разбор и сохранение выполняются в задаче,
+    чтобы SendGrid не повторял большие пачки из-за долгого ответа.
+    """
     if request.method != 'POST':
         raise Http404
 
     data = request.body
-    if not data:
+    if not data or not is_sendgrid_payload(data):
         return HttpResponseBadRequest()
 
-    data = json.loads(data)
-    new_items = []
-    for item in data:
-        stamp = item.pop('timestamp')
-        category = item.pop('category', None)
-        available_fields = set(field.name for field in Bounced._meta.get_fields()) - {'id'}
-        item = {k: v for k, v in list(item.items()) if k in available_fields}  # remove other fields
+    try:
+        data = data.decode('utf-8')
+    except UnicodeDecodeError:
+        return HttpResponseBadRequest()
 
-        bounced = Bounced(**item)
-        bounced.eventDateTime = datetime.fromtimestamp(stamp)
-        if category:
-            bounced.category = str(category)
-        new_items.append(bounced)
-    if new_items:
-        Bounced.objects.bulk_create(new_items)
+    create_sendgrid_bounced_task.delay(data)
     return HttpResponse()
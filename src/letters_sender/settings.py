@@ -129,6 +129,13 @@ SITE_ID = 1
 # EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 EMAIL_BACKEND = 'djnewsletter.backends.EmailBackend'
 
+# Хранилище вложений писем, общее для процесса, который отправляет письма, и всех воркеров Celery
+# (на нескольких серверах - S3 или общая файловая система)
+DJNEWSLETTER_CONTENT_STORAGE = 'django.core.files.storage.FileSystemStorage'
+DJNEWSLETTER_CONTENT_STORAGE_OPTIONS = {
+    'location': os.path.join(MEDIA_ROOT, 'djnewsletter'),
+}
+
 CELERY_ACCEPT_CONTENT = ['pickle', 'json']
 CELERY_TASK_SERIALIZER = 'pickle'
 CELERY_RESULT_SERIALIZER = 'pickle'